@@ -1,6 +1,6 @@
 #!/bin/sh
 
-SERVICES="event_service verification_service retrieval_service classification_service notification_service"
+SERVICES="event_service verification_service verification_api retrieval_service classification_service notification_service"
 
 for service in $SERVICES; do
     status=$(supervisorctl status $service | awk '{print $2}')
@@ -31,7 +31,7 @@ END
 }
 
 if ! check_health ; then
-   echo "verification_service flask health check failed"
+   echo "verification_api health check failed"
    exit 1
 fi
 
@@ -0,0 +1,104 @@
+import re
+from datetime import datetime, timezone
+
+from prometheus_client import Counter
+
+from common.constants import IssueEvent, IssueNoteEvent, SnippetEvent, UserEvent
+
+cascade_routes = Counter(
+    "spam_classifier_cascade_routes_total",
+    "Number of events decided by the rules or passed on to the model",
+    ["type", "route"],
+)
+cascade_shadow = Counter(
+    "spam_classifier_cascade_shadow_total",
+    "Number of events the rules would decide, by whether the model agreed",
+    ["type", "route", "agreement"],
+)
+
+URL_PATTERN = re.compile(r"https?://|www\.", re.IGNORECASE)
+
+USER_EVENT_TYPES = [e.value for e in UserEvent]
+
+# Free text of a user profile. URL fields such as avatar_url, which
+# GitLab always sets, and website_url are not counted as links.
+USER_FREE_TEXT_FIELDS = ("name", "bio", "location", "organization", "job_title", "pronouns", "work_information")
+
+# Text the link rule counts links in, per event type
+TEXT_FIELDS = {
+    **{e.value: USER_FREE_TEXT_FIELDS for e in UserEvent},
+    **{e.value: ("title", "description") for e in IssueEvent},
+    **{e.value: ("body",) for e in IssueNoteEvent},
+    **{e.value: ("title", "description") for e in SnippetEvent},
+}
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+# RuleCascade class is the first tier of classification. Cheap rules on
+# the same text as the model decide clear-cut cases locally, and only
+# the others are sent to the model service:
+#
+#   - spam if the free text of a user profile, or the text of an issue,
+#     note or snippet has at least spam_min_urls links
+#   - not spam if a user account is at least ham_min_account_age_days
+#     old, was active in the last ham_max_inactive_days and has no links
+#
+# Thresholds of 0 disable a rule. Routes are counted per event type. In
+# shadow mode, the decisions of the rules are only counted against the
+# predictions of the model.
+class RuleCascade:
+    def __init__(self, spam_min_urls=5, ham_min_account_age_days=730, ham_max_inactive_days=30):
+        self.spam_min_urls = spam_min_urls
+        self.ham_min_account_age_days = ham_min_account_age_days
+        self.ham_max_inactive_days = ham_max_inactive_days
+
+    def url_count(self, event_type, data):
+        text = " ".join(str(data[field]) for field in TEXT_FIELDS[event_type] if data.get(field))
+        return len(URL_PATTERN.findall(text))
+
+    def is_established(self, data, now):
+        created_at = _parse_date(data.get("created_at"))
+        last_activity = _parse_date(data.get("last_activity_on"))
+        if created_at is None or last_activity is None:
+            return False
+
+        return (
+            (now - created_at).days >= self.ham_min_account_age_days
+            and (now - last_activity).days <= self.ham_max_inactive_days
+        )
+
+    # Returns the prediction and score of the rules, or None if the
+    # event is sent to the model.
+    def decide(self, event_type, data):
+        decision = None
+        if event_type in TEXT_FIELDS:
+            urls = self.url_count(event_type, data)
+            if self.spam_min_urls and urls >= self.spam_min_urls:
+                decision = (1, 1.0)
+            elif (
+                event_type in USER_EVENT_TYPES
+                and self.ham_min_account_age_days
+                and urls == 0
+                and self.is_established(data, datetime.now(timezone.utc))
+            ):
+                decision = (0, 0.0)
+
+        route = "model" if decision is None else ("rules_spam" if decision[0] else "rules_not_spam")
+        cascade_routes.labels(event_type, route).inc()
+        return decision
+
+    # Counts the decision of the rules for an event the model predicted
+    def shadow(self, event_type, data, prediction):
+        decision = self.decide(event_type, data)
+        if decision is not None:
+            route = "rules_spam" if decision[0] else "rules_not_spam"
+            cascade_shadow.labels(event_type, route, "agree" if decision[0] == prediction else "disagree").inc()
@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from common.constants import UserEvent
+
+USER_EVENT_TYPES = [e.value for e in UserEvent]
+
+
+# Loads the model registry of the model service with the model files in
+# models_dir. The models package and its dependencies
+# (models/requirements.txt) must be installed.
+def load_registry(models_dir, backend, variant, threads=None):
+    from models.registry import ModelRegistry
+
+    registry = ModelRegistry(
+        os.path.join(models_dir, "users", "versions"),
+        backend,
+        variant=variant,
+        threads=threads,
+        base_dir=models_dir,
+    )
+    registry.start_watcher()
+    return registry
+
+
+# InProcessModel class predicts user events with the model of the model
+# service loaded in the classification process, without HTTP requests.
+# New model versions are picked up like in the model service.
+#
+# Predictions run on threads of an executor, so that callers stop
+# waiting after timeout seconds, as with ProcessPoolModel. A prediction
+# past its timeout cannot be interrupted and finishes in the background.
+class InProcessModel:
+    def __init__(self, models_dir, backend, variant="float", threads=None):
+        self.registry = load_registry(models_dir, backend, variant, threads)
+        self.executor = ThreadPoolExecutor(thread_name_prefix="local_model")
+
+    def supports(self, event_type):
+        return event_type in USER_EVENT_TYPES
+
+    def predict(self, event_type, records, timeout=None):
+        return self.executor.submit(self.registry.active.predict_records, records).result(timeout)
+
+
+_worker_registry = None
+
+
+def _init_worker(models_dir, backend, variant, threads):
+    global _worker_registry
+    _worker_registry = load_registry(models_dir, backend, variant, threads)
+
+
+def _predict_in_worker(records):
+    return _worker_registry.active.predict_records(records)
+
+
+# ProcessPoolModel class predicts user events with the model loaded in
+# each of a pool of local processes, so that predictions use several
+# cores without HTTP requests. Workers are spawned rather than forked,
+# as the runtimes are not fork safe.
+class ProcessPoolModel:
+    def __init__(self, models_dir, backend, variant="float", threads=None, processes=None):
+        self.executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(models_dir, backend, variant, threads),
+        )
+
+    def supports(self, event_type):
+        return event_type in USER_EVENT_TYPES
+
+    def predict(self, event_type, records, timeout=None):
+        return self.executor.submit(_predict_in_worker, records).result(timeout)
+
+
+MODEL_MODES = {
+    "in_process": InProcessModel,
+    "process_pool": ProcessPoolModel,
+}
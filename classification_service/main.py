@@ -1,11 +1,16 @@
 import json
 import logging
 import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from contextlib import contextmanager
 
+from classification_service.cascade import RuleCascade
+from classification_service.local_model import MODEL_MODES
+from classification_service.model_client import CircuitBreaker, CircuitOpenError, ModelClient
+from classification_service.prediction_cache import PredictionCache
+from classification_service.routing import load_routes, route_events
 from common.event_processor import EventProcessor
 
 from prometheus_client import multiprocess, CollectorRegistry, Counter, Histogram
@@ -16,74 +21,355 @@ logging.basicConfig(
 )
 
 
+CLASSIFICATION_BATCH_SIZE = int(os.getenv("CLASSIFICATION_BATCH_SIZE", 1))
+CLASSIFICATION_BATCH_MAX_WAIT_MS = int(os.getenv("CLASSIFICATION_BATCH_MAX_WAIT_MS", 50))
+
+# Predictions cached by content, see prediction_cache.py. A size of 0
+# disables the cache, and the Redis tier shares it between replicas.
+CLASSIFICATION_CACHE_SIZE = int(os.getenv("CLASSIFICATION_CACHE_SIZE", 10000))
+CLASSIFICATION_CACHE_TTL = int(os.getenv("CLASSIFICATION_CACHE_TTL", 3600))
+CLASSIFICATION_CACHE_REDIS = os.getenv("CLASSIFICATION_CACHE_REDIS", "false").lower() == "true"
+
+# Rules deciding clear-cut users before the model, see cascade.py. "on"
+# publishes the decisions of the rules instead of predicting with the
+# model. "shadow" only counts the decisions of the rules against the
+# predictions of the model, until the thresholds are validated.
+CLASSIFICATION_CASCADE = os.getenv("CLASSIFICATION_CASCADE", "shadow").lower()
+CASCADE_SPAM_MIN_URLS = int(os.getenv("CASCADE_SPAM_MIN_URLS", 5))
+CASCADE_HAM_MIN_ACCOUNT_AGE_DAYS = int(os.getenv("CASCADE_HAM_MIN_ACCOUNT_AGE_DAYS", 730))
+CASCADE_HAM_MAX_INACTIVE_DAYS = int(os.getenv("CASCADE_HAM_MAX_INACTIVE_DAYS", 30))
+
+# Model version of the predictions made by the rules
+RULES_MODEL_VERSION = "rules"
+
+CASCADE_MODES = ("off", "shadow", "on")
+
+# Routing table overrides as a JSON object, see routing.py, and the
+# defaults of the routes
+CLASSIFICATION_ROUTES = os.getenv("CLASSIFICATION_ROUTES") or None
+CLASSIFICATION_ROUTE_TIMEOUT = float(os.getenv("CLASSIFICATION_ROUTE_TIMEOUT", 10))
+CLASSIFICATION_ROUTE_CONCURRENCY = int(os.getenv("CLASSIFICATION_ROUTE_CONCURRENCY", 4))
+
+# "http" sends events to the model service. "in_process" and
+# "process_pool" load the model of the model service, with the models
+# package and the model files of the models directory, and predict user
+# events locally, see local_model.py.
+CLASSIFICATION_MODEL_MODE = os.getenv("CLASSIFICATION_MODEL_MODE", "http")
+CLASSIFICATION_MODELS_DIR = os.getenv("CLASSIFICATION_MODELS_DIR", "models")
+CLASSIFICATION_MODEL_BACKEND = os.getenv("CLASSIFICATION_MODEL_BACKEND", "keras")
+CLASSIFICATION_MODEL_VARIANT = os.getenv("CLASSIFICATION_MODEL_VARIANT", "float")
+CLASSIFICATION_MODEL_PROCESSES = int(os.getenv("CLASSIFICATION_MODEL_PROCESSES", 0)) or None
+
+# Connections kept open to the model service, by default one per batch
+# worker, and the circuit breaker of the model service: it opens after
+# CLASSIFICATION_BREAKER_FAILURES consecutive failures and lets a trial
+# request through after CLASSIFICATION_BREAKER_RESET_SECONDS.
+CLASSIFICATION_MODEL_POOL_SIZE = int(os.getenv("CLASSIFICATION_MODEL_POOL_SIZE", 0))
+CLASSIFICATION_BREAKER_FAILURES = int(os.getenv("CLASSIFICATION_BREAKER_FAILURES", 5))
+CLASSIFICATION_BREAKER_RESET_SECONDS = float(os.getenv("CLASSIFICATION_BREAKER_RESET_SECONDS", 30))
+
+# How long events wait for the model service while it cannot be reached
+# before they are moved to the dead letter stream
+CLASSIFICATION_MODEL_UNREACHABLE_SECONDS = float(os.getenv("CLASSIFICATION_MODEL_UNREACHABLE_SECONDS", 300))
+
+# Stream that events failing classification are moved to, with the
+# reason of the failure, and the number of events it keeps
+CLASSIFICATION_DEAD_LETTER_STREAM = os.getenv("CLASSIFICATION_DEAD_LETTER_STREAM", "classification:dead_letter")
+CLASSIFICATION_DEAD_LETTER_MAXLEN = int(os.getenv("CLASSIFICATION_DEAD_LETTER_MAXLEN", 10000))
+
+score_histogram = Histogram(
+    "spam_classifier_scores",
+    "Spam score returned by spam classifier",
+    buckets=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0],
+)
+request_latency = Histogram(
+    "spam_classifier_request_latency_seconds",
+    "Time taken for spam classifier to respond",
+)
+successful_requests = Counter(
+    "spam_classifier_successful_requests_total",
+    "Number of successful requests to spam classifier",
+)
+failed_requests = Counter(
+    "spam_classifier_failed_requests_total",
+    "Number of failed requests to spam classifier",
+)
+event_types = Counter(
+    "spam_classifier_event_types_total",
+    "Number of events processed by type",
+    ["type"],
+)
+batch_fill = Histogram(
+    "spam_classifier_batch_fill_ratio",
+    "Number of events in a batch relative to the maximum batch size",
+    ["type"],
+    buckets=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0],
+)
+batch_wait = Histogram(
+    "spam_classifier_batch_wait_seconds",
+    "Time the oldest event of a batch waited before the batch was sent",
+    ["type"],
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0],
+)
+
+
+# GitlabUserSpamClassifier class sends events to the model service and
+# adds the predictions to the classification stream. The routing table
+# tells which model endpoint or local classifier classifies each event
+# type, and events of other types are skipped.
+#
+# If batch_size is greater than 1, events are gathered per event type
+# until batch_size events are waiting or the oldest one has waited
+# batch_max_wait_ms, and each batch is sent to the batch prediction
+# endpoint of the model service. If the model service does not have the
+# endpoint, events are sent one by one.
+#
+# Clear-cut users are decided by rules without the model service. Events
+# whose content was already predicted by the model version the model
+# service last reported are answered from the prediction cache.
+# After a model swap, cached predictions of the previous version are
+# used until the next prediction reports the new version.
 class GitlabUserSpamClassifier(EventProcessor):
-    def __init__(self, redis_conn=None, model_url="http://127.0.0.1:5001"):
+    def __init__(
+        self,
+        redis_conn=None,
+        model_url="http://127.0.0.1:5001",
+        batch_size=CLASSIFICATION_BATCH_SIZE,
+        batch_max_wait_ms=CLASSIFICATION_BATCH_MAX_WAIT_MS,
+        cache_size=CLASSIFICATION_CACHE_SIZE,
+        cascade=CLASSIFICATION_CASCADE,
+        routes=None,
+        model_mode=CLASSIFICATION_MODEL_MODE,
+        local_model=None,
+        model_client=None,
+    ):
         super().__init__("retrieval", "classification", redis_conn=redis_conn)
         self.model_url = model_url
+        self.batch_size = batch_size
+        self.batch_max_wait_ms = batch_max_wait_ms
+        self.batch_endpoint_available = True
 
-        prometheus_multiproc_dir = "prometheus_multiproc_dir"
-
-        os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+        self.routes = routes if routes is not None else load_routes(
+            CLASSIFICATION_ROUTES, CLASSIFICATION_ROUTE_TIMEOUT, CLASSIFICATION_ROUTE_CONCURRENCY
+        )
 
-        registry = CollectorRegistry()
-        multiprocess.MultiProcessCollector(registry)
+        # Batches of different routes are sent concurrently, up to the
+        # concurrency limits of the routes
+        self.batch_workers = sum(route.max_concurrency for route in self.routes.values() if route.endpoint) or 1
+        self.batch_executor = ThreadPoolExecutor(max_workers=self.batch_workers)
 
-        self.score_histogram = Histogram(
-            "spam_classifier_scores",
-            "Spam score returned by spam classifier",
-            buckets=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0],
+        self.model_client = model_client or ModelClient(
+            model_url,
+            pool_size=CLASSIFICATION_MODEL_POOL_SIZE or self.batch_workers,
+            breaker=CircuitBreaker(CLASSIFICATION_BREAKER_FAILURES, CLASSIFICATION_BREAKER_RESET_SECONDS),
         )
 
-        self.request_latency = Histogram(
-            "spam_classifier_request_latency_seconds",
-            "Time taken for spam classifier to respond",
+        rules = RuleCascade(
+            spam_min_urls=CASCADE_SPAM_MIN_URLS,
+            ham_min_account_age_days=CASCADE_HAM_MIN_ACCOUNT_AGE_DAYS,
+            ham_max_inactive_days=CASCADE_HAM_MAX_INACTIVE_DAYS,
         )
+        if cascade not in CASCADE_MODES:
+            raise ValueError(f"Unknown cascade mode {cascade}, expected one of {', '.join(CASCADE_MODES)}")
+        self.cascade = rules if cascade == "on" else None
+        self.shadow_cascade = rules if cascade == "shadow" else None
+        self.local_classifiers = {"rules": rules.decide}
+
+        self.local_model = local_model or self._load_local_model(model_mode)
+
+        self.model_version = None
+        self.prediction_cache = None
+        if cache_size:
+            self.prediction_cache = PredictionCache(
+                self.redis_client if CLASSIFICATION_CACHE_REDIS else None,
+                max_size=cache_size,
+                ttl=CLASSIFICATION_CACHE_TTL,
+            )
 
-        self.successful_requests = Counter(
-            "spam_classifier_successful_requests_total",
-            "Number of successful requests to spam classifier",
-        )
+        prometheus_multiproc_dir = "prometheus_multiproc_dir"
 
-        self.failed_requests = Counter(
-            "spam_classifier_failed_requests_total",
-            "Number of failed requests to spam classifier",
-        )
+        os.makedirs(prometheus_multiproc_dir, exist_ok=True)
 
-        self.event_types = Counter(
-            "spam_classifier_event_types_total",
-            "Number of events processed by type",
-            ["type"],
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+        self.score_histogram = score_histogram
+        self.request_latency = request_latency
+        self.successful_requests = successful_requests
+        self.failed_requests = failed_requests
+        self.event_types = event_types
+
+    @staticmethod
+    def _load_local_model(model_mode):
+        if model_mode == "http":
+            return None
+        if model_mode not in MODEL_MODES:
+            raise ValueError(f"Unknown model mode {model_mode}, expected http or one of {', '.join(MODEL_MODES)}")
+
+        options = {"processes": CLASSIFICATION_MODEL_PROCESSES} if model_mode == "process_pool" else {}
+        return MODEL_MODES[model_mode](
+            CLASSIFICATION_MODELS_DIR, CLASSIFICATION_MODEL_BACKEND, CLASSIFICATION_MODEL_VARIANT, **options
         )
 
     def process_event(self, event_type, data):
+        route = self._route(event_type)
+        if route is not None and not self._publish_local_prediction(event_type, data, route):
+            self._predict_event(event_type, data, route)
+
+    # Returns the route of an event type. Events without a route are
+    # skipped.
+    def _route(self, event_type, count=1):
+        route = self.routes.get(event_type)
+        if route is None:
+            logging.debug(f"No route for event type {event_type}, skipping")
+            route_events.labels(event_type, "skipped").inc(count)
+        return route
+
+    # Events the model service fails to predict are moved to the dead
+    # letter stream, so that one event cannot stop the classification of
+    # the others.
+    def _predict_event(self, event_type, data, route):
         logging.debug(f"processing event {event_type}")
 
-        data_json = json.dumps(data)
+        if self.local_model is not None and self.local_model.supports(event_type):
+            self._predict_locally(event_type, [data], route)
+            return
 
-        url = f"{self.model_url}/predict_{event_type}"
-
-        response = None
-        with self.request_latency.time():
-            with self.retry() as session:
-                response = session.post(
-                    url,
-                    data=data_json,
-                    headers={"Content-Type": "application/json"},
-                )
+        response = self._post_to_model(event_type, route.endpoint, json.dumps(data), route, [data])
+        if response is None:
+            return
 
         if response.status_code != 200:
-            self.failed_requests.inc()
-            logging.critical(
-                f"Model returned code {response.status_code}",
-                f"Response: {response.text}"
+            self._dead_letter(
+                event_type, [data], "error", f"Model returned code {response.status_code}. Response: {response.text}"
             )
-            exit(1)
+            return
 
         self.successful_requests.inc()
+        route_events.labels(event_type, "predicted").inc()
+
+        self._publish_result(event_type, data, response.json())
 
-        prediction = response.json()["prediction"]
+    # Predicts events with the local model, in one call for a batch
+    def _predict_locally(self, event_type, events, route):
+        try:
+            with route, self.request_latency.time():
+                results = self.local_model.predict(event_type, events, timeout=route.timeout)
+        except FuturesTimeoutError:
+            self._dead_letter(event_type, events, "timeout", f"Local model timed out after {route.timeout}s")
+            return
+        except Exception as e:
+            self._dead_letter(event_type, events, "error", f"Local model failed: {e}")
+            return
 
-        score = round(response.json()["score"], 3)
+        self.successful_requests.inc()
+        route_events.labels(event_type, "predicted").inc(len(events))
+
+        for data, result in zip(events, results):
+            self._publish_result(event_type, data, result)
+
+    # Sends a request to the model service for the given events. While
+    # the model service cannot be reached, the request is retried
+    # whenever the circuit breaker allows it, so that the events wait in
+    # the stream instead of being lost, for up to
+    # CLASSIFICATION_MODEL_UNREACHABLE_SECONDS. Requests that time out,
+    # still fail after the retries of the model client, or cannot reach
+    # the model service in that time fail the events, which are moved to
+    # the dead letter stream, and None is returned.
+    def _post_to_model(self, event_type, path, data, route, events):
+        deadline = time.monotonic() + CLASSIFICATION_MODEL_UNREACHABLE_SECONDS
+        while True:
+            try:
+                with route, self.request_latency.time():
+                    return self.model_client.post(path, data=data, timeout=route.timeout)
+            except CircuitOpenError as e:
+                if time.monotonic() + e.retry_after > deadline:
+                    self._dead_letter(event_type, events, "unreachable", f"{e}, giving up")
+                    return None
+                logging.warning(f"{e}")
+                time.sleep(e.retry_after)
+            except requests.ConnectionError as e:
+                if time.monotonic() > deadline:
+                    self._dead_letter(event_type, events, "unreachable", f"Model service cannot be reached: {e}")
+                    return None
+                self.failed_requests.inc()
+                logging.error(f"Model service cannot be reached: {e}")
+            except requests.Timeout:
+                self._dead_letter(event_type, events, "timeout", f"Model timed out after {route.timeout}s")
+                return None
+            except requests.RequestException as e:
+                self._dead_letter(event_type, events, "error", f"Request to model service failed: {e}")
+                return None
+
+    # Moves events that failed classification to the dead letter stream
+    # with the reason of the failure, so that they can be inspected and
+    # replayed
+    def _dead_letter(self, event_type, events, outcome, message):
+        self.failed_requests.inc()
+        route_events.labels(event_type, outcome).inc(len(events))
+        logging.error(f"Moving {len(events)} {event_type} event(s) to {CLASSIFICATION_DEAD_LETTER_STREAM}: {message}")
+
+        for data in events:
+            self.redis_client.xadd(
+                CLASSIFICATION_DEAD_LETTER_STREAM,
+                {event_type: json.dumps({"event_data": data, "outcome": outcome, "error": message})},
+                maxlen=CLASSIFICATION_DEAD_LETTER_MAXLEN,
+                approximate=True,
+            )
+
+    # Publishes the prediction of a local route, of the rules or the
+    # cached prediction of an event, if there is one. Events of local
+    # routes that the local classifier does not decide are skipped.
+    def _publish_local_prediction(self, event_type, data, route):
+        if route.local is not None:
+            decision = self.local_classifiers[route.local](event_type, data)
+            if decision is None:
+                route_events.labels(event_type, "undecided").inc()
+            else:
+                route_events.labels(event_type, "local").inc()
+                self._publish_prediction(event_type, data, *decision, route.local)
+            return True
+
+        if self.cascade is not None:
+            decision = self.cascade.decide(event_type, data)
+            if decision is not None:
+                self._publish_prediction(event_type, data, *decision, RULES_MODEL_VERSION)
+                return True
+
+        if self.prediction_cache is None:
+            return False
+
+        key = self.prediction_cache.key(event_type, data, self.model_version)
+        if key is None:
+            return False
+
+        cached = self.prediction_cache.get(event_type, key)
+        if cached is None:
+            return False
+
+        self._publish_prediction(event_type, data, cached["prediction"], cached["score"], self.model_version)
+        return True
+
+    # Publishes and caches a prediction of the model service
+    def _publish_result(self, event_type, data, result):
+        if self.shadow_cascade is not None:
+            self.shadow_cascade.shadow(event_type, data, result["prediction"])
+
+        model_version = result.get("model_version")
+        if model_version is not None:
+            self.model_version = model_version
+
+        if self.prediction_cache is not None:
+            key = self.prediction_cache.key(event_type, data, model_version)
+            if key is not None:
+                self.prediction_cache.set(key, result["prediction"], result["score"])
+
+        self._publish_prediction(event_type, data, result["prediction"], result["score"], model_version)
+
+    # Results name the model version that predicted them, if the model
+    # service reports it
+    def _publish_prediction(self, event_type, data, prediction, score, model_version=None):
+        score = round(score, 3)
 
         self.score_histogram.observe(score)
 
@@ -92,6 +378,8 @@ class GitlabUserSpamClassifier(EventProcessor):
             "prediction": prediction,
             "score": score,
         }
+        if model_version is not None:
+            results["model_version"] = model_version
 
         logging.debug(
             {
@@ -106,30 +394,123 @@ class GitlabUserSpamClassifier(EventProcessor):
 
         self.event_types.labels(type=event_type).inc()
 
-    @contextmanager
-    def retry(self, total_requests=5, backoff_factor=1, statuses=(500, 502, 503, 504, 429)):
+    # Sends a batch of events of one type to the model service. Returns
+    # False if the model service has no batch prediction endpoint.
+    def process_events_batch(self, event_type, events, route):
+        response = self._post_to_model(
+            event_type,
+            "/predict_batch",
+            json.dumps({"event_type": event_type, "records": events}),
+            route,
+            events,
+        )
+        if response is None:
+            return True
 
-        session = requests.Session()
+        if response.status_code == 404:
+            return False
 
-        retries = Retry(total=total_requests, backoff_factor=backoff_factor, status_forcelist=list(statuses), allowed_methods=["GET", "POST"])
+        if response.status_code != 200:
+            self._dead_letter(
+                event_type, events, "error", f"Model returned code {response.status_code}. Response: {response.text}"
+            )
+            return True
+
+        self.successful_requests.inc()
+        route_events.labels(event_type, "predicted").inc(len(events))
+
+        for data, result in zip(events, response.json()["predictions"]):
+            self._publish_result(event_type, data, result)
+        return True
 
-        session.mount("http://", HTTPAdapter(max_retries=retries))
-        session.mount("https://", HTTPAdapter(max_retries=retries))
+    # Events of a batch failing with an unexpected error are moved to the
+    # dead letter stream, as they were already read past and would
+    # otherwise stay in the stream until a restart. Events published
+    # before the error are moved too.
+    def _flush_batch(self, event_type, batch):
+        batch_fill.labels(type=event_type).observe(len(batch) / self.batch_size)
+        batch_wait.labels(type=event_type).observe(time.monotonic() - batch[0][2])
 
         try:
-            yield session
-        except requests.RequestException as e:
-            self.failed_requests.inc()
-            logging.critical(
-                {
-                    "Classification service:": "Request to model service timed out too many times",
-                    "error": e,
-                }
+            self._classify_batch(event_type, batch)
+        except Exception as e:
+            self._dead_letter(event_type, [data for _, data, _ in batch], "error", f"Failed to process batch: {e}")
+
+        self.redis_client.xdel(self.input_stream_name, *[message_id for message_id, _, _ in batch])
+
+    def _classify_batch(self, event_type, batch):
+        route = self._route(event_type, len(batch))
+        events = []
+        if route is not None:
+            events = [data for _, data, _ in batch if not self._publish_local_prediction(event_type, data, route)]
+
+        if events and self.local_model is not None and self.local_model.supports(event_type):
+            self._predict_locally(event_type, events, route)
+            events = []
+
+        if events and route.batch and self.batch_endpoint_available:
+            if self.process_events_batch(event_type, events, route):
+                events = []
+            else:
+                logging.warning("Model service has no batch prediction endpoint, sending events one by one")
+                self.batch_endpoint_available = False
+
+        for data in events:
+            self._predict_event(event_type, data, route)
+
+    def _submit_batch(self, event_type, batch, pending):
+        future = self.batch_executor.submit(self._flush_batch, event_type, batch)
+        future.add_done_callback(
+            lambda f: f.exception() and logging.error(f"Failed to process {event_type} batch: {f.exception()}")
+        )
+        pending.add(future)
+
+    # Reads events after the last one read instead of from the start of
+    # the stream, so that events waiting in a batch are not read again.
+    # Events are deleted from the stream once their batch is processed.
+    # Reading waits while all batch workers are busy.
+    def poll_and_process_batches(self, testing=False):
+        batches = {}
+        pending = set()
+        last_id = '0'
+
+        while True:
+            pending = {future for future in pending if not future.done()}
+            if len(pending) >= self.batch_workers:
+                wait(pending, return_when=FIRST_COMPLETED)
+
+            block_ms = self.poll_block_ms
+            if batches:
+                oldest = min(batch[0][2] for batch in batches.values())
+                block_ms = max(1, int((oldest + self.batch_max_wait_ms / 1000 - time.monotonic()) * 1000))
+
+            messages = self.redis_client.xread(
+                {self.input_stream_name: last_id}, block=block_ms, count=self.batch_size
             )
-            exit(1)
+
+            for message_id, message in messages[0][1] if messages else []:
+                last_id = message_id
+                for key, value in message.items():
+                    event_type = key.decode('utf-8')
+                    batch = batches.setdefault(event_type, [])
+                    batch.append((message_id, json.loads(value.decode('utf-8')), time.monotonic()))
+                    if len(batch) >= self.batch_size:
+                        self._submit_batch(event_type, batches.pop(event_type), pending)
+
+            now = time.monotonic()
+            for event_type in list(batches):
+                if testing or now - batches[event_type][0][2] >= self.batch_max_wait_ms / 1000:
+                    self._submit_batch(event_type, batches.pop(event_type), pending)
+
+            if testing and messages:
+                wait(pending)
+                return
 
     def run(self, testing=False):
-        self.poll_and_process_event(testing=testing)
+        if self.batch_size > 1:
+            self.poll_and_process_batches(testing=testing)
+        else:
+            self.poll_and_process_event(testing=testing)
 
 
 def main():
@@ -0,0 +1,186 @@
+import threading
+import time
+
+import requests
+from prometheus_client import Counter, Gauge
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+model_requests = Counter(
+    "spam_classifier_model_requests_total",
+    "Number of requests to the model service by outcome",
+    ["outcome"],
+)
+model_connections = Counter(
+    "spam_classifier_model_connections_total",
+    "Number of connections opened to the model service, requests not opening one reuse a pooled connection",
+)
+circuit_state = Gauge(
+    "spam_classifier_model_circuit_state",
+    "State of the circuit breaker of the model service: 0 closed, 1 half open, 2 open",
+    multiprocess_mode="livemax",
+)
+
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Model service circuit is open, retrying in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+# CircuitBreaker class stops requests to the model service after
+# failure_threshold consecutive failures. Once reset_timeout seconds
+# have passed, a single trial request is let through: the circuit closes
+# again if it succeeds and stays open for another reset_timeout if not.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.state = "closed"
+        self._lock = threading.Lock()
+        circuit_state.set(CIRCUIT_STATES["closed"])
+
+    def _set_state(self, state):
+        self.state = state
+        circuit_state.set(CIRCUIT_STATES[state])
+
+    def before_request(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+
+            retry_after = self.opened_at + self.reset_timeout - time.monotonic()
+            if self.state == "open" and retry_after <= 0:
+                self._set_state("half_open")
+                return
+
+            raise CircuitOpenError(max(retry_after, 0.1))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != "closed":
+                self._set_state("closed")
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state("open")
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        model_connections.inc()
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        model_connections.inc()
+        return super()._new_conn()
+
+
+# Counts the connections opened by its connection pools
+class _CountingHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+# ModelClient class sends requests to the model service over a single
+# long-lived session, whose keep-alive connections are pooled, up to
+# pool_size, and reused by all requests and threads.
+#
+# Requests are retried on connection errors and on the given statuses,
+# up to total_retries times with exponential backoff, but not on read
+# timeouts, so that the timeout of a request bounds how long it waits.
+# Retries are only started within retry_deadline seconds of the first
+# attempt, so that a request takes at most retry_deadline plus one
+# timeout. Every attempt is recorded by the circuit breaker, so that a
+# burst of failing attempts opens the circuit.
+class ModelClient:
+    def __init__(
+        self,
+        base_url,
+        pool_size=10,
+        total_retries=3,
+        backoff_factor=0.5,
+        retry_deadline=5,
+        statuses=(500, 502, 503, 504, 429),
+        breaker=None,
+    ):
+        self.base_url = base_url
+        self.total_retries = total_retries
+        self.backoff_factor = backoff_factor
+        self.retry_deadline = retry_deadline
+        self.statuses = frozenset(statuses)
+        self.breaker = breaker or CircuitBreaker()
+
+        adapter = _CountingHTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    # Raises CircuitOpenError without sending the request while the
+    # circuit is open. Responses of any status count as successes of
+    # the model service except 5xx.
+    def _send(self, path, data, timeout):
+        try:
+            self.breaker.before_request()
+        except CircuitOpenError:
+            model_requests.labels("rejected").inc()
+            raise
+
+        try:
+            response = self.session.post(f"{self.base_url}{path}", data=data, timeout=timeout)
+        except requests.RequestException:
+            model_requests.labels("failed").inc()
+            self.breaker.record_failure()
+            raise
+
+        if response.status_code >= 500:
+            model_requests.labels("failed").inc()
+            self.breaker.record_failure()
+        else:
+            model_requests.labels("success" if response.ok else "error").inc()
+            self.breaker.record_success()
+        return response
+
+    # Waits before the next attempt. Returns False without waiting if the
+    # attempt would start after the deadline.
+    def _back_off(self, attempt, deadline):
+        if attempt >= self.total_retries:
+            return False
+
+        delay = self.backoff_factor * 2 ** attempt
+        if time.monotonic() + delay > deadline:
+            return False
+        time.sleep(delay)
+        return True
+
+    # Returns the response of the last attempt, which may have one of the
+    # retried statuses, or raises the error of the last attempt.
+    def post(self, path, data, timeout=None):
+        deadline = time.monotonic() + self.retry_deadline
+        attempt = 0
+        while True:
+            try:
+                response = self._send(path, data, timeout)
+            except requests.ConnectionError:
+                if not self._back_off(attempt, deadline):
+                    raise
+            else:
+                if response.status_code not in self.statuses or not self._back_off(attempt, deadline):
+                    return response
+            attempt += 1
@@ -0,0 +1,55 @@
+import hashlib
+import json
+
+from prometheus_client import Counter
+
+from common.cache import TieredCache
+from common.constants import SnippetEvent, UserEvent, USER_TEXT_FEATURES
+
+prediction_cache_requests = Counter(
+    "spam_classifier_prediction_cache_requests_total",
+    "Number of prediction cache lookups",
+    ["type", "result"],
+)
+
+# Fields each model reads, per event type. User creations and renames
+# are predicted by the same model, so they share their predictions.
+CACHE_FEATURES = {
+    UserEvent.USER_CREATE.value: ("user", USER_TEXT_FEATURES),
+    UserEvent.USER_RENAME.value: ("user", USER_TEXT_FEATURES),
+    SnippetEvent.SNIPPET_CHECK.value: ("snippet", ("title", "description", "file_name")),
+}
+
+
+# PredictionCache class caches predictions by the content the model
+# reads, so that events repeating the bio, name or snippet of an earlier
+# event, like spam waves or renames of unchanged profiles, are not sent
+# to the model service again. Keys hash the model's input fields, with
+# missing fields normalised to null, together with the model version,
+# so that a new model version never answers with predictions of the
+# previous one. Lookups are counted per event type and per tier.
+class PredictionCache:
+    def __init__(self, redis_client=None, max_size=10000, ttl=3600):
+        self.cache = TieredCache(
+            "classification_predictions",
+            redis_client=redis_client,
+            max_size=max_size,
+            ttl=ttl,
+        )
+
+    # Returns None for event types without a model or without a version
+    def key(self, event_type, data, model_version):
+        if event_type not in CACHE_FEATURES or model_version is None:
+            return None
+
+        model, features = CACHE_FEATURES[event_type]
+        content = json.dumps([data.get(feature) for feature in features], separators=(",", ":"))
+        return f"{model_version}:{model}:{hashlib.sha256(content.encode('utf-8')).hexdigest()}"
+
+    def get(self, event_type, key):
+        prediction, tier = self.cache.get_with_tier(key)
+        prediction_cache_requests.labels(event_type, f"{tier}_hit" if tier else "miss").inc()
+        return prediction
+
+    def set(self, key, prediction, score):
+        self.cache.set(key, {"prediction": prediction, "score": score})
@@ -0,0 +1,86 @@
+import json
+import threading
+
+from prometheus_client import Counter, Gauge
+
+from common.constants import IssueEvent, IssueNoteEvent, SnippetEvent, UserEvent
+
+route_events = Counter(
+    "spam_classifier_route_events_total",
+    "Number of events per event type and routing outcome",
+    ["type", "outcome"],
+)
+route_in_flight = Gauge(
+    "spam_classifier_route_in_flight",
+    "Number of model requests in flight per route",
+    ["route"],
+    multiprocess_mode="livesum",
+)
+
+
+# Local classifiers of the classification service routes can name
+LOCAL_CLASSIFIERS = ("rules",)
+
+
+# Route class tells how events of one type are classified: by a model
+# service endpoint, or by one of the LOCAL_CLASSIFIERS. Requests
+# of a route are limited to max_concurrency at a time, and each waits
+# up to timeout seconds for the model service.
+class Route:
+    def __init__(self, name, endpoint=None, local=None, timeout=10, max_concurrency=4, batch=True):
+        if (endpoint is None) == (local is None):
+            raise ValueError(f"Route {name} needs either an endpoint or a local classifier")
+        if local is not None and local not in LOCAL_CLASSIFIERS:
+            raise ValueError(
+                f"Route {name} has unknown local classifier {local}, expected one of {', '.join(LOCAL_CLASSIFIERS)}"
+            )
+
+        self.name = name
+        self.endpoint = endpoint
+        self.local = local
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        # Whether the model service predicts the event type on /predict_batch
+        self.batch = batch
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    # Waits for a free slot of the route while a request is made
+    def __enter__(self):
+        self._slots.acquire()
+        route_in_flight.labels(self.name).inc()
+        return self
+
+    def __exit__(self, *exc):
+        route_in_flight.labels(self.name).dec()
+        self._slots.release()
+
+
+# Event types the model service has endpoints for. Issues and notes are
+# only checked by the rules, and other event types are not classified.
+DEFAULT_ROUTES = {
+    **{e.value: {"endpoint": f"/predict_{e.value}"} for e in UserEvent},
+    **{e.value: {"endpoint": f"/predict_{e.value}"} for e in SnippetEvent},
+    **{e.value: {"local": "rules"} for e in IssueEvent},
+    **{e.value: {"local": "rules"} for e in IssueNoteEvent},
+}
+
+
+# Builds the routing table from the default routes and a JSON object of
+# overrides, e.g.
+#
+#   {"issue_open": {"endpoint": "/predict_issue", "timeout": 2,
+#    "max_concurrency": 2, "batch": false}, "snippet_check": null}
+#
+# where null removes the route of an event type.
+def load_routes(overrides=None, timeout=10, max_concurrency=4):
+    settings = dict(DEFAULT_ROUTES)
+    settings.update(json.loads(overrides) if overrides else {})
+
+    return {
+        event_type: Route(
+            event_type,
+            **{"timeout": timeout, "max_concurrency": max_concurrency, **route},
+        )
+        for event_type, route in settings.items()
+        if route is not None
+    }
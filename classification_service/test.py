@@ -1,14 +1,24 @@
 import unittest
+from datetime import date
 from unittest.mock import patch, MagicMock
 from classification_service.main import GitlabUserSpamClassifier
+from classification_service.model_client import CircuitBreaker, CircuitOpenError, ModelClient
+from classification_service.local_model import InProcessModel, ProcessPoolModel
+from classification_service.routing import load_routes
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from models.test import HAS_ONNX, user, write_version
 import json
+import os
+import tempfile
+import time
 import fakeredis
-from common.constants import UserEvent
+import requests
+from common.constants import IssueEvent, ProjectEvent, UserEvent
 
 
 class TestGitlabUserSpamClassifier(unittest.TestCase):
-    @patch("classification_service.main.GitlabUserSpamClassifier.retry", autospec=True)
-    def test_run_with_data_in_queue(self, mock_retry):
+    @patch("classification_service.main.ModelClient")
+    def test_run_with_data_in_queue(self, mock_model_client):
         redis_conn = fakeredis.FakeRedis()
 
         redis_conn.xadd(
@@ -16,27 +26,24 @@ class TestGitlabUserSpamClassifier(unittest.TestCase):
             {UserEvent.USER_CREATE.value: json.dumps({"username": "test_user", "some_data": "data"})},
         )
 
-        mock_session = MagicMock()
+        mock_client = mock_model_client.return_value
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.json.return_value = {"prediction": 1, "score": 0.9}
-        mock_session.post.return_value = mock_response
-
-        # Configure the retry context manager to use the mock session
-        mock_retry.return_value.__enter__.return_value = mock_session
+        mock_client.post.return_value = mock_response
 
         classifier = GitlabUserSpamClassifier(
             redis_conn=redis_conn, model_url="http://test-model-url"
         )
         classifier.run(testing=True)
 
-        expected_url = "http://test-model-url/predict_user_create"
+        expected_path = "/predict_user_create"
         expected_data = json.dumps({"username": "test_user", "some_data": "data"})
 
-        mock_session.post.assert_called_once_with(
-            expected_url,
+        mock_client.post.assert_called_once_with(
+            expected_path,
             data=expected_data,
-            headers={"Content-Type": "application/json"},
+            timeout=10.0,
         )
 
         messages = redis_conn.xread({"retrieval": '0'}, block=1000, count=1)
@@ -56,6 +63,382 @@ class TestGitlabUserSpamClassifier(unittest.TestCase):
                     self.assertEqual(decoded_key, expected_key)
                     self.assertEqual(decoded_value, expected_value)
 
+    @patch("classification_service.main.ModelClient")
+    def test_events_are_classified_in_batches(self, mock_model_client):
+        redis_conn = fakeredis.FakeRedis()
+
+        for username in ["user1", "user2", "user3"]:
+            redis_conn.xadd("retrieval", {UserEvent.USER_CREATE.value: json.dumps({"username": username})})
+
+        mock_client = mock_model_client.return_value
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {
+            "predictions": [
+                {"prediction": 1, "score": 0.9, "model_version": "v2"},
+                {"prediction": 0, "score": 0.1, "model_version": "v2"},
+                {"prediction": 0, "score": 0.2, "model_version": "v2"},
+            ]
+        }
+        mock_client.post.return_value = mock_response
+
+        classifier = GitlabUserSpamClassifier(
+            redis_conn=redis_conn, model_url="http://test-model-url", batch_size=3
+        )
+        classifier.run(testing=True)
+
+        mock_client.post.assert_called_once_with(
+            "/predict_batch",
+            data=json.dumps({
+                "event_type": UserEvent.USER_CREATE.value,
+                "records": [{"username": "user1"}, {"username": "user2"}, {"username": "user3"}],
+            }),
+            timeout=10.0,
+        )
+
+        results = [json.loads(message[b"user_create"]) for _, message in redis_conn.xrange("classification")]
+        self.assertEqual(
+            [(result["event_data"]["username"], result["prediction"], result["model_version"]) for result in results],
+            [("user1", 1, "v2"), ("user2", 0, "v2"), ("user3", 0, "v2")],
+        )
+        self.assertEqual(redis_conn.xlen("retrieval"), 0)
+
+    @patch("classification_service.main.ModelClient")
+    def test_batches_fall_back_to_single_predictions(self, mock_model_client):
+        redis_conn = fakeredis.FakeRedis()
+
+        for username in ["user1", "user2"]:
+            redis_conn.xadd("retrieval", {UserEvent.USER_CREATE.value: json.dumps({"username": username})})
+
+        not_found = MagicMock(status_code=404)
+        prediction = MagicMock(status_code=200)
+        prediction.json.return_value = {"prediction": 0, "score": 0.1}
+        mock_client = mock_model_client.return_value
+        mock_client.post.side_effect = [not_found, prediction, prediction]
+
+        classifier = GitlabUserSpamClassifier(
+            redis_conn=redis_conn, model_url="http://test-model-url", batch_size=10
+        )
+        classifier.run(testing=True)
+
+        self.assertEqual(
+            [call.args[0] for call in mock_client.post.call_args_list],
+            [
+                "/predict_batch",
+                "/predict_user_create",
+                "/predict_user_create",
+            ],
+        )
+        self.assertFalse(classifier.batch_endpoint_available)
+        self.assertEqual(redis_conn.xlen("classification"), 2)
+
+    @patch("classification_service.main.ModelClient")
+    def test_repeated_content_is_answered_from_cache(self, mock_model_client):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_client = mock_model_client.return_value
+        mock_client.post.return_value.status_code = 200
+        mock_client.post.return_value.json.return_value = {"prediction": 1, "score": 0.9, "model_version": "v1"}
+
+        classifier = GitlabUserSpamClassifier(redis_conn=redis_conn, model_url="http://test-model-url")
+
+        # Same profile content for different users, then a new model version
+        classifier.process_event(UserEvent.USER_CREATE.value, {"id": 1, "username": "spam", "bio": "buy now"})
+        classifier.process_event(UserEvent.USER_RENAME.value, {"id": 2, "username": "spam", "bio": "buy now"})
+        self.assertEqual(mock_client.post.call_count, 1)
+
+        classifier.process_event(UserEvent.USER_CREATE.value, {"id": 3, "username": "other", "bio": "buy now"})
+        self.assertEqual(mock_client.post.call_count, 2)
+
+        mock_client.post.return_value.json.return_value = {"prediction": 0, "score": 0.1, "model_version": "v2"}
+        classifier.process_event(UserEvent.USER_CREATE.value, {"id": 4, "username": "new", "bio": ""})
+        classifier.process_event(UserEvent.USER_CREATE.value, {"id": 5, "username": "spam", "bio": "buy now"})
+        self.assertEqual(mock_client.post.call_count, 4)
+
+        results = [json.loads(value) for _, message in redis_conn.xrange("classification") for value in message.values()]
+        self.assertEqual([result["event_data"]["id"] for result in results], [1, 2, 3, 4, 5])
+        self.assertEqual([result["model_version"] for result in results], ["v1", "v1", "v1", "v2", "v2"])
+
+    @patch("classification_service.main.ModelClient")
+    def test_clear_cut_users_are_decided_by_rules(self, mock_model_client):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_client = mock_model_client.return_value
+        mock_client.post.return_value.status_code = 200
+        mock_client.post.return_value.json.return_value = {"prediction": 0, "score": 0.3, "model_version": "v1"}
+
+        classifier = GitlabUserSpamClassifier(redis_conn=redis_conn, model_url="http://test-model-url", cascade="on")
+
+        # Users as retrieved from GitLab, which always sets avatar_url
+        def user(user_id, username, **attributes):
+            return {
+                "id": user_id,
+                "username": username,
+                "name": username.title(),
+                "state": "active",
+                "web_url": f"https://gitlab.com/{username}",
+                "avatar_url": f"https://secure.gravatar.com/avatar/{user_id}?s=80&d=identicon",
+                "website_url": "",
+                "bio": "",
+                "created_at": date.today().isoformat() + "T00:00:00.000Z",
+                "last_activity_on": date.today().isoformat(),
+                **attributes,
+            }
+
+        links = " ".join(f"https://example.com/{i}" for i in range(5))
+        classifier.process_event(UserEvent.USER_CREATE.value, user(1, "spam", bio=links))
+        classifier.process_event(
+            UserEvent.USER_RENAME.value,
+            user(2, "old", website_url="https://old.example.com", created_at="2015-01-01T00:00:00.000Z"),
+        )
+        classifier.process_event(UserEvent.USER_CREATE.value, user(3, "new", bio="https://example.com"))
+
+        mock_client.post.assert_called_once()
+        results = [json.loads(value) for _, message in redis_conn.xrange("classification") for value in message.values()]
+        self.assertEqual(
+            [(result["prediction"], result["model_version"]) for result in results],
+            [(1, "rules"), (0, "rules"), (0, "v1")],
+        )
+
+    @patch("classification_service.cascade.cascade_shadow")
+    @patch("classification_service.main.ModelClient")
+    def test_rules_only_count_their_decisions_in_shadow_mode(self, mock_model_client, mock_shadow):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_client = mock_model_client.return_value
+        mock_client.post.return_value.status_code = 200
+        mock_client.post.return_value.json.return_value = {"prediction": 0, "score": 0.3, "model_version": "v1"}
+
+        classifier = GitlabUserSpamClassifier(redis_conn=redis_conn, model_url="http://test-model-url", cache_size=0)
+
+        links = " ".join(f"https://example.com/{i}" for i in range(5))
+        classifier.process_event(UserEvent.USER_CREATE.value, {"id": 1, "username": "spam", "bio": links})
+        classifier.process_event(UserEvent.USER_CREATE.value, {"id": 2, "username": "new", "bio": ""})
+
+        self.assertEqual(mock_client.post.call_count, 2)
+        results = [json.loads(value) for _, message in redis_conn.xrange("classification") for value in message.values()]
+        self.assertEqual([result["model_version"] for result in results], ["v1", "v1"])
+        mock_shadow.labels.assert_called_once_with(UserEvent.USER_CREATE.value, "rules_spam", "disagree")
+
+    @patch("classification_service.main.ModelClient")
+    def test_events_without_model_are_routed_or_skipped(self, mock_model_client):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_client = mock_model_client.return_value
+        mock_client.post.return_value.status_code = 500
+
+        classifier = GitlabUserSpamClassifier(redis_conn=redis_conn, model_url="http://test-model-url")
+
+        links = " ".join(f"https://example.com/{i}" for i in range(5))
+        classifier.process_event(ProjectEvent.PROJECT_CREATE.value, {"id": 1, "name": "project"})
+        classifier.process_event(IssueEvent.ISSUE_OPEN.value, {"id": 2, "title": "offer", "description": links})
+        classifier.process_event(IssueEvent.ISSUE_OPEN.value, {"id": 3, "title": "bug", "description": "crash"})
+        classifier.process_event(UserEvent.USER_CREATE.value, {"id": 4, "username": "user"})
+
+        mock_client.post.assert_called_once()
+        self.assertEqual(mock_client.post.call_args.args[0], "/predict_user_create")
+
+        results = [json.loads(value) for _, message in redis_conn.xrange("classification") for value in message.values()]
+        self.assertEqual([(result["event_data"]["id"], result["prediction"]) for result in results], [(2, 1)])
+
+    def test_routes_to_unknown_local_classifiers_are_rejected(self):
+        routes = load_routes(json.dumps({IssueEvent.ISSUE_OPEN.value: {"local": "rules", "timeout": 2}}))
+        self.assertEqual(routes[IssueEvent.ISSUE_OPEN.value].timeout, 2)
+
+        with self.assertRaises(ValueError):
+            load_routes(json.dumps({IssueEvent.ISSUE_OPEN.value: {"local": "rule"}}))
+
+    @patch("classification_service.main.ModelClient")
+    def test_events_of_failed_batches_are_dead_lettered(self, mock_model_client):
+        redis_conn = fakeredis.FakeRedis()
+
+        for username in ["user1", "user2"]:
+            redis_conn.xadd("retrieval", {UserEvent.USER_CREATE.value: json.dumps({"username": username})})
+
+        classifier = GitlabUserSpamClassifier(redis_conn=redis_conn, model_url="http://test-model-url", batch_size=2)
+        with patch.object(classifier, "_publish_local_prediction", side_effect=RuntimeError("broken")):
+            classifier.run(testing=True)
+
+        self.assertEqual(redis_conn.xlen("retrieval"), 0)
+        failed = [json.loads(message[b"user_create"]) for _, message in redis_conn.xrange("classification:dead_letter")]
+        self.assertEqual([f["event_data"]["username"] for f in failed], ["user1", "user2"])
+        self.assertEqual({f["outcome"] for f in failed}, {"error"})
+
+    @patch("classification_service.main.ModelClient")
+    def test_batches_are_predicted_by_local_model(self, mock_model_client):
+        redis_conn = fakeredis.FakeRedis()
+
+        for username in ["user1", "user2", "user3"]:
+            redis_conn.xadd("retrieval", {UserEvent.USER_CREATE.value: json.dumps({"username": username})})
+
+        local_model = MagicMock()
+        local_model.supports.return_value = True
+        local_model.predict.return_value = [
+            {"prediction": 1, "score": 0.9, "model_version": "v1"},
+            {"prediction": 0, "score": 0.1, "model_version": "v1"},
+            {"prediction": 0, "score": 0.2, "model_version": "v1"},
+        ]
+
+        classifier = GitlabUserSpamClassifier(
+            redis_conn=redis_conn, model_url="http://test-model-url", batch_size=3, local_model=local_model
+        )
+        classifier.run(testing=True)
+
+        mock_model_client.return_value.post.assert_not_called()
+        local_model.predict.assert_called_once_with(
+            UserEvent.USER_CREATE.value,
+            [{"username": "user1"}, {"username": "user2"}, {"username": "user3"}],
+            timeout=10.0,
+        )
+        results = [json.loads(message[b"user_create"]) for _, message in redis_conn.xrange("classification")]
+        self.assertEqual([result["prediction"] for result in results], [1, 0, 0])
+
+    @patch("classification_service.main.time.sleep")
+    @patch("classification_service.main.ModelClient")
+    def test_events_wait_while_circuit_is_open(self, mock_model_client, mock_sleep):
+        redis_conn = fakeredis.FakeRedis()
+
+        prediction = MagicMock(status_code=200)
+        prediction.json.return_value = {"prediction": 0, "score": 0.1}
+        mock_client = mock_model_client.return_value
+        mock_client.post.side_effect = [requests.ConnectionError(), CircuitOpenError(5), prediction]
+
+        classifier = GitlabUserSpamClassifier(redis_conn=redis_conn, model_url="http://test-model-url")
+        classifier.process_event(UserEvent.USER_CREATE.value, {"username": "user"})
+
+        self.assertEqual(mock_client.post.call_count, 3)
+        mock_sleep.assert_called_once_with(5)
+        self.assertEqual(redis_conn.xlen("classification"), 1)
+
+    @patch("classification_service.main.ModelClient")
+    def test_events_the_model_keeps_failing_are_dead_lettered(self, mock_model_client):
+        redis_conn = fakeredis.FakeRedis()
+
+        redis_conn.xadd("retrieval", {UserEvent.USER_CREATE.value: json.dumps({"username": "rejected"})})
+        redis_conn.xadd("retrieval", {UserEvent.USER_CREATE.value: json.dumps({"username": "timed_out"})})
+
+        # Status retries of the model client are exhausted, then a timeout
+        mock_client = mock_model_client.return_value
+        mock_client.post.side_effect = [MagicMock(status_code=503, text="Service unavailable"), requests.ReadTimeout()]
+
+        classifier = GitlabUserSpamClassifier(redis_conn=redis_conn, model_url="http://test-model-url")
+        classifier.run(testing=True)
+        classifier.run(testing=True)
+
+        self.assertEqual(mock_client.post.call_count, 2)
+        self.assertEqual(redis_conn.xlen("retrieval"), 0)
+        self.assertEqual(redis_conn.xlen("classification"), 0)
+
+        failed = [json.loads(message[b"user_create"]) for _, message in redis_conn.xrange("classification:dead_letter")]
+        self.assertEqual([f["event_data"]["username"] for f in failed], ["rejected", "timed_out"])
+        self.assertEqual([f["outcome"] for f in failed], ["error", "timeout"])
+
+    @patch("classification_service.main.CLASSIFICATION_MODEL_UNREACHABLE_SECONDS", 4)
+    @patch("classification_service.main.time.sleep")
+    @patch("classification_service.main.ModelClient")
+    def test_events_stop_waiting_for_unreachable_model(self, mock_model_client, mock_sleep):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_client = mock_model_client.return_value
+        mock_client.post.side_effect = [requests.ConnectionError(), CircuitOpenError(5)]
+
+        classifier = GitlabUserSpamClassifier(redis_conn=redis_conn, model_url="http://test-model-url")
+        classifier.process_event(UserEvent.USER_CREATE.value, {"username": "user"})
+
+        mock_sleep.assert_not_called()
+        failed = [json.loads(message[b"user_create"]) for _, message in redis_conn.xrange("classification:dead_letter")]
+        self.assertEqual([f["outcome"] for f in failed], ["unreachable"])
+
+
+@patch("classification_service.model_client.time.sleep")
+class TestModelClient(unittest.TestCase):
+    def response(self, status_code):
+        return MagicMock(status_code=status_code, ok=status_code < 400)
+
+    def test_retried_statuses_are_retried(self, mock_sleep):
+        client = ModelClient("http://model", backoff_factor=1)
+        client.session.post = MagicMock(side_effect=[self.response(503), self.response(200)])
+
+        self.assertEqual(client.post("/predict_batch", "{}").status_code, 200)
+        mock_sleep.assert_called_once_with(1)
+        self.assertEqual(client.breaker.failures, 0)
+
+    def test_every_attempt_is_recorded_by_the_breaker(self, mock_sleep):
+        client = ModelClient("http://model", total_retries=5, breaker=CircuitBreaker(failure_threshold=2))
+        client.session.post = MagicMock(side_effect=requests.ConnectionError())
+
+        with self.assertRaises(CircuitOpenError):
+            client.post("/predict_batch", "{}")
+        self.assertEqual(client.session.post.call_count, 2)
+
+    def test_no_retry_is_started_after_the_deadline(self, mock_sleep):
+        client = ModelClient("http://model", total_retries=5, backoff_factor=1, retry_deadline=1.5)
+        client.session.post = MagicMock(return_value=self.response(502))
+
+        self.assertEqual(client.post("/predict_batch", "{}").status_code, 502)
+        mock_sleep.assert_called_once_with(1)
+        self.assertEqual(client.session.post.call_count, 2)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_circuit_opens_after_failures_and_closes_after_trial(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+        breaker.record_failure()
+        breaker.before_request()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+
+        # Only one trial request once the reset timeout has passed
+        breaker.opened_at -= 60
+        breaker.before_request()
+        self.assertEqual(breaker.state, "half_open")
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+        breaker.before_request()
+
+
+@unittest.skipUnless(HAS_ONNX, "onnx, onnxruntime and scikit-learn are required")
+class TestLocalModel(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.models_dir = self.temp_dir.name
+        write_version(os.path.join(self.models_dir, "users", "versions"), "v1")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_in_process_model_predicts_with_latest_version(self):
+        model = InProcessModel(self.models_dir, "onnx")
+
+        predictions = model.predict(UserEvent.USER_CREATE.value, [user(), user("x" * 10)], timeout=5)
+
+        self.assertEqual([p["prediction"] for p in predictions], [0, 1])
+        self.assertEqual({p["model_version"] for p in predictions}, {"v1"})
+
+    def test_in_process_model_stops_waiting_after_timeout(self):
+        model = InProcessModel(self.models_dir, "onnx")
+        model.registry.active = MagicMock()
+        model.registry.active.predict_records.side_effect = lambda records: time.sleep(1)
+
+        with self.assertRaises(FuturesTimeoutError):
+            model.predict(UserEvent.USER_CREATE.value, [user()], timeout=0.05)
+
+    def test_process_pool_model_predicts_in_workers(self):
+        model = ProcessPoolModel(self.models_dir, "onnx", processes=1)
+        self.addCleanup(model.executor.shutdown)
+
+        predictions = model.predict(UserEvent.USER_CREATE.value, [user("x" * 10)], timeout=60)
+
+        self.assertEqual(predictions[0]["prediction"], 1)
+        self.assertEqual(predictions[0]["model_version"], "v1")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,131 @@
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+
+# Bloom filters are serialised as a 24 byte header followed by the bit
+# array, most significant bit first. The header holds the version of the
+# verified users sets the filter was built from, so that readers can
+# tell whether the filter is older than the sets.
+HEADER = struct.Struct(">4sQIQ")
+MAGIC = b"SPBF"
+
+
+def bloom_parameters(capacity, error_rate):
+    capacity = max(int(capacity), 1)
+    size = math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+    hash_count = max(1, round(size / capacity * math.log(2)))
+    return size, hash_count
+
+
+# Bit positions of an item, from double hashing of a single digest.
+# Positions are generated lazily, so lookups stop at the first unset bit.
+def bloom_positions(item, size, hash_count):
+    digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+    first, second = struct.unpack(">QQ", digest)
+    return ((first + i * second) % size for i in range(hash_count))
+
+
+# BloomFilter class builds a Bloom filter in memory, to be written to a
+# file for MmapBloomFilter. version is the version of the sets it is
+# built from.
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001, version=0):
+        self.size, self.hash_count = bloom_parameters(capacity, error_rate)
+        self.version = version
+        self.bits = bytearray(math.ceil(self.size / 8))
+
+    def add(self, item):
+        for position in bloom_positions(item, self.size, self.hash_count):
+            self.bits[position >> 3] |= 0x80 >> (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (0x80 >> (position & 7))
+            for position in bloom_positions(item, self.size, self.hash_count)
+        )
+
+    def to_bytes(self):
+        return HEADER.pack(MAGIC, self.size, self.hash_count, self.version) + bytes(self.bits)
+
+    # Writes the filter atomically, so that readers never see a partial file.
+    def write_file(self, path):
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(self.to_bytes())
+        os.replace(temporary_path, path)
+
+
+def _parse_header(header):
+    magic, size, hash_count, version = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("Not a Bloom filter")
+    return size, hash_count, version
+
+
+# MmapBloomFilter class queries a Bloom filter file through a read-only
+# memory map. Pages are shared between processes through the page cache,
+# so memory use does not grow with the number of replicas on a node.
+# The file is checked for a replacement at most every check_interval
+# seconds, like the verified lists files, and reopened when it has been
+# replaced. The parameters and version are read from the header of the
+# same map as the bits.
+class MmapBloomFilter:
+    def __init__(self, path, check_interval=10):
+        self.path = path
+        self.check_interval = check_interval
+        self.version = None
+        self._map = None
+        self._stat = None
+        self._last_checked = None
+
+    def _open(self):
+        now = time.monotonic()
+        if self._last_checked is not None and now - self._last_checked < self.check_interval:
+            return self._map
+        self._last_checked = now
+
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return self._map
+
+        if self._stat is not None and (stat.st_ino, stat.st_mtime_ns) == self._stat:
+            return self._map
+
+        try:
+            with open(self.path, "rb") as file:
+                new_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size, self.hash_count, self.version = _parse_header(new_map[:HEADER.size])
+        except (OSError, ValueError, struct.error) as e:
+            logging.warning(f"Unable to open Bloom filter {self.path}: {e}")
+            return self._map
+
+        if self._map is not None:
+            self._map.close()
+        self._map = new_map
+        self._stat = (stat.st_ino, stat.st_mtime_ns)
+        return self._map
+
+    # Returns None if no filter is available, so that callers fall back
+    # to the authoritative store.
+    def might_contain(self, item):
+        bits = self._open()
+        if bits is None:
+            return None
+
+        for position in bloom_positions(item, self.size, self.hash_count):
+            if not bits[HEADER.size + (position >> 3)] & (0x80 >> (position & 7)):
+                return False
+        return True
+
+
+# Returns a Bloom filter reader for the configured backend, "file", or
+# None if no Bloom filter is configured.
+def bloom_filter_reader(backend, location):
+    if backend == "file":
+        return MmapBloomFilter(location)
+    return None
@@ -0,0 +1,175 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+
+# LRUCache class is a small thread-safe in-process cache. Entries are
+# evicted in least-recently-used order once max_size is reached and
+# expire after ttl seconds.
+class LRUCache:
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# TieredCache class is a local LRUCache fronting a Redis cache that is
+# shared by all replicas of a service. Values must be JSON serialisable.
+# Invalidations are published on a Redis pub/sub channel so that every
+# replica drops its local copy as well, and on_invalidate is called with
+# the invalidated key, or None for the whole namespace.
+class TieredCache:
+    def __init__(
+        self,
+        namespace,
+        redis_client=None,
+        max_size=1024,
+        ttl=300,
+        invalidation_channel="spamphibian_cache_invalidation",
+        on_invalidate=None,
+    ):
+        self.namespace = namespace
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.invalidation_channel = invalidation_channel
+        self.on_invalidate = on_invalidate
+        self.local = LRUCache(max_size=max_size, ttl=ttl)
+        self._listener = None
+
+    def _redis_key(self, key):
+        return f"cache:{self.namespace}:{key}"
+
+    def get(self, key):
+        value, _ = self.get_with_tier(key)
+        return value
+
+    # Returns the cached value together with the tier it was found in
+    # ("local" or "redis"), or (None, None) on a miss.
+    def get_with_tier(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value, "local"
+
+        if self.redis_client is None:
+            return None, None
+
+        try:
+            serialised = self.redis_client.get(self._redis_key(key))
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Error reading {self.namespace} cache from Redis: {e}")
+            return None, None
+
+        if serialised is None:
+            return None, None
+
+        value = json.loads(serialised)
+        self.local.set(key, value)
+        return value, "redis"
+
+    # Values expire after ttl seconds if given, or after the ttl of the
+    # cache otherwise.
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.local.set(key, value, ttl=ttl)
+
+        if self.redis_client is None:
+            return
+
+        try:
+            self.redis_client.set(self._redis_key(key), json.dumps(value), ex=ttl)
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Error writing {self.namespace} cache to Redis: {e}")
+
+    # Drops a single key, or the whole namespace if no key is given,
+    # from Redis and from the local cache of every replica.
+    def invalidate(self, key=None):
+        if key is None:
+            self.local.clear()
+        else:
+            self.local.delete(key)
+
+        if self.redis_client is None:
+            return
+
+        try:
+            if key is None:
+                for redis_key in self.redis_client.scan_iter(match=self._redis_key("*")):
+                    self.redis_client.delete(redis_key)
+            else:
+                self.redis_client.delete(self._redis_key(key))
+
+            self.redis_client.publish(
+                self.invalidation_channel,
+                json.dumps({"namespace": self.namespace, "key": key}),
+            )
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Error invalidating {self.namespace} cache in Redis: {e}")
+
+    def _handle_invalidation(self, message):
+        try:
+            payload = json.loads(message["data"])
+        except (TypeError, ValueError):
+            return
+
+        if payload.get("namespace") != self.namespace:
+            return
+
+        if payload.get("key") is None:
+            self.local.clear()
+        else:
+            self.local.delete(payload["key"])
+
+        if self.on_invalidate is not None:
+            self.on_invalidate(payload.get("key"))
+
+    # Subscribes to the invalidation channel in a background thread.
+    def start_invalidation_listener(self):
+        if self.redis_client is None or self._listener is not None:
+            return
+
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.invalidation_channel: self._handle_invalidation})
+        self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop_invalidation_listener(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
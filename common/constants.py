@@ -30,3 +30,39 @@ class GroupEvent(Enum):
 
 class SnippetEvent(Enum):
     SNIPPET_CHECK = "snippet_check"
+
+# Redis keys of the verified users sets maintained by the
+# verified users retriever job and read by the verification service.
+VERIFIED_GROUP_MEMBERS_KEY = "verified_users:group_members"
+VERIFIED_ESTABLISHED_USERS_KEY = "verified_users:established"
+VERIFIED_USERS_KEYS = (VERIFIED_GROUP_MEMBERS_KEY, VERIFIED_ESTABLISHED_USERS_KEY)
+# Incremented by the job whenever the sets change
+VERIFIED_USERS_VERSION_KEY = "verified_users:version"
+
+# Attributes of GitLab objects read by the classification model, the
+# classification rules and the notification service. Dotted names are
+# attributes of nested objects.
+USER_TEXT_FEATURES = (
+    "username",
+    "name",
+    "bio",
+    "location",
+    "website_url",
+    "public_email",
+    "organization",
+    "skype",
+    "linkedin",
+    "twitter",
+    "job_title",
+    "pronouns",
+    "work_information",
+    "email",
+    "commit_email",
+    "avatar_url",
+)
+USER_FIELDS = ("id", "state", "web_url", "created_at", "last_activity_on") + USER_TEXT_FEATURES
+ISSUE_FIELDS = ("id", "iid", "project_id", "title", "description", "state", "web_url", "author.name")
+ISSUE_NOTE_FIELDS = ("id", "project_id", "issue_iid", "body", "created_at", "author.name", "author.web_url")
+PROJECT_FIELDS = ("id", "name", "namespace.name", "created_at", "web_url")
+GROUP_FIELDS = ("id", "name", "visibility", "created_at", "web_url")
+SNIPPET_FIELDS = ("id", "title", "description", "file_name", "created_at", "web_url", "author.id", "author.name")
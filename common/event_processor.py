@@ -10,6 +10,10 @@ class EventProcessor:
         self.input_stream_name = input_stream_name
         self.output_stream_name = output_stream_name
 
+        # How long to block waiting for new events, in milliseconds.
+        # Child classes can lower it in before_poll().
+        self.poll_block_ms = 10000
+
         if redis_conn:
             self.redis_client = redis_conn
         else:
@@ -102,7 +106,8 @@ class EventProcessor:
     def poll_and_process_event(self, testing=False):
     # TODO: Send heartbeat to Prometheus
         while True:
-            messages = self.redis_client.xread({self.input_stream_name: '0'}, block=10000, count=1)
+            self.before_poll()
+            messages = self.redis_client.xread({self.input_stream_name: '0'}, block=self.poll_block_ms, count=1)
             if not messages:
                 continue
 
@@ -126,6 +131,10 @@ class EventProcessor:
                 if testing:
                     return
 
+    # Called before each read from the input stream
+    def before_poll(self):
+        pass
+
     def process_event(self, event_type, data):
         raise NotImplementedError("Child classes must implement this method")
 
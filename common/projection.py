@@ -0,0 +1,58 @@
+import json
+
+from common.constants import (
+    UserEvent,
+    ProjectEvent,
+    IssueEvent,
+    IssueNoteEvent,
+    GroupEvent,
+    SnippetEvent,
+    USER_FIELDS,
+    ISSUE_FIELDS,
+    ISSUE_NOTE_FIELDS,
+    PROJECT_FIELDS,
+    GROUP_FIELDS,
+    SNIPPET_FIELDS,
+)
+
+# Objects are serialised with a schema version, so that consumers can
+# tell projected objects apart and detect schema changes. Increment it
+# when the fields of an object type change.
+SCHEMA_VERSION_FIELD = "_v"
+SCHEMA_VERSION = 2
+
+# Fields of the object each event is about
+EVENT_FIELDS = {
+    **{e.value: USER_FIELDS for e in UserEvent},
+    **{e.value: ISSUE_FIELDS for e in IssueEvent},
+    **{e.value: ISSUE_NOTE_FIELDS for e in IssueNoteEvent},
+    **{e.value: PROJECT_FIELDS for e in ProjectEvent},
+    **{e.value: GROUP_FIELDS for e in GroupEvent},
+    **{e.value: SNIPPET_FIELDS for e in SnippetEvent},
+}
+
+
+# Returns the given fields of an object. Dotted names are copied into
+# nested dictionaries, and missing fields are None, so that consumers
+# always get the same keys.
+def project_fields(attributes, fields):
+    projected = {}
+    for field in fields:
+        *parents, name = field.split(".")
+        source, target = attributes, projected
+        for parent in parents:
+            source = source.get(parent) if isinstance(source, dict) else None
+            target = target.setdefault(parent, {})
+        target[name] = source.get(name) if isinstance(source, dict) else None
+    return projected
+
+
+# Serialises the fields of an object read by classification and
+# notification. Objects of unknown event types are serialised whole.
+def serialise_object(event_type, attributes):
+    fields = EVENT_FIELDS.get(event_type)
+    if fields is None:
+        return json.dumps(attributes)
+
+    projected = {SCHEMA_VERSION_FIELD: SCHEMA_VERSION, **project_fields(attributes, fields)}
+    return json.dumps(projected, separators=(",", ":"))
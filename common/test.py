@@ -1,8 +1,13 @@
 import unittest
 from common.event_processor import EventProcessor
+from common.cache import TieredCache
+from common.bloom import BloomFilter, MmapBloomFilter
+from common.projection import serialise_object
+import os
+import tempfile
 import fakeredis
 import json
-from common.constants import UserEvent
+from common.constants import UserEvent, IssueEvent
 
 class TestEventProcessor(unittest.TestCase):
 
@@ -40,5 +45,118 @@ class TestEventProcessor(unittest.TestCase):
         with self.assertRaises(NotImplementedError):
             self.event_processor.process_event(None, None)
 
+
+class TestTieredCache(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_conn = fakeredis.FakeRedis()
+        self.cache = TieredCache("test", redis_client=self.redis_conn, max_size=2, ttl=60)
+
+    def test_get_from_redis_tier(self):
+        self.cache.set("a", {"value": 1})
+        self.cache.local.clear()
+
+        self.assertEqual(self.cache.get_with_tier("a"), ({"value": 1}, "redis"))
+        self.assertEqual(self.cache.get_with_tier("a"), ({"value": 1}, "local"))
+
+    def test_local_tier_evicts_least_recently_used(self):
+        for key in ["a", "b", "c"]:
+            self.cache.set(key, key)
+
+        self.assertIsNone(self.cache.local.get("a"))
+        self.assertEqual(self.cache.get("a"), "a")
+
+    def test_invalidate_namespace(self):
+        other = TieredCache("other", redis_client=self.redis_conn)
+        other.set("a", 1)
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+
+        self.cache.invalidate()
+
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(other.get("a"), 1)
+
+    def test_invalidation_message_clears_local_tier(self):
+        self.cache.set("a", 1)
+        self.cache._handle_invalidation({"data": json.dumps({"namespace": "test", "key": "a"})})
+
+        self.assertIsNone(self.cache.local.get("a"))
+
+class TestBloomFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.members = [f"user{i}@example.com" for i in range(500)]
+        self.bloom_filter = BloomFilter(len(self.members), error_rate=0.01)
+        for member in self.members:
+            self.bloom_filter.add(member)
+
+    def assert_reader_matches(self, reader):
+        for member in self.members:
+            self.assertTrue(reader.might_contain(member))
+
+        false_positives = sum(
+            reader.might_contain(f"other{i}@example.com") for i in range(1000)
+        )
+        self.assertLess(false_positives, 50)
+
+    def test_file_reader(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "verified_users.bloom")
+            reader = MmapBloomFilter(path, check_interval=0)
+            self.assertIsNone(reader.might_contain("user0@example.com"))
+
+            self.bloom_filter.write_file(path)
+            self.assert_reader_matches(reader)
+
+    # A rewritten filter of another size is used once the file is
+    # checked again
+    def test_reader_uses_rewritten_filter(self):
+        resized = BloomFilter(len(self.members) * 10, error_rate=0.001, version=2)
+        for member in self.members + ["new@example.com"]:
+            resized.add(member)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "verified_users.bloom")
+            self.bloom_filter.write_file(path)
+            file_reader = MmapBloomFilter(path, check_interval=3600)
+            self.assertTrue(file_reader.might_contain("user0@example.com"))
+            self.assertEqual(file_reader.version, 0)
+
+            resized.write_file(path)
+            self.assertFalse(file_reader.might_contain("new@example.com"))
+
+            file_reader.check_interval = 0
+            self.assertTrue(file_reader.might_contain("new@example.com"))
+            self.assertEqual(file_reader.version, 2)
+            self.assert_reader_matches(file_reader)
+
+class TestProjection(unittest.TestCase):
+    def test_only_read_fields_are_serialised(self):
+        issue = {
+            "id": 301,
+            "iid": 23,
+            "title": "New API",
+            "author": {"id": 51, "name": "Author"},
+            "_links": {"self": "https://gitlab.com/api/v4/projects/14/issues/23"},
+        }
+
+        self.assertEqual(
+            json.loads(serialise_object(IssueEvent.ISSUE_OPEN.value, issue)),
+            {
+                "_v": 2,
+                "id": 301,
+                "iid": 23,
+                "project_id": None,
+                "title": "New API",
+                "description": None,
+                "state": None,
+                "web_url": None,
+                "author": {"name": "Author"},
+            },
+        )
+
+
 if __name__ == '__main__':
     unittest.main()
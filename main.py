@@ -14,6 +14,12 @@ if __name__ == "__main__":
     verification_service = Process(
         target=run_script, args=("verification_service/main.py",)
     )
+    verification_api = Process(
+        target=run_script, args=("verification_service/api.py",)
+    )
+    verified_users_job = Process(
+        target=run_script, args=("verified_users_job/main.py",)
+    )
     retrieval_service = Process(target=run_script, args=("retrieval_service/main.py",))
     classification_service = Process(
         target=run_script, args=("classification_service/main.py",)
@@ -25,6 +31,8 @@ if __name__ == "__main__":
     # Start processes
     event_service.start()
     verification_service.start()
+    verification_api.start()
+    verified_users_job.start()
     retrieval_service.start()
     classification_service.start()
     notification_service.start()
@@ -36,6 +44,8 @@ if __name__ == "__main__":
         # Kill processes on Ctrl+C
         os.kill(event_service.pid, signal.SIGINT)
         os.kill(verification_service.pid, signal.SIGINT)
+        os.kill(verification_api.pid, signal.SIGINT)
+        os.kill(verified_users_job.pid, signal.SIGINT)
         os.kill(retrieval_service.pid, signal.SIGINT)
         os.kill(classification_service.pid, signal.SIGINT)
         os.kill(notification_service.pid, signal.SIGINT)
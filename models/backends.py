@@ -0,0 +1,109 @@
+import threading
+
+import numpy as np
+
+# Model backends run the user classifier with different runtimes. They
+# take the output of the preprocessing pipeline and return scores with
+# shape (n, 1), like Keras' predict(). Runtimes are imported when a
+# backend is loaded, so that TensorFlow is only imported by the Keras
+# backend, or by the TFLite backend if tflite-runtime is not installed.
+
+DEFAULT_MODEL_PATHS = {
+    "keras": "users/keras_model.keras",
+    "onnx": "users/model.onnx",
+    "tflite": "users/model.tflite",
+}
+
+# int8 variants are produced by quantize_model.py. The Keras model is
+# only available as float.
+VARIANTS = ("float", "int8")
+
+
+def model_path(name, variant="float"):
+    if variant not in VARIANTS:
+        raise ValueError(f"Unknown model variant {variant}, expected one of {', '.join(VARIANTS)}")
+    if variant == "float":
+        return DEFAULT_MODEL_PATHS[name]
+    if name == "keras":
+        raise ValueError("The keras backend has no int8 variant, use onnx or tflite")
+
+    root, extension = DEFAULT_MODEL_PATHS[name].rsplit(".", 1)
+    return f"{root}.{variant}.{extension}"
+
+
+def to_float_array(x):
+    if hasattr(x, "toarray"):
+        x = x.toarray()
+    return np.asarray(x, dtype=np.float32)
+
+
+class KerasBackend:
+    def __init__(self, path, threads=None):
+        import tensorflow as tf
+
+        if threads:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+        self.model = tf.keras.models.load_model(path)
+
+    def predict(self, x):
+        return self.model.predict(x, verbose=0)
+
+
+class OnnxBackend:
+    def __init__(self, path, threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, x):
+        return self.session.run(None, {self.input_name: to_float_array(x)})[0]
+
+
+# TFLite interpreters are not thread safe and their input shape is
+# fixed until resized, so calls are serialised.
+class TFLiteBackend:
+    def __init__(self, path, threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+
+            Interpreter = tf.lite.Interpreter
+
+        self.interpreter = Interpreter(model_path=path, num_threads=threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.lock = threading.Lock()
+
+    def predict(self, x):
+        x = to_float_array(x)
+        with self.lock:
+            if tuple(self.input["shape"]) != x.shape:
+                self.interpreter.resize_tensor_input(self.input["index"], x.shape)
+                self.interpreter.allocate_tensors()
+                self.input = self.interpreter.get_input_details()[0]
+                self.output = self.interpreter.get_output_details()[0]
+
+            self.interpreter.set_tensor(self.input["index"], x)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output["index"]).copy()
+
+
+BACKENDS = {
+    "keras": KerasBackend,
+    "onnx": OnnxBackend,
+    "tflite": TFLiteBackend,
+}
+
+
+def load_backend(name, path=None, threads=None, variant="float"):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown model backend {name}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](path or model_path(name, variant), threads=threads)
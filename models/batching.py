@@ -0,0 +1,102 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from prometheus_client import Counter, Gauge, Histogram
+
+queue_depth = Gauge(
+    "model_service_batch_queue_depth",
+    "Number of records waiting to be predicted",
+    multiprocess_mode="livesum",
+)
+batch_size = Histogram(
+    "model_service_batch_size",
+    "Number of records predicted together",
+    buckets=[1, 2, 4, 8, 16, 32, 64, 128],
+)
+batch_fallbacks = Counter(
+    "model_service_batch_fallbacks_total",
+    "Number of failed batches predicted again record by record",
+)
+
+
+# DynamicBatcher class gathers records of concurrent requests into
+# batches, so that they share one preprocessing and one model call. A
+# worker thread takes the first waiting record, waits up to window_ms
+# for more, up to max_batch_size records, and predicts them together.
+# Requests wait for the result of their own record.
+class DynamicBatcher:
+    def __init__(self, predict, max_batch_size=32, window_ms=5):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.window_ms = window_ms
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    # The worker is started by the first request of each process, as
+    # threads do not survive forking.
+    def _ensure_worker(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, record):
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((record, future))
+        queue_depth.inc()
+        return future
+
+    def predict_one(self, record, timeout=None):
+        return self.submit(record).result(timeout)
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        queue_depth.dec(len(batch))
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            batch_size.observe(len(batch))
+
+            try:
+                results = self.predict([record for record, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                else:
+                    self._predict_each(batch)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    # A record failing the model call of a batch would fail the requests
+    # of the other records, so they are predicted one by one and only
+    # the failing records fail.
+    def _predict_each(self, batch):
+        batch_fallbacks.inc()
+        for record, future in batch:
+            try:
+                future.set_result(self.predict([record])[0])
+            except Exception as e:
+                future.set_exception(e)
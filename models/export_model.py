@@ -0,0 +1,127 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from models.backends import DEFAULT_MODEL_PATHS, load_backend, to_float_array
+from models.preprocessing import derive_user_features, load_pipeline
+
+# Exports the Keras user classifier to ONNX or TFLite, for the lighter
+# runtimes of backends.py, and checks that the exported model gives the
+# same scores as the Keras model:
+#
+#   python -m models.export_model --format onnx --samples user_create.jsonl
+#
+# from this directory, with its parent on PYTHONPATH as in the image.
+# The ONNX export needs requirements-export.txt, which the image does
+# not install.
+#
+# Scores are compared on historic user records if a JSON lines file of
+# them is given, or on random inputs otherwise. The export fails if a
+# score differs by more than --tolerance.
+
+
+# Returns the model inputs of the sample records, or random inputs
+def load_inputs(samples_path, pipeline_path, input_size, count=256, seed=0):
+    if samples_path:
+        with open(samples_path, "r") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        pipeline = load_pipeline(pipeline_path)
+        return to_float_array(pipeline.transform(derive_user_features(pd.DataFrame(records))))
+
+    rng = np.random.default_rng(seed)
+    return rng.random((count, input_size), dtype=np.float32)
+
+
+def export_onnx(keras_model, path, opset=13):
+    import tensorflow as tf
+    import tf2onnx
+
+    # The batch dimension is left dynamic
+    input_signature = (tf.TensorSpec((None, keras_model.input_shape[-1]), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(keras_model, input_signature=input_signature, opset=opset, output_path=path)
+
+
+def export_tflite(keras_model, path):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    with open(path, "wb") as f:
+        f.write(converter.convert())
+
+
+def max_score_difference(reference, candidate, inputs):
+    return float(np.max(np.abs(reference.predict(inputs)[:, 0] - candidate.predict(inputs)[:, 0])))
+
+
+# Median time of a predict() call, in milliseconds
+def latency_ms(backend, inputs, batch_size, repeats=50):
+    batch = inputs[:batch_size]
+    backend.predict(batch)
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        backend.predict(batch)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings) * 1000)
+
+
+def size_mb(path):
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(path)
+            for name in names
+        ) / 1e6
+    return os.path.getsize(path) / 1e6
+
+
+def print_comparison(rows):
+    print(f"{'model':<12}{'size (MB)':>12}{'batch 1 (ms)':>15}{'batch 32 (ms)':>15}{'max diff':>12}")
+    for name, size, latency_1, latency_32, difference in rows:
+        print(f"{name:<12}{size:>12.2f}{latency_1:>15.3f}{latency_32:>15.3f}{difference:>12.2e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the user classifier to a CPU inference runtime")
+    parser.add_argument("--format", choices=["onnx", "tflite"], required=True)
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATHS["keras"])
+    parser.add_argument("--output")
+    parser.add_argument("--pipeline", default="users/preprocessing_pipeline.pkl")
+    parser.add_argument("--samples", help="JSON lines file of user records to compare scores on")
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    output = args.output or DEFAULT_MODEL_PATHS[args.format]
+
+    keras_backend = load_backend("keras", args.model)
+    if args.format == "onnx":
+        export_onnx(keras_backend.model, output)
+    else:
+        export_tflite(keras_backend.model, output)
+
+    exported_backend = load_backend(args.format, output)
+
+    inputs = load_inputs(args.samples, args.pipeline, keras_backend.model.input_shape[-1])
+    difference = max_score_difference(keras_backend, exported_backend, inputs)
+
+    print_comparison([
+        ("keras", size_mb(args.model), latency_ms(keras_backend, inputs, 1), latency_ms(keras_backend, inputs, 32), 0.0),
+        (args.format, size_mb(output), latency_ms(exported_backend, inputs, 1),
+         latency_ms(exported_backend, inputs, 32), difference),
+    ])
+
+    if difference > args.tolerance:
+        print(f"Scores differ by up to {difference:.2e}, more than the tolerance of {args.tolerance:.2e}")
+        sys.exit(1)
+
+    print(f"Exported {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import json
+import os
+
+import numpy as np
+
+from models.backends import load_backend
+from models.export_model import export_onnx
+from models.preprocessing import TEXT_FEATURES
+
+# Builds the fixture user classifier of test.py, a small Keras model,
+# its ONNX export and the scores of the Keras model on fixed inputs:
+#
+#   python -m models.fixtures.build_fixtures
+#
+# from the parent of this directory's parent, with requirements-export.txt
+# installed. The fixtures are committed, so that test.py checks the ONNX
+# export against the Keras scores without TensorFlow, and re-exports the
+# Keras model when TensorFlow is installed. Rebuild them when the pinned
+# TensorFlow or tf2onnx change.
+
+FIXTURES_DIR = os.path.dirname(os.path.abspath(__file__))
+KERAS_PATH = os.path.join(FIXTURES_DIR, "user_classifier.h5")
+ONNX_PATH = os.path.join(FIXTURES_DIR, "user_classifier.onnx")
+GOLDEN_PATH = os.path.join(FIXTURES_DIR, "golden_scores.json")
+
+
+def main():
+    import tensorflow as tf
+
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([
+        tf.keras.Input(shape=(len(TEXT_FEATURES),)),
+        tf.keras.layers.Dense(8, activation="relu"),
+        tf.keras.layers.Dense(1, activation="sigmoid"),
+    ])
+    model.save(KERAS_PATH)
+    export_onnx(model, ONNX_PATH)
+
+    # Scaled features, as the preprocessing pipeline outputs them, so
+    # that the scores are spread between 0 and 1
+    inputs = np.random.default_rng(0).random((32, len(TEXT_FEATURES)), dtype=np.float32)
+    scores = load_backend("keras", KERAS_PATH).predict(inputs)[:, 0]
+
+    with open(GOLDEN_PATH, "w") as f:
+        json.dump(
+            {
+                "tensorflow": tf.__version__,
+                "inputs": inputs.tolist(),
+                "scores": [float(score) for score in scores],
+            },
+            f,
+        )
+    print(f"Wrote fixtures to {FIXTURES_DIR}")
+
+
+if __name__ == "__main__":
+    main()
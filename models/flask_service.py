@@ -1,75 +1,89 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_restful import Resource, Api
-import pandas as pd
-import pickle
-from sklearn.base import BaseEstimator, TransformerMixin
-import tensorflow as tf
+import os
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, generate_latest, multiprocess
+
+from models.batching import DynamicBatcher
+from models.preprocessing import TEXT_FEATURES
+from models.registry import ModelRegistry
+
+MODEL_BATCH_SIZE = int(os.getenv("MODEL_BATCH_SIZE", 32))
+MODEL_BATCH_WINDOW_MS = float(os.getenv("MODEL_BATCH_WINDOW_MS", 5))
+
+# Runtime of the user classifier: "keras", or "onnx" or "tflite" for a
+# model exported with export_model.py. MODEL_VARIANT "int8" loads the
+# model quantized with quantize_model.py instead.
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "keras")
+MODEL_VARIANT = os.getenv("MODEL_VARIANT", "float")
+MODEL_PATH = os.getenv("MODEL_PATH") or None
+MODEL_THREADS = int(os.getenv("MODEL_THREADS", 0)) or None
+
+# Directory watched for versioned models, see registry.py. MODEL_VERSION
+# pins a version, e.g. to roll back.
+MODEL_DIR = os.getenv("MODEL_DIR", "users/versions")
+MODEL_VERSION = os.getenv("MODEL_VERSION") or None
+MODEL_WATCH_INTERVAL = float(os.getenv("MODEL_WATCH_INTERVAL", 30))
+
+WARM_UP_RECORD = {feature: "" for feature in TEXT_FEATURES}
+
+predictions_total = Counter(
+    "model_service_predictions_total",
+    "Number of records predicted",
+    ["model_version"],
+)
 
 app = Flask(__name__)
 api = Api(app)
 
+# The model is loaded by warm_up(), in each process serving requests
+registry = ModelRegistry(
+    MODEL_DIR,
+    MODEL_BACKEND,
+    variant=MODEL_VARIANT,
+    path=MODEL_PATH,
+    threads=MODEL_THREADS,
+    pinned_version=MODEL_VERSION,
+    watch_interval=MODEL_WATCH_INTERVAL,
+    warm_up_record=WARM_UP_RECORD,
+    load_model=False,
+)
 
-def to_dense(x):
-    return x.toarray()
 
+class SnippetSpamClassifier(Resource):
+    def post(self):
+        data = request.get_json(force=True)
 
-def load_resources():
-    with open("users/preprocessing_pipeline.pkl", "rb") as f:
-        pipeline = pickle.load(f)
-    loaded_model = tf.keras.models.load_model("users/keras_model.keras")
-    return pipeline, loaded_model
-
-
-preprocessing_pipeline, model = load_resources()
-
-
-class LengthTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, columns):
-        self.columns = columns
-
-    def fit(self, X, y=None):
-        return self
+        print(f"Snippet data received: {data}")
 
-    def transform(self, X):
-        X_copy = X.copy()
-        for col in self.columns:
-            X_copy[col + "_length"] = X_copy[col].apply(
-                lambda x: len(str(x)) if pd.notnull(x) else 0
-            )
-        return X_copy
+        return jsonify(
+            {"prediction": "1", "score": 0.5, "model_version": registry.active.version}
+        )
 
 
-class IsNullTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, columns):
-        self.columns = columns
+USER_EVENT_TYPES = ["user_create", "user_rename"]
 
-    def fit(self, X, y=None):
-        return self
 
-    def transform(self, X):
-        X_copy = X.copy()
-        for col in self.columns:
-            X_copy[col + "_isnull"] = X_copy[col].isnull().astype(int)
-        return X_copy
+# Returns the prediction, score and model version of each record, with
+# a single model call for all of them.
+def predict_users(records):
+    model_version = registry.active
 
+    predictions = model_version.predict_records(records)
+    predictions_total.labels(model_version=model_version.version).inc(len(records))
 
-class SnippetSpamClassifier(Resource):
-    def post(self):
-        data = request.get_json(force=True)
+    return predictions
 
-        print(f"Snippet data received: {data}")
 
-        return jsonify(
-            {"prediction": "1", "score": 0.5}
-        )
+# Single records of concurrent requests are predicted together
+user_batcher = DynamicBatcher(
+    predict_users, max_batch_size=MODEL_BATCH_SIZE, window_ms=MODEL_BATCH_WINDOW_MS
+)
 
 
 class UserSpamClassifier(Resource):
     def post(self):
         data = request.get_json(force=True)
 
-        df = pd.DataFrame([data])
-
         # numeric_features = [
         #     "theme_id",
         #     "color_scheme_id",
@@ -90,49 +104,72 @@ class UserSpamClassifier(Resource):
         #     "is_admin",
         #     "note",
         # ]
-        text_features = [
-            "username",
-            "name",
-            "bio",
-            "location",
-            "website_url",
-            "public_email",
-            "organization",
-            "skype",
-            "linkedin",
-            "twitter",
-            "job_title",
-            "pronouns",
-            "work_information",
-            "email",
-            "commit_email",
-            "avatar_url",
-        ]
-
-        length_transformer = LengthTransformer(text_features)
-        df = length_transformer.transform(df)
-
-        is_null_transformer = IsNullTransformer(text_features)
-        df = is_null_transformer.transform(df)
-
-        df["combined_text"] = df[text_features].apply(
-            lambda row: " ".join(row.values.astype(str)), axis=1
-        )
-        text_features = ["combined_text"]
 
-        processed_data = preprocessing_pipeline.transform(df)
+        return jsonify(user_batcher.predict_one(data))
 
-        prediction = model.predict(processed_data)
 
-        prediction_label = 1 if prediction[0][0] > 0.5 else 0
+# BatchSpamClassifier class predicts many records of one event type at
+# once. Event types without a model are answered with 404, so that
+# clients send these events to the per event type endpoints.
+class BatchSpamClassifier(Resource):
+    def post(self):
+        data = request.get_json(force=True)
+        records = data.get("records") if isinstance(data, dict) else None
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            return {"message": "Expected an event_type and a list of records"}, 400
+        event_type = data.get("event_type")
 
-        return jsonify(
-            {"prediction": prediction_label, "score": prediction[0][0].item()}
-        )
+        if event_type in USER_EVENT_TYPES:
+            predictions = predict_users(records) if records else []
+        elif event_type == "snippet_check":
+            predictions = [
+                {"prediction": "1", "score": 0.5, "model_version": registry.active.version} for _ in records
+            ]
+        else:
+            return {"message": f"No model for event type {event_type}"}, 404
+
+        return jsonify({"predictions": predictions})
+
+
+# Set by warm_up() in each process, before it reports ready
+warmed_up = False
+
+
+# Loads the model and runs a first prediction through the batcher, which
+# starts its worker thread and makes the runtime allocate its buffers,
+# so that the first request of a worker is not slower than the others.
+# Starts watching for new model versions.
+def warm_up():
+    global warmed_up
+
+    registry.load_model()
+    user_batcher.predict_one(WARM_UP_RECORD)
+    registry.start_watcher()
+    warmed_up = True
 
 
 api.add_resource(UserSpamClassifier, "/predict_user_create", "/predict_user_rename")
 api.add_resource(SnippetSpamClassifier, "/predict_snippet_check")
+api.add_resource(BatchSpamClassifier, "/predict_batch")
+
+
+@app.route("/ready")
+def readiness_check():
+    return jsonify({"warmed_up": warmed_up, "model_version": registry.active.version}), 200 if warmed_up else 503
+
+
+# Metrics of all gunicorn workers are collected from
+# PROMETHEUS_MULTIPROC_DIR when it is set
+@app.route("/metrics")
+def metrics():
+    registry = None
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry) if registry else generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
 
+# Development server, server.py serves the model in production
 if __name__ == "__main__":
+    warm_up()
     app.run(host="0.0.0.0", port=5001, debug=True)
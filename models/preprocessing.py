@@ -0,0 +1,92 @@
+import pickle
+import sys
+
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+
+TEXT_FEATURES = [
+    "username",
+    "name",
+    "bio",
+    "location",
+    "website_url",
+    "public_email",
+    "organization",
+    "skype",
+    "linkedin",
+    "twitter",
+    "job_title",
+    "pronouns",
+    "work_information",
+    "email",
+    "commit_email",
+    "avatar_url",
+]
+
+
+def to_dense(x):
+    return x.toarray()
+
+
+class LengthTransformer(BaseEstimator, TransformerMixin):
+    def __init__(self, columns):
+        self.columns = columns
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+        X_copy = X.copy()
+        for col in self.columns:
+            # str() of each value, as numpy converts them, without a
+            # Python call per row
+            lengths = np.char.str_len(X_copy[col].to_numpy().astype(str))
+            X_copy[col + "_length"] = np.where(X_copy[col].notnull(), lengths, 0)
+        return X_copy
+
+
+class IsNullTransformer(BaseEstimator, TransformerMixin):
+    def __init__(self, columns):
+        self.columns = columns
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+        X_copy = X.copy()
+        for col in self.columns:
+            X_copy[col + "_isnull"] = X_copy[col].isnull().astype(int)
+        return X_copy
+
+
+length_transformer = LengthTransformer(TEXT_FEATURES)
+is_null_transformer = IsNullTransformer(TEXT_FEATURES)
+
+
+# Derives the features of all records at once, with column-wise
+# operations instead of one Python call per row. Features missing from
+# all records, e.g. attributes older GitLab versions do not return, are
+# missing values, as they are for records of a batch that lack them.
+def derive_user_features(df):
+    df = df.reindex(columns=df.columns.union(TEXT_FEATURES, sort=False))
+    df = length_transformer.transform(df)
+    df = is_null_transformer.transform(df)
+
+    combined_text = df[TEXT_FEATURES[0]].to_numpy().astype(str)
+    for col in TEXT_FEATURES[1:]:
+        combined_text = np.char.add(np.char.add(combined_text, " "), df[col].to_numpy().astype(str))
+    df["combined_text"] = combined_text.astype(object)
+
+    return df
+
+
+# The pipeline was pickled from a script defining to_dense, so it refers
+# to __main__.to_dense. It is added to __main__ for entry points that do
+# not define it.
+def load_pipeline(path):
+    main_module = sys.modules["__main__"]
+    if not hasattr(main_module, "to_dense"):
+        main_module.to_dense = to_dense
+
+    with open(path, "rb") as f:
+        return pickle.load(f)
@@ -0,0 +1,169 @@
+import argparse
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+from models.backends import DEFAULT_MODEL_PATHS, load_backend, model_path, to_float_array
+from models.export_model import latency_ms, print_comparison, size_mb
+from models.preprocessing import derive_user_features, load_pipeline
+
+# Produces an int8 variant of the exported user classifier, calibrated
+# on historic user records, and reports how it compares to the float
+# model:
+#
+#   python -m models.quantize_model --format onnx --samples user_create.jsonl
+#
+# The samples are a JSON lines file of user_create payloads. Part of
+# them is used to calibrate activation ranges, and the rest to compare
+# scores and accuracy. The records must be labelled, unless the accuracy
+# check is skipped with --skip-accuracy-check. The model service loads
+# the int8 variant with MODEL_VARIANT=int8.
+
+
+# CalibrationDataReader class feeds calibration batches to ONNX Runtime
+class CalibrationDataReader:
+    def __init__(self, input_name, inputs, batch_size=32):
+        self.batches = iter(
+            [{input_name: inputs[i:i + batch_size]} for i in range(0, len(inputs), batch_size)]
+        )
+
+    def get_next(self):
+        return next(self.batches, None)
+
+
+def quantize_onnx(float_path, int8_path, calibration_inputs):
+    import onnxruntime
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+
+    input_name = onnxruntime.InferenceSession(
+        float_path, providers=["CPUExecutionProvider"]
+    ).get_inputs()[0].name
+
+    quantize_static(
+        float_path,
+        int8_path,
+        CalibrationDataReader(input_name, calibration_inputs),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+
+
+# Inputs and outputs stay float, so that the backend is unchanged
+def quantize_tflite(keras_path, int8_path, calibration_inputs):
+    import tensorflow as tf
+
+    def representative_dataset():
+        for row in calibration_inputs:
+            yield [row[np.newaxis, :]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(tf.keras.models.load_model(keras_path))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    with open(int8_path, "wb") as f:
+        f.write(converter.convert())
+
+
+def accuracy(scores, labels):
+    return float(np.mean((scores > 0.5).astype(int) == labels))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the user classifier to int8")
+    parser.add_argument("--format", choices=["onnx", "tflite"], required=True)
+    parser.add_argument("--float-model", help="Float model, exported with export_model.py for ONNX")
+    parser.add_argument("--output")
+    parser.add_argument("--pipeline", default="users/preprocessing_pipeline.pkl")
+    parser.add_argument("--samples", required=True, help="JSON lines file of user_create payloads")
+    parser.add_argument("--calibration-size", type=int, default=500)
+    parser.add_argument("--label-field", default="is_spam")
+    parser.add_argument("--report", help="Write the report to this JSON file")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.01)
+    parser.add_argument(
+        "--skip-accuracy-check",
+        action="store_true",
+        help="Quantize without comparing accuracy, e.g. without labelled records",
+    )
+    args = parser.parse_args()
+
+    with open(args.samples, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    np.random.default_rng(0).shuffle(records)
+
+    pipeline = load_pipeline(args.pipeline)
+    inputs = to_float_array(pipeline.transform(derive_user_features(pd.DataFrame(records))))
+
+    # Scores are compared on records not used for calibration, if any
+    calibration_inputs = inputs[:args.calibration_size]
+    evaluation_inputs = inputs[args.calibration_size:]
+    evaluation_records = records[args.calibration_size:]
+    if len(evaluation_inputs) == 0:
+        evaluation_inputs, evaluation_records = inputs, records
+
+    labelled = all(args.label_field in record for record in evaluation_records)
+    if not labelled and not args.skip_accuracy_check:
+        parser.error(
+            f"Records without {args.label_field} cannot check the accuracy of the int8 model, "
+            "label them or pass --skip-accuracy-check"
+        )
+
+    output = args.output or model_path(args.format, "int8")
+    if args.format == "onnx":
+        float_path = args.float_model or DEFAULT_MODEL_PATHS["onnx"]
+        quantize_onnx(float_path, output, calibration_inputs)
+    else:
+        float_path = args.float_model or DEFAULT_MODEL_PATHS["keras"]
+        quantize_tflite(float_path, output, calibration_inputs)
+
+    float_backend = load_backend("keras" if float_path.endswith(".keras") else args.format, float_path)
+    int8_backend = load_backend(args.format, output)
+
+    float_scores = float_backend.predict(evaluation_inputs)[:, 0]
+    int8_scores = int8_backend.predict(evaluation_inputs)[:, 0]
+
+    report = {
+        "format": args.format,
+        "calibration_records": len(calibration_inputs),
+        "evaluation_records": len(evaluation_inputs),
+        "max_score_difference": float(np.max(np.abs(float_scores - int8_scores))),
+        "mean_score_difference": float(np.mean(np.abs(float_scores - int8_scores))),
+        "prediction_agreement": float(np.mean((float_scores > 0.5) == (int8_scores > 0.5))),
+    }
+    for name, backend, path in [("float", float_backend, float_path), ("int8", int8_backend, output)]:
+        report[name] = {
+            "path": path,
+            "size_mb": size_mb(path),
+            "latency_ms_batch_1": latency_ms(backend, evaluation_inputs, 1),
+            "latency_ms_batch_32": latency_ms(backend, evaluation_inputs, 32),
+        }
+
+    if labelled:
+        labels = np.array([int(record[args.label_field]) for record in evaluation_records])
+        report["float"]["accuracy"] = accuracy(float_scores, labels)
+        report["int8"]["accuracy"] = accuracy(int8_scores, labels)
+
+    print_comparison([
+        (name, report[name]["size_mb"], report[name]["latency_ms_batch_1"],
+         report[name]["latency_ms_batch_32"], 0.0 if name == "float" else report["max_score_difference"])
+        for name in ["float", "int8"]
+    ])
+    print(json.dumps(report, indent=2))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.skip_accuracy_check:
+        print("Accuracy check skipped")
+    elif report["float"]["accuracy"] - report["int8"]["accuracy"] > args.max_accuracy_drop:
+        print(f"Accuracy drops by more than {args.max_accuracy_drop}")
+        sys.exit(1)
+
+    print(f"Quantized {output}")
+
+
+if __name__ == "__main__":
+    main()
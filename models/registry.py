@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+from prometheus_client import Counter, Gauge
+
+from models.backends import load_backend, model_path
+from models.preprocessing import TEXT_FEATURES, derive_user_features, load_pipeline
+
+model_version_info = Gauge(
+    "model_service_model_version_info",
+    "Model version answering predictions, 1 while it is active",
+    ["model_version"],
+    multiprocess_mode="livemax",
+)
+model_reloads = Counter(
+    "model_service_model_reloads_total",
+    "Model versions loaded by the watcher",
+    ["result"],
+)
+
+MANIFEST_FILE = "manifest.json"
+
+
+# ModelVersion class holds the preprocessing pipeline and model of one
+# version. Predictions read the active version once, so that a swap
+# never mixes the pipeline of one version with the model of another.
+#
+# The runtimes of the backends are not fork safe, so the model is only
+# loaded by load_model(), in the process that predicts. The pipeline of
+# a version loaded before forking is shared by the workers.
+class ModelVersion:
+    def __init__(self, version, pipeline, backend, model_path, threads=None):
+        self.version = version
+        self.pipeline = pipeline
+        self.backend = backend
+        self.model_path = model_path
+        self.threads = threads
+        self.model = None
+
+    def load_model(self):
+        self.model = load_backend(self.backend, self.model_path, threads=self.threads)
+        return self
+
+    def predict(self, df):
+        return self.model.predict(self.pipeline.transform(derive_user_features(df)))[:, 0]
+
+    # Returns the prediction, score and model version of each record
+    def predict_records(self, records):
+        return [
+            {"prediction": 1 if score > 0.5 else 0, "score": score.item(), "model_version": self.version}
+            for score in self.predict(pd.DataFrame(records))
+        ]
+
+
+# Loads a version directory. Its manifest names the files of the version:
+#
+#   {"version": "2026-10-01", "backend": "onnx", "model": "model.onnx",
+#    "pipeline": "preprocessing_pipeline.pkl"}
+#
+# The backend defaults to the configured one, and the version to the
+# directory name. The model is not loaded.
+def load_version(directory, default_backend, threads=None):
+    with open(os.path.join(directory, MANIFEST_FILE), "r") as f:
+        manifest = json.load(f)
+
+    return ModelVersion(
+        str(manifest.get("version", os.path.basename(directory))),
+        load_pipeline(os.path.join(directory, manifest.get("pipeline", "preprocessing_pipeline.pkl"))),
+        manifest.get("backend", default_backend),
+        os.path.join(directory, manifest["model"]),
+        threads=threads,
+    )
+
+
+# ModelRegistry class serves the active model version and swaps it for
+# newer versions published to model_dir while requests are answered.
+#
+# Each version is a subdirectory of model_dir with its pipeline, model
+# and manifest. The manifest is written last, so directories without one
+# are still being copied and are skipped. The latest version is the last
+# directory name in sort order, or the pinned version if there is one.
+# A watcher thread loads and warms up a new version before making it
+# active, and keeps the active version if loading fails.
+#
+# Without versions in model_dir, the model of the configured backend and
+# variant in users/ of base_dir is served as version "default".
+#
+# With load_model False, only the pipeline of the active version is
+# loaded, and each process predicting calls load_model() first. The
+# model server preloads the registry this way before forking workers.
+class ModelRegistry:
+    def __init__(self, model_dir, backend, variant="float", path=None, threads=None,
+                 pinned_version=None, watch_interval=30, warm_up_record=None, base_dir=".",
+                 load_model=True):
+        self.model_dir = model_dir
+        self.backend = backend
+        self.threads = threads
+        self.pinned_version = pinned_version
+        self.watch_interval = watch_interval
+        self.warm_up_record = warm_up_record or {feature: "" for feature in TEXT_FEATURES}
+        self.failed_versions = set()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._model_pid = None
+
+        self.active_directory = self.latest_version_directory()
+        if self.active_directory:
+            self.active = load_version(self.active_directory, backend, threads)
+        else:
+            self.active = ModelVersion(
+                "default",
+                load_pipeline(os.path.join(base_dir, "users/preprocessing_pipeline.pkl")),
+                backend,
+                path or os.path.join(base_dir, model_path(backend, variant)),
+                threads=threads,
+            )
+        if load_model:
+            self.load_model()
+        model_version_info.labels(model_version=self.active.version).set(1)
+        logging.info(f"Serving model version {self.active.version}")
+
+    # Loads the model of the active version, if the calling process has
+    # not loaded it yet. Versions swapped in by the watcher are loaded by
+    # reload().
+    def load_model(self):
+        with self._lock:
+            if self._model_pid != os.getpid():
+                self.active.load_model()
+                self._model_pid = os.getpid()
+
+    def latest_version_directory(self):
+        if not self.model_dir or not os.path.isdir(self.model_dir):
+            return None
+
+        versions = sorted(
+            name for name in os.listdir(self.model_dir)
+            if os.path.isfile(os.path.join(self.model_dir, name, MANIFEST_FILE))
+            and name not in self.failed_versions
+        )
+        if self.pinned_version:
+            versions = [name for name in versions if name == self.pinned_version]
+        return os.path.join(self.model_dir, versions[-1]) if versions else None
+
+    def warm_up(self, model_version):
+        model_version.predict(pd.DataFrame([self.warm_up_record]))
+
+    # Loads the latest version if it is not the active one. Returns True
+    # if the active version was swapped.
+    def reload(self):
+        latest = self.latest_version_directory()
+        if latest is None or latest == self.active_directory:
+            return False
+
+        try:
+            candidate = load_version(latest, self.backend, self.threads).load_model()
+            self.warm_up(candidate)
+        except Exception as e:
+            logging.error(f"Failed to load model version {latest}: {e}")
+            self.failed_versions.add(os.path.basename(latest))
+            model_reloads.labels(result="failed").inc()
+            return False
+
+        previous = self.active
+        self.active = candidate
+        self.active_directory = latest
+        model_version_info.labels(model_version=previous.version).set(0)
+        model_version_info.labels(model_version=candidate.version).set(1)
+        model_reloads.labels(result="swapped").inc()
+        logging.info(f"Swapped model version {previous.version} for {candidate.version}")
+        return True
+
+    # The watcher is started by each process, as threads do not survive
+    # forking.
+    def start_watcher(self):
+        if not self.model_dir or self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._watch, daemon=True).start()
+                self._pid = os.getpid()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.watch_interval)
+            self.reload()
@@ -0,0 +1,111 @@
+import gc
+import logging
+import os
+import shutil
+
+from gunicorn.app.base import BaseApplication
+from prometheus_client import multiprocess
+
+
+# Returns the number of cores the container may use: the CPU quota of
+# its cgroup, rather than the cores of the host os.cpu_count() returns.
+def available_cpus():
+    cpus = os.cpu_count() or 1
+    try:
+        # cgroup v2, then v1
+        if os.path.exists("/sys/fs/cgroup/cpu.max"):
+            with open("/sys/fs/cgroup/cpu.max", "r") as f:
+                quota, period = f.read().split()[:2]
+        else:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r") as f:
+                period = f.read().strip()
+    except (OSError, ValueError):
+        return cpus
+
+    if quota in ("max", "-1"):
+        return cpus
+    return max(1, min(cpus, int(quota) // int(period)))
+
+
+MODEL_SERVER_HOST = os.getenv("MODEL_SERVER_HOST", "0.0.0.0")
+MODEL_SERVER_PORT = int(os.getenv("MODEL_SERVER_PORT", 5001))
+MODEL_WORKER_THREADS = int(os.getenv("MODEL_WORKER_THREADS", 8))
+
+# Workers default to one per available core. Each worker loads its own
+# model runtime, as the runtimes are not fork safe, so Keras workers use
+# more memory than ONNX or TFLite ones and MODEL_WORKERS may need to be
+# lowered for them.
+MODEL_WORKERS = int(os.getenv("MODEL_WORKERS", 0)) or available_cpus()
+
+# Models run on the thread calling them, as the workers already scale
+# with the cores.
+os.environ.setdefault("MODEL_THREADS", "1")
+
+
+# ModelServer class serves the model service Flask app with gunicorn.
+# The app, with the preprocessing pipeline of the model, is imported by
+# load(), which runs once in the master before the workers are forked.
+# The model runtime is created in each worker by post_worker_init().
+class ModelServer(BaseApplication):
+    def __init__(self, options=None):
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from models.flask_service import app
+
+        return app
+
+
+# Runs in the master after loading the app, before the workers are forked.
+# Moving the loaded objects out of the garbage collector's generations
+# keeps collections in the workers from writing to their pages, which
+# would copy them into each worker.
+def when_ready(server):
+    gc.freeze()
+    logging.info(f"Model server forking {MODEL_WORKERS} workers")
+
+
+# Runs in every worker before it accepts requests, so that requests and
+# readiness probes are only answered by workers with a warmed up model.
+def post_worker_init(worker):
+    from models.flask_service import warm_up
+
+    warm_up()
+    logging.info(f"Model server worker {worker.pid} ready")
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def main():
+    # Metrics files of a previous run are not valid anymore
+    prometheus_multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if prometheus_multiproc_dir:
+        shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+        os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+
+    options = {
+        "bind": f"{MODEL_SERVER_HOST}:{MODEL_SERVER_PORT}",
+        "workers": MODEL_WORKERS,
+        # Concurrent requests of a worker are batched by its DynamicBatcher
+        "threads": MODEL_WORKER_THREADS,
+        "preload_app": True,
+        "when_ready": when_ready,
+        "post_worker_init": post_worker_init,
+        "child_exit": child_exit,
+        "accesslog": None,
+    }
+    ModelServer(options).run()
+
+
+if __name__ == "__main__":
+    main()
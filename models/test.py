@@ -0,0 +1,419 @@
+import importlib.util
+import json
+import os
+import pickle
+import tempfile
+import threading
+import unittest
+from unittest.mock import mock_open, patch
+
+from models.batching import DynamicBatcher
+from models.server import available_cpus
+
+try:
+    import numpy as np
+    import pandas as pd
+    from onnx import TensorProto, helper, save
+
+    from models.backends import load_backend
+    from models.export_model import export_onnx, max_score_difference
+    from models.preprocessing import TEXT_FEATURES, derive_user_features
+    from models.quantize_model import main as quantize_main
+    from models.registry import ModelRegistry
+
+    HAS_ONNX = True
+except ImportError:
+    HAS_ONNX = False
+
+HAS_EXPORT = HAS_ONNX and all(importlib.util.find_spec(name) for name in ["tensorflow", "tf2onnx"])
+
+
+# Preprocessing pipeline of the test model versions, which only keeps
+# the text lengths
+class LengthPipeline:
+    def transform(self, df):
+        return df[[f"{feature}_length" for feature in TEXT_FEATURES]].to_numpy(dtype=np.float32)
+
+
+# Writes a model version to model_dir/name, whose ONNX model scores
+# users by the length of their bio: sigmoid(len(bio) + bias).
+def write_version(model_dir, name, bias=-5.0, model=None):
+    directory = os.path.join(model_dir, name)
+    os.makedirs(directory)
+
+    if model is None:
+        weights = [1.0 if feature == "bio" else 0.0 for feature in TEXT_FEATURES]
+        graph = helper.make_graph(
+            [
+                helper.make_node("MatMul", ["input", "weights"], ["logits"]),
+                helper.make_node("Add", ["logits", "bias"], ["z"]),
+                helper.make_node("Sigmoid", ["z"], ["score"]),
+            ],
+            "users",
+            [helper.make_tensor_value_info("input", TensorProto.FLOAT, [None, len(TEXT_FEATURES)])],
+            [helper.make_tensor_value_info("score", TensorProto.FLOAT, [None, 1])],
+            initializer=[
+                helper.make_tensor("weights", TensorProto.FLOAT, [len(TEXT_FEATURES), 1], weights),
+                helper.make_tensor("bias", TensorProto.FLOAT, [1], [bias]),
+            ],
+        )
+        onnx_model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+        onnx_model.ir_version = 8
+        save(onnx_model, os.path.join(directory, "model.onnx"))
+    else:
+        with open(os.path.join(directory, "model.onnx"), "wb") as f:
+            f.write(model)
+
+    with open(os.path.join(directory, "preprocessing_pipeline.pkl"), "wb") as f:
+        pickle.dump(LengthPipeline(), f)
+
+    # Written last, like a published version
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump({"version": name, "backend": "onnx", "model": "model.onnx"}, f)
+
+    return directory
+
+
+def user(bio=""):
+    return {**{feature: "" for feature in TEXT_FEATURES}, "bio": bio}
+
+
+class TestDynamicBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def predict(self, records):
+        self.batches.append(list(records))
+        if "bad" in records:
+            raise ValueError("bad record")
+        return [record.upper() for record in records]
+
+    def test_records_within_window_are_predicted_together(self):
+        batcher = DynamicBatcher(self.predict, max_batch_size=32, window_ms=200)
+
+        futures = [batcher.submit(record) for record in ["a", "b", "c"]]
+
+        self.assertEqual([future.result(5) for future in futures], ["A", "B", "C"])
+        self.assertEqual(self.batches, [["a", "b", "c"]])
+
+    def test_records_after_window_are_predicted_separately(self):
+        batcher = DynamicBatcher(self.predict, max_batch_size=32, window_ms=10)
+
+        self.assertEqual(batcher.predict_one("a", timeout=5), "A")
+        self.assertEqual(batcher.predict_one("b", timeout=5), "B")
+        self.assertEqual(self.batches, [["a"], ["b"]])
+
+    def test_batches_are_capped(self):
+        batcher = DynamicBatcher(self.predict, max_batch_size=2, window_ms=200)
+
+        futures = [batcher.submit(record) for record in ["a", "b", "c", "d", "e"]]
+
+        self.assertEqual([future.result(5) for future in futures], ["A", "B", "C", "D", "E"])
+        self.assertEqual([len(batch) for batch in self.batches], [2, 2, 1])
+
+    def test_failing_record_does_not_fail_its_batch(self):
+        batcher = DynamicBatcher(self.predict, max_batch_size=32, window_ms=200)
+
+        futures = [batcher.submit(record) for record in ["a", "bad", "b"]]
+
+        self.assertEqual(futures[0].result(5), "A")
+        self.assertEqual(futures[2].result(5), "B")
+        with self.assertRaises(ValueError):
+            futures[1].result(5)
+        self.assertEqual(self.batches, [["a", "bad", "b"], ["a"], ["bad"], ["b"]])
+
+    def test_batcher_keeps_working_after_failure(self):
+        batcher = DynamicBatcher(self.predict, max_batch_size=32, window_ms=10)
+
+        with self.assertRaises(ValueError):
+            batcher.predict_one("bad", timeout=5)
+        self.assertEqual(batcher.predict_one("a", timeout=5), "A")
+
+    def test_concurrent_requests_get_their_own_result(self):
+        batcher = DynamicBatcher(self.predict, max_batch_size=4, window_ms=20)
+        results = {}
+
+        def request(record):
+            results[record] = batcher.predict_one(record, timeout=5)
+
+        threads = [threading.Thread(target=request, args=(str(i),)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {str(i): str(i).upper() for i in range(20)})
+        self.assertTrue(all(len(batch) <= 4 for batch in self.batches))
+
+
+class TestServer(unittest.TestCase):
+
+    @patch("models.server.os.cpu_count", return_value=64)
+    @patch("models.server.os.path.exists", return_value=True)
+    def test_workers_follow_cgroup_cpu_quota(self, mock_exists, mock_cpu_count):
+        with patch("builtins.open", mock_open(read_data="250000 100000\n")):
+            self.assertEqual(available_cpus(), 2)
+        with patch("builtins.open", mock_open(read_data="max 100000\n")):
+            self.assertEqual(available_cpus(), 64)
+
+
+@unittest.skipUnless(HAS_ONNX, "onnx, onnxruntime and scikit-learn are required")
+class TestModelRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.model_dir = self.temp_dir.name
+        write_version(self.model_dir, "v1", bias=-5.0)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_records_are_predicted_by_the_latest_version(self):
+        registry = ModelRegistry(self.model_dir, "onnx")
+
+        predictions = registry.active.predict_records([user(), user("x" * 10)])
+
+        self.assertEqual([p["prediction"] for p in predictions], [0, 1])
+        self.assertEqual({p["model_version"] for p in predictions}, {"v1"})
+        self.assertAlmostEqual(predictions[1]["score"], 1 / (1 + np.exp(-5)), places=5)
+
+    def test_new_version_is_swapped_in(self):
+        registry = ModelRegistry(self.model_dir, "onnx")
+        previous = registry.active
+
+        write_version(self.model_dir, "v2", bias=5.0)
+        self.assertTrue(registry.reload())
+        self.assertFalse(registry.reload())
+
+        prediction = registry.active.predict_records([user()])[0]
+        self.assertEqual((prediction["prediction"], prediction["model_version"]), (1, "v2"))
+
+        # Requests holding the previous version finish with it
+        prediction = previous.predict_records([user()])[0]
+        self.assertEqual((prediction["prediction"], prediction["model_version"]), (0, "v1"))
+
+    def test_failing_version_is_skipped(self):
+        registry = ModelRegistry(self.model_dir, "onnx")
+
+        write_version(self.model_dir, "v2", model=b"not a model")
+        self.assertFalse(registry.reload())
+        self.assertEqual(registry.active.version, "v1")
+        self.assertIn("v2", registry.failed_versions)
+
+        # Not loaded again, but a later version is
+        self.assertFalse(registry.reload())
+        write_version(self.model_dir, "v3", bias=5.0)
+        self.assertTrue(registry.reload())
+        self.assertEqual(registry.active.version, "v3")
+
+    def test_versions_without_manifest_are_skipped(self):
+        registry = ModelRegistry(self.model_dir, "onnx")
+
+        os.makedirs(os.path.join(self.model_dir, "v2"))
+        self.assertFalse(registry.reload())
+        self.assertEqual(registry.active.version, "v1")
+
+    def test_pinned_version_is_served(self):
+        write_version(self.model_dir, "v2", bias=5.0)
+
+        registry = ModelRegistry(self.model_dir, "onnx", pinned_version="v1")
+
+        self.assertEqual(registry.active.version, "v1")
+        self.assertFalse(registry.reload())
+
+    def test_deferred_model_is_loaded_by_each_process(self):
+        registry = ModelRegistry(self.model_dir, "onnx", load_model=False)
+        self.assertEqual(registry.active.version, "v1")
+        self.assertIsNone(registry.active.model)
+
+        registry.load_model()
+        model = registry.active.model
+        registry.load_model()
+        self.assertIs(registry.active.model, model)
+        self.assertEqual(registry.active.predict_records([user()])[0]["prediction"], 0)
+
+        # A forked worker does not use the runtime of its parent
+        with patch("models.registry.os.getpid", return_value=-1):
+            registry.load_model()
+        self.assertIsNot(registry.active.model, model)
+
+
+# Features of the model service before derive_user_features, with one
+# Python call per row
+def derive_user_features_row_wise(df):
+    df = df.copy()
+    for col in TEXT_FEATURES:
+        df[col + "_length"] = df[col].apply(lambda x: len(str(x)) if pd.notnull(x) else 0)
+    for col in TEXT_FEATURES:
+        df[col + "_isnull"] = df[col].isnull().astype(int)
+    df["combined_text"] = df[TEXT_FEATURES].apply(lambda row: " ".join(row.values.astype(str)), axis=1)
+    return df
+
+
+@unittest.skipUnless(HAS_ONNX, "onnx, onnxruntime and scikit-learn are required")
+class TestPreprocessing(unittest.TestCase):
+
+    def test_features_match_row_wise_features(self):
+        records = [
+            user("Buy cheap watches"),
+            {**user(), "name": None, "bio": float("nan"), "location": None},
+            {**user(), "skype": 12345, "twitter": 1.5, "pronouns": 0},
+            {**user("Grüße aus Zürich 日本語 🚀"), "name": "Zoë", "job_title": "   "},
+        ]
+
+        for frame in [pd.DataFrame(records), pd.DataFrame(records[1:2]), pd.DataFrame(records[3:])]:
+            pd.testing.assert_frame_equal(derive_user_features(frame), derive_user_features_row_wise(frame))
+
+    def test_missing_features_are_missing_values(self):
+        df = derive_user_features(pd.DataFrame([{"username": "spammer", "bio": "Buy now"}]))
+
+        self.assertEqual(df.loc[0, "bio_length"], 7)
+        self.assertEqual(df.loc[0, "skype_length"], 0)
+        self.assertEqual(df.loc[0, "skype_isnull"], 1)
+        self.assertEqual(df.loc[0, "username_isnull"], 0)
+
+
+@unittest.skipUnless(HAS_ONNX, "onnx, onnxruntime and scikit-learn are required")
+class TestBatchEndpoint(unittest.TestCase):
+
+    # The model service finds its model version when it is imported, and
+    # loads the model when it is warmed up
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.TemporaryDirectory()
+        write_version(cls.model_dir.name, "2026-01-01")
+        with patch.dict(os.environ, {"MODEL_BACKEND": "onnx", "MODEL_DIR": cls.model_dir.name}):
+            from models import flask_service
+        flask_service.warm_up()
+        cls.client = flask_service.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.model_dir.cleanup()
+
+    def predict_batch(self, body):
+        return self.client.post("/predict_batch", json=body)
+
+    def test_user_events_are_predicted_in_order(self):
+        response = self.predict_batch({"event_type": "user_create", "records": [user("x" * 10), user()]})
+
+        self.assertEqual(response.status_code, 200)
+        predictions = response.get_json()["predictions"]
+        self.assertEqual([prediction["prediction"] for prediction in predictions], [1, 0])
+        self.assertEqual({prediction["model_version"] for prediction in predictions}, {"2026-01-01"})
+
+    def test_records_with_missing_features_are_predicted(self):
+        response = self.predict_batch({"event_type": "user_rename", "records": [{"bio": "x" * 10}]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["predictions"][0]["prediction"], 1)
+
+    def test_snippet_checks_get_one_prediction_per_record(self):
+        response = self.predict_batch({"event_type": "snippet_check", "records": [{}, {}]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()["predictions"]), 2)
+
+    def test_event_types_without_a_model_are_not_found(self):
+        response = self.predict_batch({"event_type": "issue_create", "records": [{}]})
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_empty_batches_get_no_predictions(self):
+        response = self.predict_batch({"event_type": "user_create", "records": []})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["predictions"], [])
+
+    def test_malformed_batches_are_rejected(self):
+        self.assertEqual(self.predict_batch({"event_type": "user_create"}).status_code, 400)
+        self.assertEqual(self.predict_batch({"event_type": "user_create", "records": ["x"]}).status_code, 400)
+
+
+@unittest.skipUnless(HAS_ONNX, "onnx, onnxruntime and scikit-learn are required")
+class TestQuantizeModel(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = write_version(self.temp_dir.name, "v1")
+        self.samples = os.path.join(self.temp_dir.name, "samples.jsonl")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def quantize(self, records, *options):
+        with open(self.samples, "w") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+
+        argv = [
+            "quantize_model.py", "--format", "onnx", "--samples", self.samples, "--calibration-size", "4",
+            "--float-model", os.path.join(self.directory, "model.onnx"),
+            "--pipeline", os.path.join(self.directory, "preprocessing_pipeline.pkl"),
+            "--output", os.path.join(self.directory, "model.int8.onnx"),
+            *options,
+        ]
+        with patch("sys.argv", argv), patch("builtins.print"):
+            quantize_main()
+
+    def test_accuracy_is_checked_on_labelled_records(self):
+        records = [{**user("x" * length), "is_spam": int(length > 5)} for length in [0, 2, 8, 10] * 5]
+
+        self.quantize(records)
+
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "model.int8.onnx")))
+
+    def test_unlabelled_records_need_accuracy_check_skipped(self):
+        records = [user("x" * (i % 10)) for i in range(20)]
+
+        with patch("models.quantize_model.quantize_onnx") as mock_quantize, patch("sys.stderr"):
+            with self.assertRaises(SystemExit) as error:
+                self.quantize(records)
+        self.assertEqual(error.exception.code, 2)
+        mock_quantize.assert_not_called()
+
+        self.quantize(records, "--skip-accuracy-check")
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "model.int8.onnx")))
+
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+# The fixture user classifier, its ONNX export and the scores of the
+# Keras model on fixed inputs are built by fixtures/build_fixtures.py
+# with the TensorFlow of requirements-export.txt. The ONNX export is
+# checked without TensorFlow, and a new export with it.
+@unittest.skipUnless(HAS_ONNX, "onnx, onnxruntime and scikit-learn are required")
+class TestExportModel(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(FIXTURES_DIR, "golden_scores.json"), "r") as f:
+            golden = json.load(f)
+        self.inputs = np.array(golden["inputs"], dtype=np.float32)
+        self.scores = np.array(golden["scores"], dtype=np.float32)
+
+    def assert_gives_golden_scores(self, backend):
+        scores = backend.predict(self.inputs)
+        self.assertEqual(scores.shape, (len(self.inputs), 1))
+        self.assertLess(float(np.max(np.abs(scores[:, 0] - self.scores))), 1e-5)
+
+    def test_onnx_export_gives_keras_scores(self):
+        self.assert_gives_golden_scores(load_backend("onnx", os.path.join(FIXTURES_DIR, "user_classifier.onnx")))
+
+    @unittest.skipUnless(HAS_EXPORT, "tensorflow and tf2onnx of requirements-export.txt are required")
+    def test_new_onnx_export_gives_keras_scores(self):
+        keras_backend = load_backend("keras", os.path.join(FIXTURES_DIR, "user_classifier.h5"))
+        self.assert_gives_golden_scores(keras_backend)
+
+        with tempfile.TemporaryDirectory() as directory:
+            onnx_path = os.path.join(directory, "model.onnx")
+            export_onnx(keras_backend.model, onnx_path)
+            onnx_backend = load_backend("onnx", onnx_path)
+
+            self.assert_gives_golden_scores(onnx_backend)
+            self.assertLess(max_score_difference(keras_backend, onnx_backend, self.inputs), 1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import importlib.util
+
+import gitlab
+import httpx
+
+
+# AsyncGitlabClient class is a minimal asyncio client for the GitLab
+# REST API. A single httpx connection pool is shared by all requests,
+# so connections are kept alive between requests, the number of open
+# connections is bounded, and HTTP/2 is used if the h2 package is
+# installed. Objects are returned as dictionaries with the same
+# attributes python-gitlab would serialise with to_json().
+class AsyncGitlabClient:
+    def __init__(
+        self,
+        gitlab_url,
+        gitlab_access_token,
+        max_connections=20,
+        max_keepalive_connections=10,
+        timeout=10,
+        transport=None,
+    ):
+        self.client = httpx.AsyncClient(
+            base_url=f"{gitlab_url.rstrip('/')}/api/v4",
+            headers={"PRIVATE-TOKEN": gitlab_access_token or ""},
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+            http2=importlib.util.find_spec("h2") is not None,
+            timeout=timeout,
+            transport=transport,
+        )
+
+    # Errors are raised as python-gitlab exceptions, so that callers can
+    # handle both clients in the same way.
+    async def _request(self, path, params=None, headers=None):
+        try:
+            return await self.client.get(path, params=params or None, headers=headers)
+        except httpx.HTTPError as e:
+            raise gitlab.exceptions.GitlabHttpError(error_message=str(e)) from e
+
+    def _raise_for_status(self, response):
+        if response.status_code != 200:
+            raise gitlab.exceptions.GitlabGetError(
+                error_message=response.text,
+                response_code=response.status_code,
+                response_body=response.content,
+            )
+
+    async def get(self, path, **params):
+        response = await self._request(path, params=params)
+        self._raise_for_status(response)
+        return response.json()
+
+    # Returns the object and its ETag. If the ETag of a cached copy is
+    # given and the object has not changed, the object is None and the
+    # response body is neither sent nor parsed.
+    async def get_conditional(self, path, etag=None):
+        response = await self._request(path, headers={"If-None-Match": etag} if etag else None)
+        if response.status_code == 304:
+            return None, response.headers.get("ETag", etag)
+        self._raise_for_status(response)
+        return response.json(), response.headers.get("ETag")
+
+    async def get_group(self, group_id):
+        return await self.get(f"/groups/{group_id}")
+
+    async def get_issue_note(self, project_id, issue_iid, note_id):
+        note = await self.get(f"/projects/{project_id}/issues/{issue_iid}/notes/{note_id}")
+        # python-gitlab adds the attributes of the parent objects
+        note.update({"project_id": project_id, "issue_iid": issue_iid})
+        return note
+
+    async def aclose(self):
+        await self.client.aclose()
@@ -0,0 +1,131 @@
+import json
+from datetime import datetime, timezone
+
+AUTHOR_FIELDS = "id username name state avatarUrl webUrl"
+
+ISSUE_FIELDS = f"""
+    id iid projectId title description state type confidential discussionLocked
+    createdAt updatedAt closedAt dueDate webUrl upvotes downvotes userNotesCount
+    labels {{ nodes {{ title }} }}
+    author {{ {AUTHOR_FIELDS} }}
+"""
+
+NOTE_FIELDS = f"""
+    id body system internal resolvable createdAt updatedAt
+    author {{ {AUTHOR_FIELDS} }}
+"""
+
+
+def global_id(object_type, object_id):
+    return f"gid://gitlab/{object_type}/{object_id}"
+
+
+def parse_global_id(value):
+    return int(value.rsplit("/", 1)[-1])
+
+
+# GraphQL times have no fractional seconds, e.g. 2024-01-02T03:04:05Z,
+# while REST times have milliseconds, e.g. 2024-01-02T03:04:05.000Z
+def rest_time(value):
+    if value is None:
+        return None
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc)
+    return parsed.strftime("%Y-%m-%dT%H:%M:%S.") + f"{parsed.microsecond // 1000:03d}Z"
+
+
+def _author_to_rest(author):
+    if author is None:
+        return None
+    return {
+        "id": parse_global_id(author["id"]),
+        "username": author["username"],
+        "name": author["name"],
+        "state": author["state"],
+        "avatar_url": author["avatarUrl"],
+        "web_url": author["webUrl"],
+    }
+
+
+# The functions below map GraphQL nodes to the attributes returned by the
+# REST API, so that classification and notification get the same shape
+# from both backends.
+def issue_to_rest(node):
+    return {
+        "id": parse_global_id(node["id"]),
+        "iid": int(node["iid"]),
+        "project_id": node["projectId"],
+        "title": node["title"],
+        "description": node["description"],
+        "state": node["state"],
+        "type": node["type"],
+        "issue_type": node["type"].lower() if node["type"] else None,
+        "confidential": node["confidential"],
+        "discussion_locked": node["discussionLocked"],
+        "created_at": rest_time(node["createdAt"]),
+        "updated_at": rest_time(node["updatedAt"]),
+        "closed_at": rest_time(node["closedAt"]),
+        "due_date": node["dueDate"],
+        "web_url": node["webUrl"],
+        "upvotes": node["upvotes"],
+        "downvotes": node["downvotes"],
+        "user_notes_count": node["userNotesCount"],
+        "labels": [label["title"] for label in node["labels"]["nodes"]],
+        "author": _author_to_rest(node["author"]),
+    }
+
+
+def note_to_rest(node):
+    return {
+        "id": parse_global_id(node["id"]),
+        "type": None,
+        "body": node["body"],
+        "attachment": None,
+        "author": _author_to_rest(node["author"]),
+        "created_at": rest_time(node["createdAt"]),
+        "updated_at": rest_time(node["updatedAt"]),
+        "system": node["system"],
+        "noteable_type": "Issue",
+        "resolvable": node["resolvable"],
+        "internal": node["internal"],
+        "confidential": node["internal"],
+    }
+
+
+# GitlabGraphQLClient class fetches many issues and issue notes from the
+# GitLab GraphQL API in a single request. Each object is requested under
+# its own alias, so that one missing or inaccessible object does not fail
+# the whole query: its alias is null and the other objects are returned.
+# Requests go through the python-gitlab session, so that authentication,
+# connection reuse and errors are the same as for REST requests.
+class GitlabGraphQLClient:
+    def __init__(self, gitlab_client):
+        self.gitlab_client = gitlab_client
+        self.url = f"{gitlab_client.url.rstrip('/')}/api/graphql"
+
+    def query(self, query):
+        result = self.gitlab_client.http_post(self.url, post_data={"query": query})
+        return result.get("data") or {}, result.get("errors") or []
+
+    # Returns the issues and notes found, by ID, mapped to REST attributes
+    def get_issues_and_notes(self, issue_ids=(), note_ids=()):
+        aliases = []
+        for issue_id in sorted(set(issue_ids)):
+            aliases.append(f"issue_{issue_id}: issue(id: {json.dumps(global_id('Issue', issue_id))}) {{ {ISSUE_FIELDS} }}")
+        for note_id in sorted(set(note_ids)):
+            aliases.append(f"note_{note_id}: note(id: {json.dumps(global_id('Note', note_id))}) {{ {NOTE_FIELDS} }}")
+        if not aliases:
+            return {}, {}
+
+        data, _ = self.query("query {\n" + "\n".join(aliases) + "\n}")
+
+        issues = {
+            issue_id: issue_to_rest(data[f"issue_{issue_id}"])
+            for issue_id in issue_ids
+            if data.get(f"issue_{issue_id}")
+        }
+        notes = {
+            note_id: note_to_rest(data[f"note_{note_id}"])
+            for note_id in note_ids
+            if data.get(f"note_{note_id}")
+        }
+        return issues, notes
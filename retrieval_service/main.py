@@ -1,9 +1,14 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import logging
 import gitlab
+from gitlab.v4.objects import Project, ProjectIssue, User
 import os
-from prometheus_client import Counter, Histogram
+from prometheus_client import Counter, Gauge, Histogram
 import requests
 import json
+import random
 import time
 
 from common.constants import (
@@ -16,12 +21,133 @@ from common.constants import (
 )
 
 from common.event_processor import EventProcessor
+from common.projection import serialise_object
+from retrieval_service.async_client import AsyncGitlabClient
+from retrieval_service.graphql_client import GitlabGraphQLClient, rest_time
+from retrieval_service.object_cache import GitlabObjectCache
 
 LOGLEVEL = os.environ.get('LOGLEVEL', 'WARNING').upper()
 logging.basicConfig(
     level=LOGLEVEL, format="%(asctime)s - %(levelname)s - Retrieval service: %(message)s"
 )
 
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", 1024))
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", 300))
+RETRIEVAL_VALIDATOR_TTL = int(os.getenv("RETRIEVAL_VALIDATOR_TTL", 86400))
+SNIPPET_BATCH_SIZE = int(os.getenv("SNIPPET_BATCH_SIZE", 100))
+SNIPPET_AUTHOR_CONCURRENCY = int(os.getenv("SNIPPET_AUTHOR_CONCURRENCY", 8))
+SNIPPET_RECHECK_DAYS = float(os.getenv("SNIPPET_RECHECK_DAYS", 7))
+VERIFICATION_URL = os.getenv("VERIFICATION_URL", "http://localhost:8001")
+
+RETRIEVAL_MAX_ATTEMPTS = int(os.getenv("RETRIEVAL_MAX_ATTEMPTS", 5))
+RETRIEVAL_RETRY_INITIAL_DELAY = float(os.getenv("RETRIEVAL_RETRY_INITIAL_DELAY", 1))
+RETRIEVAL_RETRY_MAX_DELAY = float(os.getenv("RETRIEVAL_RETRY_MAX_DELAY", 32))
+
+SNIPPET_CHECKED_KEY = "retrieval:snippet_check:updated_at"
+RETRY_SCHEDULE_KEY = "retrieval:retry"
+RETRY_ATTEMPT_FIELD = "_retrieval_attempt"
+
+event_processing_time = Histogram(
+    "retrieval_service_event_processing_seconds",
+    "Time taken to process an event",
+)
+events_processed = Counter(
+    "retrieval_service_events_processed_total",
+    "Total number of events processed",
+)
+gitlab_retries = Counter(
+    "retrieval_service_gitlab_retries_total",
+    "Number of events rescheduled or given up after transient GitLab errors",
+    ["endpoint", "outcome"],
+)
+graphql_objects = Counter(
+    "retrieval_service_graphql_objects_total",
+    "Number of objects retrieved in GraphQL batches or with the REST fallback",
+    ["object_type", "result"],
+)
+conditional_requests = Counter(
+    "retrieval_service_conditional_requests_total",
+    "Number of stale cached objects revalidated with GitLab",
+    ["object_type", "result"],
+)
+fetches_avoided = Counter(
+    "retrieval_service_fetches_avoided_total",
+    "Number of events forwarded without retrieving the object from GitLab",
+    ["event_type"],
+)
+pending_retries = Gauge(
+    "retrieval_service_pending_retries",
+    "Number of events waiting to be retried",
+)
+
+
+# TransientRetrievalError is raised when a GitLab request fails with an
+# error that may succeed later, i.e. anything but a 404, or cannot reach
+# GitLab.
+class TransientRetrievalError(Exception):
+    def __init__(self, endpoint, error):
+        super().__init__(f"{endpoint}: {error}")
+        self.endpoint = endpoint
+        self.error = error
+
+
+# Hook times, e.g. "2015-05-17 17:06:40 UTC" in note hooks, in the REST
+# format
+def _hook_time_to_rest(value):
+    if value.endswith(" UTC"):
+        value = value[:-len(" UTC")].replace(" ", "T") + "Z"
+    return rest_time(value)
+
+
+# Builds the object of an issue or issue note event from its hook
+# payload, with the fields read by classification and notification, so
+# that it can be forwarded without retrieving the object. The author of
+# the object is the user who triggered the event, and None is returned
+# if they are not, e.g. when an issue is closed by someone else, or if
+# the payload lacks a field. Other hooks, such as the user and project
+# system hooks, lack most attributes of their object.
+def object_from_payload(event_type, event_data, gitlab_url):
+    attributes = event_data.get("object_attributes") or {}
+    user = event_data.get("user") or {}
+    if user.get("id") is None or user.get("id") != attributes.get("author_id"):
+        return None
+
+    try:
+        if event_type in [e.value for e in IssueEvent]:
+            return {
+                "id": attributes["id"],
+                "iid": attributes["iid"],
+                "project_id": attributes["project_id"],
+                "title": attributes["title"],
+                "description": attributes["description"],
+                "state": attributes["state"],
+                "web_url": attributes["url"],
+                "author": {"name": user["name"]},
+            }
+
+        if event_type in [e.value for e in IssueNoteEvent]:
+            return {
+                "id": attributes["id"],
+                "project_id": event_data["project_id"],
+                "issue_iid": event_data["issue"]["iid"],
+                "body": attributes["note"],
+                "created_at": _hook_time_to_rest(attributes["created_at"]),
+                "author": {"name": user["name"], "web_url": f"{gitlab_url.rstrip('/')}/{user['username']}"},
+            }
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+
+    return None
+
+
+def _endpoint_name(func):
+    name = getattr(func, "__name__", "unknown")
+    owner = getattr(func, "__self__", None)
+    if owner is None:
+        return name
+    return f"{type(owner).__name__}.{name}"
+
+
 # GitlabRetrievalProcessor class is used to process events from Redis queues
 # and push events back into to Redis queues after processing.
 # It is a subclass of EventProcessor.
@@ -34,38 +160,181 @@ class GitlabRetrievalProcessor(EventProcessor):
         )
         self.testing = testing
 
-        self.event_processing_time = Histogram(
-            "retrieval_service_event_processing_seconds",
-            "Time taken to process an event",
-        )
-        self.events_processed = Counter(
-            "retrieval_service_events_processed_total",
-            "Total number of events processed",
+        self.event_processing_time = event_processing_time
+        self.events_processed = events_processed
+
+        # Projects, users and issues looked up as context of other events
+        # are cached. Objects an event is about are fetched again, unless
+        # they can be built from the payload of the event.
+        self.object_cache = GitlabObjectCache(
+            self.redis_client,
+            max_size=RETRIEVAL_CACHE_SIZE,
+            ttl=RETRIEVAL_CACHE_TTL,
+            validator_ttl=RETRIEVAL_VALIDATOR_TTL,
         )
 
-    def _retry_with_exponential_backoff(self, func, *args, max_attempts=5, initial_delay=1, max_delay=32, **kwargs):
-        attempt = 0
-        delay = initial_delay
-        while attempt < max_attempts:
-            try:
-                return func(*args, **kwargs)
-            except (gitlab.exceptions.GitlabGetError, gitlab.exceptions.GitlabHttpError) as e:
-                logging.warning(f'Error retrieving from GitLab with function {func.__name__}: {e}')
-                if e.response_code == 404:
-                    logging.warning(f'Object not found in GitLab.')
-                    raise
-                else:
-                    logging.warning(f'Retry {attempt + 1} of {max_attempts} for function {func.__name__} failed with error: {e}')
-                    attempt += 1
-                    if attempt == max_attempts:
-                        raise
-                    time.sleep(delay)
-                    delay = min(delay * 2, max_delay)
+    # Calls GitLab once. Transient errors are raised as
+    # TransientRetrievalError, so that process_event can reschedule the
+    # event instead of blocking the worker loop with sleeps.
+    def _get_from_gitlab(self, func, *args, endpoint=None, **kwargs):
+        endpoint = endpoint or _endpoint_name(func)
+        try:
+            return func(*args, **kwargs)
+        except (gitlab.exceptions.GitlabGetError, gitlab.exceptions.GitlabHttpError) as e:
+            logging.warning(f'Error retrieving from GitLab with function {endpoint}: {e}')
+            if e.response_code == 404:
+                logging.warning('Object not found in GitLab.')
+                raise
+            raise TransientRetrievalError(endpoint, e) from e
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            logging.warning(f'Unable to reach GitLab with function {endpoint}: {e}')
+            raise TransientRetrievalError(endpoint, e) from e
+
+    # Requests an object, with the ETag of a cached copy if there is one.
+    # Returns None if GitLab answers that the object has not changed.
+    def _conditional_get(self, path, etag=None):
+        try:
+            return self.gitlab_client.http_request(
+                "get", path, extra_headers={"If-None-Match": etag} if etag else None
+            )
+        except gitlab.exceptions.GitlabHttpError as e:
+            if e.response_code == 304:
+                return None
+            raise
+
+    # Returns the attributes of an object looked up as context of an event.
+    # Stale cached copies are revalidated with a conditional request, so
+    # that unchanged objects are neither downloaded nor parsed again.
+    def _get_cached_attributes(self, object_type, key, path):
+        entry = self.object_cache.get_entry(object_type, key)
+        if entry is not None and self.object_cache.is_fresh(entry):
+            return entry["attributes"]
+
+        etag = entry["etag"] if entry is not None else None
+        response = self._get_from_gitlab(self._conditional_get, path, etag, endpoint=f"{object_type}.get")
+        if response is None:
+            conditional_requests.labels(object_type, "not_modified").inc()
+            self.object_cache.set(object_type, key, entry["attributes"], etag=etag)
+            return entry["attributes"]
+
+        if etag:
+            conditional_requests.labels(object_type, "modified").inc()
+        attributes = response.json()
+        self.object_cache.set(object_type, key, attributes, etag=response.headers.get("ETag"))
+        return attributes
+
+    # Schedules the event to be added to the input stream again after an
+    # exponential backoff delay with jitter, in a Redis sorted set scored
+    # by due time. The number of attempts travels with the event data.
+    def _schedule_retry(self, event_type, event_data, error):
+        attempt = event_data.get(RETRY_ATTEMPT_FIELD, 0) + 1
+        if attempt >= RETRIEVAL_MAX_ATTEMPTS:
+            gitlab_retries.labels(error.endpoint, "exhausted").inc()
+            logging.warning(f'Giving up on {event_type} event after {attempt} attempts: {error}')
+            return
+
+        delay = min(RETRIEVAL_RETRY_INITIAL_DELAY * 2 ** (attempt - 1), RETRIEVAL_RETRY_MAX_DELAY)
+        delay = random.uniform(delay / 2, delay)
+
+        retry = json.dumps({"event_type": event_type, "event_data": {**event_data, RETRY_ATTEMPT_FIELD: attempt}})
+        self.redis_client.zadd(RETRY_SCHEDULE_KEY, {retry: time.time() + delay})
+        gitlab_retries.labels(error.endpoint, "scheduled").inc()
+        logging.warning(f'Retry {attempt} of {RETRIEVAL_MAX_ATTEMPTS} for {event_type} event in {delay:.1f}s: {error}')
+
+    # Moves retries that are due back to the input stream, and shortens
+    # the next blocking read so that the next retry is not delayed. The
+    # schedule is read with one pipeline, so polls without due retries
+    # make a single round trip, and due retries are moved with two more.
+    def before_poll(self):
+        now = time.time()
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.zrangebyscore(RETRY_SCHEDULE_KEY, 0, now)
+        pipeline.zrangebyscore(RETRY_SCHEDULE_KEY, f"({now}", "+inf", start=0, num=1, withscores=True)
+        pipeline.zcard(RETRY_SCHEDULE_KEY)
+        due_retries, next_retry, pending = pipeline.execute()
+
+        if due_retries:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for retry in due_retries:
+                pipeline.zrem(RETRY_SCHEDULE_KEY, retry)
+            removed = pipeline.execute()
+
+            # Only the replica that removes a retry adds it to the stream
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for retry, was_removed in zip(due_retries, removed):
+                if was_removed:
+                    retry = json.loads(retry)
+                    pipeline.xadd(self.input_stream_name, {retry["event_type"]: json.dumps(retry["event_data"])})
+            pipeline.execute()
+            pending -= sum(removed)
+
+        self.poll_block_ms = 10000
+        if next_retry:
+            self.poll_block_ms = max(1, min(self.poll_block_ms, int((next_retry[0][1] - now) * 1000)))
+        pending_retries.set(pending)
+
+    # Forwards the object of the event built from its payload, if the
+    # payload has every field read by classification and notification.
+    # Returns whether it did.
+    def _forward_sufficient_payload(self, event_type, event_data):
+        gitlab_object = object_from_payload(event_type, event_data, self.gitlab_client.url)
+        if gitlab_object is None:
+            return False
+
+        fetches_avoided.labels(event_type).inc()
+        self.events_processed.inc()
+        self.push_event_to_queue(event_type, gitlab_object, stream_name="retrieval")
+        return True
+
+    # Drops cached objects changed by an event, on all replicas
+    def _invalidate_cached_objects(self, event_type, event_data):
+        if event_type == UserEvent.USER_RENAME.value:
+            self.object_cache.invalidate("user", event_data["user_id"])
+        elif event_type in [ProjectEvent.PROJECT_RENAME.value, ProjectEvent.PROJECT_TRANSFER.value]:
+            self.object_cache.invalidate("project", event_data["project_id"])
+        elif event_type == GroupEvent.GROUP_RENAME.value:
+            # The paths of all projects in the group change
+            self.object_cache.invalidate("project")
+
+    # Objects an event is about have just changed, so they are always
+    # downloaded again when refresh is set.
+    def _get_project(self, project_id, refresh=False):
+        if refresh:
+            project = self._get_from_gitlab(self.gitlab_client.projects.get, project_id)
+            self.object_cache.set("project", project_id, project.attributes)
+            return project
+
+        attributes = self._get_cached_attributes("project", project_id, f"/projects/{project_id}")
+        return Project(self.gitlab_client.projects, attributes)
+
+    def _get_user(self, user_id, refresh=False):
+        if refresh:
+            user = self._get_from_gitlab(self.gitlab_client.users.get, user_id)
+            self.object_cache.set("user", user_id, user.attributes)
+            return user
+
+        attributes = self._get_cached_attributes("user", user_id, f"/users/{user_id}")
+        return User(self.gitlab_client.users, attributes)
+
+    def _get_issue(self, project, issue_iid, refresh=False):
+        key = f"{project.id}:{issue_iid}"
+        if refresh:
+            issue = self._get_from_gitlab(project.issues.get, issue_iid)
+            self.object_cache.set("issue", key, issue.attributes)
+            return issue
+
+        attributes = self._get_cached_attributes("issue", key, f"/projects/{project.id}/issues/{issue_iid}")
+        return ProjectIssue(project.issues, attributes)
 
     def process_event(self, event_type, event_data):
         with self.event_processing_time.time():
 
             try:
+                self._invalidate_cached_objects(event_type, event_data)
+
+                if self._forward_sufficient_payload(event_type, event_data):
+                    return
+
                 # Determine how to retrieve data based on event type
                 if event_type in [e.value for e in UserEvent]:
                     gitlab_object = self._process_user_event(event_data)
@@ -78,10 +347,9 @@ class GitlabRetrievalProcessor(EventProcessor):
                 elif event_type in [e.value for e in GroupEvent]:
                     gitlab_object = self._process_group_event(event_data)
                 elif event_type in [e.value for e in SnippetEvent]:
-                    gitlab_objects = self._process_snippet_event(event_data)
+                    for gitlab_objects in self._process_snippet_event(event_data):
+                        self.push_events_to_queue(event_type, gitlab_objects, stream_name="retrieval")
                     self.events_processed.inc()
-                    for gitlab_object in gitlab_objects:
-                        self.push_event_to_queue(event_type, gitlab_object, stream_name="retrieval")
                     return
                 else:
                     logging.info(f"{self.__class__.__name__}: event {event_type} received")
@@ -90,36 +358,103 @@ class GitlabRetrievalProcessor(EventProcessor):
                 if gitlab_object:
                     self.events_processed.inc()
                     self.push_event_to_queue(event_type, gitlab_object, stream_name="retrieval")
-            
+
+            except TransientRetrievalError as e:
+                self._schedule_retry(event_type, event_data, e)
+
             except Exception as e:
                 logging.warning(f'Unable to retrieve object. Error: {e}')
                 return
 
     def _process_user_event(self, event_data):
-        return self._retry_with_exponential_backoff(self.gitlab_client.users.get, event_data["user_id"])
+        return self._get_user(event_data["user_id"], refresh=True)
 
     def _process_project_event(self, event_data):
-        return self._retry_with_exponential_backoff(self.gitlab_client.projects.get, event_data["project_id"])
+        return self._get_project(event_data["project_id"], refresh=True)
 
     def _process_issue_event(self, event_data):
-        project = self._retry_with_exponential_backoff(self.gitlab_client.projects.get, event_data["object_attributes"]["project_id"])
-        return project.issues.get(event_data["object_attributes"]["id"])
+        project = self._get_project(event_data["object_attributes"]["project_id"])
+        return self._get_issue(project, event_data["object_attributes"]["iid"], refresh=True)
 
     def _process_issue_note_event(self, event_data):
-        project = self._retry_with_exponential_backoff(self.gitlab_client.projects.get(event_data["project_id"]))
-        issue = self._retry_with_exponential_backoff(project.issues.get(event_data["issue"]["id"]))
-        return self._retry_with_exponential_backoff(issue.notes.get(event_data["object_attributes"]["id"]))
+        project = self._get_project(event_data["project_id"])
+        issue = self._get_issue(project, event_data["issue"]["iid"])
+        return self._get_from_gitlab(issue.notes.get, event_data["object_attributes"]["id"])
 
     def _process_group_event(self, event_data):
-        return self._retry_with_exponential_backoff(self.gitlab_client.groups.get(event_data["group_id"]))
+        return self._get_from_gitlab(self.gitlab_client.groups.get, event_data["group_id"])
 
+    # Streams the public snippets created in the last SNIPPET_RECHECK_DAYS,
+    # page by page, and yields the ones with non-verified authors in
+    # batches of SNIPPET_BATCH_SIZE. The public snippets API can neither
+    # filter nor order snippets by update time, so recent snippets are
+    # listed on every check, and the ones edited since they were checked
+    # are checked again. GitLab versions that do not support
+    # created_after return all snippets, the older ones are skipped.
+    #
+    # The update time of the snippets of each batch is recorded once the
+    # batch has been pushed, so that a check retried after a failure skips
+    # the batches already pushed instead of sending them again. Records
+    # of snippets no longer listed are removed once all batches have been
+    # consumed.
     def _process_snippet_event(self, event_data):
-        # Retrieve all snippets, and filter out non-verified snippets
-        public_snippets = self._retry_with_exponential_backoff(lambda: self.gitlab_client.snippets.public())
+        recheck_after = datetime.now(timezone.utc) - timedelta(days=SNIPPET_RECHECK_DAYS)
+        checked = {
+            int(snippet_id): updated_at.decode("utf-8")
+            for snippet_id, updated_at in self.redis_client.hgetall(SNIPPET_CHECKED_KEY).items()
+        }
+
+        public_snippets = self._get_from_gitlab(
+            self.gitlab_client.snippets.public,
+            iterator=True,
+            per_page=100,
+            created_after=recheck_after.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        )
+
+        # Verification decisions per author ID, for the length of the scan
+        author_decisions = {}
+
+        listed_ids = set()
+        batch = []
+        with ThreadPoolExecutor(max_workers=SNIPPET_AUTHOR_CONCURRENCY) as pool:
+            for snippet in public_snippets:
+                if datetime.fromisoformat(snippet.created_at.replace("Z", "+00:00")) < recheck_after:
+                    continue
+                listed_ids.add(snippet.id)
+                if checked.get(snippet.id) == snippet.updated_at:
+                    continue
+
+                batch.append(snippet)
+                if len(batch) >= SNIPPET_BATCH_SIZE:
+                    yield self._filter_non_verified_snippets(batch, author_decisions, pool)
+                    self._mark_snippets_checked(batch)
+                    batch = []
+
+            if batch:
+                yield self._filter_non_verified_snippets(batch, author_decisions, pool)
+                self._mark_snippets_checked(batch)
+
+        logging.debug(f"Verified {len(author_decisions)} distinct snippet authors")
+
+        unlisted_ids = checked.keys() - listed_ids
+        if unlisted_ids:
+            self.redis_client.hdel(SNIPPET_CHECKED_KEY, *unlisted_ids)
+
+    def _mark_snippets_checked(self, snippets):
+        self.redis_client.hset(
+            SNIPPET_CHECKED_KEY, mapping={snippet.id: snippet.updated_at for snippet in snippets}
+        )
+
+    # Each distinct author of a batch is verified once, and authors not
+    # seen before in this scan are verified concurrently.
+    def _filter_non_verified_snippets(self, snippets, author_decisions, pool):
+        new_author_ids = list({snippet.author['id'] for snippet in snippets} - author_decisions.keys())
+        for author_id, verified in zip(new_author_ids, pool.map(self._is_author_verified, new_author_ids)):
+            author_decisions[author_id] = verified
 
         non_verified_snippets = []
-        for snippet in public_snippets:
-            if not self._is_snippet_author_verified(snippet):
+        for snippet in snippets:
+            if not author_decisions[snippet.author['id']]:
                 non_verified_snippets.append(snippet)
                 logging.debug(f"Added snippet {snippet.id} to non_verified_snippets")
             else:
@@ -127,12 +462,15 @@ class GitlabRetrievalProcessor(EventProcessor):
 
         return non_verified_snippets
 
-    def _is_snippet_author_verified(self, snippet):
+    def _is_author_verified(self, author_id):
         # Check if the author of the snippet is verified.
         try:
-            author = self._retry_with_exponential_backoff(self.gitlab_client.users.get, snippet.author['id'])
-            response = requests.post("http://localhost:8001/verify_email", json={'email': author.email}, timeout=10)
+            author = self._get_user(author_id)
+            response = requests.post(f"{VERIFICATION_URL}/verify_email", json={'email': author.email}, timeout=10)
             response_data = json.loads(response.text)
+        except TransientRetrievalError:
+            # The whole snippet check is retried later
+            raise
         except Exception as e:
             logging.error(f"Error verifying author: {e}")
             return False
@@ -142,30 +480,329 @@ class GitlabRetrievalProcessor(EventProcessor):
         else:
             return True
 
-    def push_event_to_queue(self, event_type, data, stream_name=None):
-        # We use a custom push_event_to_queue function in this class instead of
-        # EventProcessor's implementation so that we can use GitLab's .to_json()
-        # function to serialise the data, instead of json.dumps()
-        serialised_data = data.to_json()
+    # We use a custom push_event_to_queue function in this class instead of
+    # EventProcessor's implementation so that we can serialise the
+    # attributes of python-gitlab objects. Objects retrieved by the async
+    # and GraphQL clients are plain dictionaries. Only the fields read by
+    # classification and notification are serialised.
+    def _serialise(self, event_type, data):
+        attributes = data if isinstance(data, dict) else data.attributes
+        return serialise_object(event_type, attributes)
 
+    def push_event_to_queue(self, event_type, data, stream_name=None):
         try:
-            self.redis_client.xadd(stream_name, {event_type: serialised_data})
+            self.redis_client.xadd(stream_name, {event_type: self._serialise(event_type, data)})
             logging.debug(f"{self.__class__.__name__}: added data to {stream_name}")
         except Exception as e:
             logging.error(f"Error adding data to queue {stream_name}: {e}")
 
+    # Adds several objects to the stream in one round trip
+    def push_events_to_queue(self, event_type, objects, stream_name=None):
+        if not objects:
+            return
+
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for data in objects:
+                pipeline.xadd(stream_name, {event_type: self._serialise(event_type, data)})
+            pipeline.execute()
+            logging.debug(f"{self.__class__.__name__}: added {len(objects)} objects to {stream_name}")
+        except Exception as e:
+            logging.error(f"Error adding data to queue {stream_name}: {e}")
+
     def run(self, testing=False):
+        if not testing:
+            self.object_cache.start_invalidation_listener()
         self.poll_and_process_event(testing=testing)
 
+
+# AsyncGitlabRetrievalProcessor class retrieves objects with the async
+# GitLab client. Up to `concurrency` events are processed at the same
+# time, and each event only requests the object it is about, so slow
+# GitLab responses do not hold up other events. Snippet checks still use
+# the python-gitlab client, in a worker thread.
+#
+# The Redis client is synchronous, so its calls, for the object cache,
+# the retry schedule and the streams, run in worker threads too, and a
+# slow Redis does not block the event loop.
+class AsyncGitlabRetrievalProcessor(GitlabRetrievalProcessor):
+    def __init__(
+        self,
+        GITLAB_URL,
+        GITLAB_ACCESS_TOKEN,
+        redis_conn=None,
+        testing=False,
+        concurrency=20,
+        max_connections=20,
+        transport=None,
+    ):
+        super().__init__(GITLAB_URL, GITLAB_ACCESS_TOKEN, redis_conn=redis_conn, testing=testing)
+        self.concurrency = concurrency
+        self.async_client_options = {
+            "gitlab_url": GITLAB_URL,
+            "gitlab_access_token": GITLAB_ACCESS_TOKEN,
+            "max_connections": max_connections,
+            "max_keepalive_connections": max_connections,
+            "transport": transport,
+        }
+
+    async def _get_from_gitlab_async(self, func, *args, endpoint=None):
+        endpoint = endpoint or _endpoint_name(func)
+        try:
+            return await func(*args)
+        except (gitlab.exceptions.GitlabGetError, gitlab.exceptions.GitlabHttpError) as e:
+            logging.warning(f'Error retrieving from GitLab with function {endpoint}: {e}')
+            if e.response_code == 404:
+                raise
+            raise TransientRetrievalError(endpoint, e) from e
+
+    # Objects are requested with the ETag of their cached copy, also when
+    # refresh is set, as the async client reads the response headers.
+    async def _get_cached_async(self, object_type, key, path, refresh=False):
+        entry = await asyncio.to_thread(self.object_cache.get_entry, object_type, key)
+        if entry is not None and not refresh and self.object_cache.is_fresh(entry):
+            return entry["attributes"]
+
+        etag = entry["etag"] if entry is not None else None
+        attributes, new_etag = await self._get_from_gitlab_async(
+            self.async_client.get_conditional, path, etag, endpoint=f"{object_type}.get"
+        )
+        if attributes is None:
+            conditional_requests.labels(object_type, "not_modified").inc()
+            attributes = entry["attributes"]
+        elif etag:
+            conditional_requests.labels(object_type, "modified").inc()
+
+        await asyncio.to_thread(self.object_cache.set, object_type, key, attributes, etag=new_etag)
+        return attributes
+
+    # Objects are requested by path, so unlike python-gitlab objects,
+    # issues and notes are retrieved without their project and issue.
+    async def _retrieve_async(self, event_type, event_data):
+        client = self.async_client
+
+        if event_type in [e.value for e in UserEvent]:
+            user_id = event_data["user_id"]
+            return await self._get_cached_async("user", user_id, f"/users/{user_id}", refresh=True)
+
+        elif event_type in [e.value for e in ProjectEvent]:
+            project_id = event_data["project_id"]
+            return await self._get_cached_async("project", project_id, f"/projects/{project_id}", refresh=True)
+
+        elif event_type in [e.value for e in GroupEvent]:
+            return await self._get_from_gitlab_async(client.get_group, event_data["group_id"])
+
+        elif event_type in [e.value for e in IssueEvent]:
+            project_id = event_data["object_attributes"]["project_id"]
+            issue_iid = event_data["object_attributes"]["iid"]
+            return await self._get_cached_async(
+                "issue", f"{project_id}:{issue_iid}", f"/projects/{project_id}/issues/{issue_iid}", refresh=True
+            )
+
+        elif event_type in [e.value for e in IssueNoteEvent]:
+            return await self._get_from_gitlab_async(
+                client.get_issue_note, event_data["project_id"], event_data["issue"]["iid"], event_data["object_attributes"]["id"]
+            )
+
+        logging.info(f"{self.__class__.__name__}: event {event_type} received")
+        return None
+
+    async def process_event_async(self, event_type, event_data):
+        if event_type in [e.value for e in SnippetEvent]:
+            await asyncio.to_thread(self.process_event, event_type, event_data)
+            return
+
+        with self.event_processing_time.time():
+            try:
+                await asyncio.to_thread(self._invalidate_cached_objects, event_type, event_data)
+                if await asyncio.to_thread(self._forward_sufficient_payload, event_type, event_data):
+                    return
+                gitlab_object = await self._retrieve_async(event_type, event_data)
+            except TransientRetrievalError as e:
+                await asyncio.to_thread(self._schedule_retry, event_type, event_data, e)
+                return
+            except Exception as e:
+                logging.warning(f'Unable to retrieve object. Error: {e}')
+                return
+
+            if gitlab_object:
+                self.events_processed.inc()
+                await asyncio.to_thread(
+                    self.push_event_to_queue, event_type, gitlab_object, stream_name="retrieval"
+                )
+
+    async def _process_message(self, message_id, message):
+        for key, value in message.items():
+            await self.process_event_async(key.decode('utf-8'), json.loads(value.decode('utf-8')))
+        await asyncio.to_thread(self.redis_client.xdel, self.input_stream_name, message_id)
+
+    # Reads events after the last one read instead of from the start of
+    # the stream, so that events still being processed are not read again.
+    # Events are deleted from the stream once they are processed.
+    async def poll_and_process_events_async(self, testing=False):
+        self.async_client = AsyncGitlabClient(**self.async_client_options)
+        last_id = "0"
+        tasks = set()
+
+        try:
+            while True:
+                if len(tasks) >= self.concurrency:
+                    _, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                await asyncio.to_thread(self.before_poll)
+                messages = await asyncio.to_thread(
+                    self.redis_client.xread,
+                    {self.input_stream_name: last_id},
+                    block=min(self.poll_block_ms, 1000),
+                    count=self.concurrency - len(tasks),
+                )
+
+                for message_id, message in messages[0][1] if messages else []:
+                    last_id = message_id
+                    tasks.add(asyncio.ensure_future(self._process_message(message_id, message)))
+
+                tasks = {task for task in tasks if not task.done()}
+
+                if testing and messages:
+                    await asyncio.gather(*tasks)
+                    return
+        finally:
+            await self.async_client.aclose()
+
+    def run(self, testing=False):
+        if not testing:
+            self.object_cache.start_invalidation_listener()
+        asyncio.run(self.poll_and_process_events_async(testing=testing))
+
+
+# GraphQLGitlabRetrievalProcessor class reads up to `batch_size` events
+# at once and retrieves the issues and issue notes of all of them with a
+# single GraphQL query, instead of up to three REST requests per event.
+# Other events, and events whose object is missing from the GraphQL
+# response, are processed one by one with the REST API. If the query
+# fails, the whole batch falls back to REST.
+class GraphQLGitlabRetrievalProcessor(GitlabRetrievalProcessor):
+    def __init__(self, GITLAB_URL, GITLAB_ACCESS_TOKEN, redis_conn=None, testing=False, batch_size=50):
+        super().__init__(GITLAB_URL, GITLAB_ACCESS_TOKEN, redis_conn=redis_conn, testing=testing)
+        self.batch_size = batch_size
+        self.graphql_client = GitlabGraphQLClient(self.gitlab_client)
+
+    def process_events_batch(self, events):
+        issue_events = []
+        note_events = []
+        for event_type, event_data in events:
+            if event_type not in [e.value for e in IssueEvent] + [e.value for e in IssueNoteEvent]:
+                self.process_event(event_type, event_data)
+            elif self._forward_sufficient_payload(event_type, event_data):
+                continue
+            elif event_type in [e.value for e in IssueEvent]:
+                issue_events.append((event_type, event_data))
+            else:
+                note_events.append((event_type, event_data))
+
+        if not issue_events and not note_events:
+            return
+
+        start = time.perf_counter()
+        try:
+            issues, notes = self.graphql_client.get_issues_and_notes(
+                issue_ids=[event_data["object_attributes"]["id"] for _, event_data in issue_events],
+                note_ids=[event_data["object_attributes"]["id"] for _, event_data in note_events],
+            )
+        except Exception as e:
+            logging.warning(f'GraphQL query failed, falling back to REST. Error: {e}')
+            issues, notes = {}, {}
+        duration = time.perf_counter() - start
+
+        for event_type, event_data in issue_events:
+            issue = issues.get(event_data["object_attributes"]["id"])
+            if issue is None:
+                graphql_objects.labels("issue", "fallback").inc()
+                self.process_event(event_type, event_data)
+                continue
+
+            graphql_objects.labels("issue", "batched").inc()
+            self.object_cache.set("issue", f"{issue['project_id']}:{issue['iid']}", issue)
+            self.event_processing_time.observe(duration)
+            self.events_processed.inc()
+            self.push_event_to_queue(event_type, issue, stream_name="retrieval")
+
+        for event_type, event_data in note_events:
+            note = notes.get(event_data["object_attributes"]["id"])
+            if note is None:
+                graphql_objects.labels("note", "fallback").inc()
+                self.process_event(event_type, event_data)
+                continue
+
+            graphql_objects.labels("note", "batched").inc()
+            # Attributes of the parent objects, as added by python-gitlab
+            note.update({
+                "noteable_id": event_data["object_attributes"]["noteable_id"],
+                "noteable_iid": event_data["issue"]["iid"],
+                "project_id": event_data["project_id"],
+                "issue_iid": event_data["issue"]["iid"],
+            })
+            self.event_processing_time.observe(duration)
+            self.events_processed.inc()
+            self.push_event_to_queue(event_type, note, stream_name="retrieval")
+
+    def poll_and_process_events_batched(self, testing=False):
+        while True:
+            self.before_poll()
+            messages = self.redis_client.xread(
+                {self.input_stream_name: '0'}, block=self.poll_block_ms, count=self.batch_size
+            )
+            if not messages:
+                continue
+
+            message_ids = []
+            events = []
+            for message_id, message in messages[0][1]:
+                message_ids.append(message_id)
+                for key, value in message.items():
+                    events.append((key.decode('utf-8'), json.loads(value.decode('utf-8'))))
+
+            self.process_events_batch(events)
+            self.redis_client.xdel(self.input_stream_name, *message_ids)
+
+            if testing:
+                return
+
+    def run(self, testing=False):
+        if not testing:
+            self.object_cache.start_invalidation_listener()
+        self.poll_and_process_events_batched(testing=testing)
+
+
 def main(
     GITLAB_URL=os.getenv("GITLAB_URL"),
     GITLAB_ACCESS_TOKEN=os.getenv("GITLAB_ACCESS_TOKEN"),
     redis_conn=None,
     testing=False,
+    backend=os.getenv("RETRIEVAL_BACKEND", "sync"),
 ):
-    processor = GitlabRetrievalProcessor(
-        GITLAB_URL, GITLAB_ACCESS_TOKEN, redis_conn=redis_conn, testing=testing
-    )
+    if backend == "async":
+        processor = AsyncGitlabRetrievalProcessor(
+            GITLAB_URL,
+            GITLAB_ACCESS_TOKEN,
+            redis_conn=redis_conn,
+            testing=testing,
+            concurrency=int(os.getenv("RETRIEVAL_CONCURRENCY", 20)),
+            max_connections=int(os.getenv("GITLAB_MAX_CONNECTIONS", 20)),
+        )
+    elif backend == "graphql":
+        processor = GraphQLGitlabRetrievalProcessor(
+            GITLAB_URL,
+            GITLAB_ACCESS_TOKEN,
+            redis_conn=redis_conn,
+            testing=testing,
+            batch_size=int(os.getenv("RETRIEVAL_GRAPHQL_BATCH_SIZE", 50)),
+        )
+    else:
+        processor = GitlabRetrievalProcessor(
+            GITLAB_URL, GITLAB_ACCESS_TOKEN, redis_conn=redis_conn, testing=testing
+        )
     processor.run(testing=testing)
 
 
@@ -0,0 +1,64 @@
+import time
+
+from prometheus_client import Counter
+
+from common.cache import TieredCache
+
+OBJECT_TYPES = ("project", "user", "issue")
+
+object_cache_requests = Counter(
+    "retrieval_service_object_cache_requests_total",
+    "Number of GitLab object cache lookups",
+    ["object_type", "result"],
+)
+
+
+# GitlabObjectCache class caches the attributes of retrieved GitLab
+# projects, users and issues. Each object type has its own local LRU
+# fronting a Redis cache shared by all retrieval replicas, so a whole
+# type can be invalidated at once, e.g. all projects when a group is
+# renamed. Lookups are counted per object type and per tier.
+#
+# Cached objects are fresh for `ttl` seconds. Stale objects are kept for
+# up to `validator_ttl` seconds with their ETag, so that they can be
+# revalidated with a conditional request instead of downloaded again.
+class GitlabObjectCache:
+    def __init__(self, redis_client=None, max_size=1024, ttl=300, validator_ttl=86400):
+        self.ttl = ttl
+        self.caches = {
+            object_type: TieredCache(
+                f"retrieval_{object_type}_v2",
+                redis_client=redis_client,
+                max_size=max_size,
+                ttl=max(ttl, validator_ttl),
+            )
+            for object_type in OBJECT_TYPES
+        }
+
+    # Returns the cached entry of an object, fresh or not: a dictionary
+    # with the object's attributes, its ETag and the time it was fetched.
+    def get_entry(self, object_type, key):
+        entry, tier = self.caches[object_type].get_with_tier(str(key))
+        object_cache_requests.labels(object_type, f"{tier}_hit" if tier else "miss").inc()
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry["fetched_at"] < self.ttl
+
+    def get(self, object_type, key):
+        entry = self.get_entry(object_type, key)
+        if entry is None or not self.is_fresh(entry):
+            return None
+        return entry["attributes"]
+
+    def set(self, object_type, key, attributes, etag=None):
+        self.caches[object_type].set(
+            str(key), {"attributes": attributes, "etag": etag, "fetched_at": time.time()}
+        )
+
+    def invalidate(self, object_type, key=None):
+        self.caches[object_type].invalidate(None if key is None else str(key))
+
+    def start_invalidation_listener(self):
+        for cache in self.caches.values():
+            cache.start_invalidation_listener()
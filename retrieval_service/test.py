@@ -1,15 +1,49 @@
 import unittest
 from unittest.mock import patch, MagicMock
+from datetime import datetime, timedelta, timezone
 import json
 import logging
-from retrieval_service.main import main
+import threading
+from retrieval_service.main import (
+    main,
+    AsyncGitlabRetrievalProcessor,
+    GitlabRetrievalProcessor,
+    GraphQLGitlabRetrievalProcessor,
+    RETRY_SCHEDULE_KEY,
+    TransientRetrievalError,
+)
 import fakeredis
-from common.constants import UserEvent
+import gitlab
+import httpx
+import requests
+from notification_service.main import format_message
+from common.constants import UserEvent, IssueNoteEvent, IssueEvent, ProjectEvent, SnippetEvent, USER_FIELDS
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+def gitlab_response(attributes, etag=None):
+    response = MagicMock()
+    response.json.return_value = attributes
+    response.headers = {"ETag": etag} if etag else {}
+    return response
+
+
+def rest_time_ago(**delta):
+    return (datetime.now(timezone.utc) - timedelta(**delta)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def make_snippet(snippet_id, author_id=1, **created_ago):
+    snippet = MagicMock()
+    snippet.id = snippet_id
+    snippet.created_at = rest_time_ago(**created_ago)
+    snippet.updated_at = snippet.created_at
+    snippet.author = {"id": author_id}
+    snippet.attributes = {"id": snippet_id}
+    return snippet
+
+
 class TestService(unittest.TestCase):
     @patch("gitlab.Gitlab")
     def test_retrieve_gitlab_objects(self, mock_gitlab):
@@ -19,7 +53,7 @@ class TestService(unittest.TestCase):
         mock_gitlab.return_value = mock_gl
 
         mock_user = MagicMock()
-        mock_user.to_json.return_value = json.dumps({"user_id": "123"})
+        mock_user.attributes = {"id": 123, "username": "test_user", "theme_id": 1}
         mock_gl.users.get.return_value = mock_user
 
         redis_conn.xadd("verification", {UserEvent.USER_CREATE.value: json.dumps({"user_id": "123"})})
@@ -49,13 +83,456 @@ class TestService(unittest.TestCase):
                     mock_gitlab.assert_called_once_with("https://gitlab.com", private_token="token")
                     mock_gl.users.get.assert_called_once_with("123")
 
+                    # Only the fields read by classification and notification are kept
                     self.assertEqual(
-                        message[1][key],
-                        json.dumps({"user_id": "123"}).encode("utf-8"),
+                        decoded_value,
+                        {"_v": 2, **dict.fromkeys(USER_FIELDS), "id": 123, "username": "test_user"},
                     )
 
                     print("Clearing all messages from output stream")
                     redis_conn.xtrim('retrieval', maxlen=0)
 
+    @patch("gitlab.Gitlab")
+    def test_projects_are_cached_until_renamed(self, mock_gitlab):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_gl = MagicMock()
+        mock_gitlab.return_value = mock_gl
+
+        mock_project = MagicMock()
+        mock_project.id = 14
+        mock_project.attributes = {"id": 14, "name": "project"}
+        mock_gl.projects.get.return_value = mock_project
+        mock_gl.http_request.return_value = gitlab_response(mock_project.attributes)
+        # Issues of cached projects are retrieved through the client's HTTP API
+        mock_gl.projects.gitlab.http_get.return_value = {"id": 301, "iid": 23, "project_id": 14}
+
+        with open("test/json_data/issue_open.json", "r") as file:
+            issue_event = json.load(file)
+
+        processor = GitlabRetrievalProcessor("https://gitlab.com", "token", redis_conn=redis_conn)
+        processor.process_event(IssueEvent.ISSUE_OPEN.value, issue_event)
+        processor.object_cache.caches["project"].local.clear()
+        processor.process_event(IssueEvent.ISSUE_UPDATE.value, issue_event)
+
+        mock_gl.http_request.assert_called_once_with("get", "/projects/14", extra_headers=None)
+        mock_gl.projects.gitlab.http_get.assert_called_with("/projects/14/issues/23")
+
+        processor.process_event(ProjectEvent.PROJECT_RENAME.value, {"project_id": 14})
+        processor.process_event(IssueEvent.ISSUE_UPDATE.value, issue_event)
+
+        mock_gl.projects.get.assert_called_once_with(14)
+        self.assertEqual(mock_gl.http_request.call_count, 1)
+        self.assertEqual(redis_conn.xlen("retrieval"), 4)
+
+    @patch("gitlab.Gitlab")
+    def test_stale_objects_are_revalidated(self, mock_gitlab):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_gl = MagicMock()
+        mock_gitlab.return_value = mock_gl
+        mock_gl.http_request.return_value = gitlab_response({"id": 14, "name": "project"}, etag='W/"1"')
+
+        processor = GitlabRetrievalProcessor("https://gitlab.com", "token", redis_conn=redis_conn)
+        processor.object_cache.ttl = 0
+        processor._get_project(14)
+
+        mock_gl.http_request.side_effect = gitlab.exceptions.GitlabHttpError(response_code=304)
+        project = processor._get_project(14)
+
+        mock_gl.http_request.assert_called_with("get", "/projects/14", extra_headers={"If-None-Match": 'W/"1"'})
+        self.assertEqual(project.name, "project")
+        self.assertEqual(processor.object_cache.get_entry("project", 14)["etag"], 'W/"1"')
+
+    @patch("retrieval_service.main.requests.post")
+    @patch("gitlab.Gitlab")
+    def test_snippet_check_processes_new_and_edited_snippets(self, mock_gitlab, mock_post):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_gl = MagicMock()
+        mock_gitlab.return_value = mock_gl
+        mock_gl.http_request.return_value = gitlab_response({"id": 1, "email": "author@example.com"})
+        mock_post.return_value.text = json.dumps({"domain_verified": False, "user_verified": False})
+
+        snippets = [make_snippet(2, hours=2), make_snippet(1, hours=3)]
+        mock_gl.snippets.public.return_value = snippets
+
+        processor = GitlabRetrievalProcessor("https://gitlab.com", "token", redis_conn=redis_conn)
+        processor.process_event(SnippetEvent.SNIPPET_CHECK.value, {})
+
+        self.assertEqual(redis_conn.xlen("retrieval"), 2)
+        self.assertEqual(mock_post.call_args.args[0], "http://localhost:8001/verify_email")
+
+        # Only the new snippet and the edited one are checked again, and
+        # snippets too old to be listed are forgotten
+        edited = make_snippet(2, hours=2)
+        edited.updated_at = rest_time_ago(hours=1)
+        mock_gl.snippets.public.return_value = [make_snippet(3, hours=1), edited, make_snippet(1, days=30)]
+        processor.process_event(SnippetEvent.SNIPPET_CHECK.value, {})
+
+        self.assertEqual(
+            [json.loads(message[b"snippet_check"])["id"] for _, message in redis_conn.xrange("retrieval")],
+            [2, 1, 3, 2],
+        )
+        self.assertIn("created_after", mock_gl.snippets.public.call_args.kwargs)
+        self.assertEqual(set(redis_conn.hkeys("retrieval:snippet_check:updated_at")), {b"2", b"3"})
+
+    @patch("retrieval_service.main.SNIPPET_BATCH_SIZE", 1)
+    @patch("retrieval_service.main.requests.post")
+    @patch("gitlab.Gitlab")
+    def test_retried_snippet_check_skips_pushed_batches(self, mock_gitlab, mock_post):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_gl = MagicMock()
+        mock_gitlab.return_value = mock_gl
+        mock_gl.http_request.return_value = gitlab_response({"id": 1, "email": "author@example.com"})
+        mock_post.return_value.text = json.dumps({"domain_verified": False, "user_verified": False})
+
+        snippets = [make_snippet(snippet_id, hours=snippet_id) for snippet_id in [1, 2, 3]]
+
+        # The next page of snippets fails after the first one
+        def failing_pages(**filters):
+            yield snippets[0]
+            raise TransientRetrievalError("/snippets/public", "503")
+        mock_gl.snippets.public.side_effect = failing_pages
+
+        processor = GitlabRetrievalProcessor("https://gitlab.com", "token", redis_conn=redis_conn)
+        processor.process_event(SnippetEvent.SNIPPET_CHECK.value, {})
+
+        self.assertEqual(redis_conn.xlen("retrieval"), 1)
+        self.assertEqual(redis_conn.zcard(RETRY_SCHEDULE_KEY), 1)
+
+        mock_gl.snippets.public.side_effect = None
+        mock_gl.snippets.public.return_value = snippets
+        processor.process_event(SnippetEvent.SNIPPET_CHECK.value, {})
+
+        self.assertEqual(
+            [json.loads(message[b"snippet_check"])["id"] for _, message in redis_conn.xrange("retrieval")],
+            [1, 2, 3],
+        )
+
+    @patch("retrieval_service.main.requests.post")
+    @patch("gitlab.Gitlab")
+    def test_snippet_authors_are_verified_once(self, mock_gitlab, mock_post):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_gl = MagicMock()
+        mock_gitlab.return_value = mock_gl
+
+        def get_user(verb, path, extra_headers=None):
+            user_id = int(path.rsplit("/", 1)[1])
+            return gitlab_response({"id": user_id, "email": f"author{user_id}@example.com"})
+        mock_gl.http_request.side_effect = get_user
+
+        def verify_email(url, json, timeout):
+            response = MagicMock()
+            response.text = '{"domain_verified": %s}' % ("true" if json["email"] == "author1@example.com" else "false")
+            return response
+        mock_post.side_effect = verify_email
+
+        snippets = [make_snippet(snippet_id, author_id=snippet_id % 2 + 1, hours=1) for snippet_id in range(1, 7)]
+        mock_gl.snippets.public.return_value = snippets
+
+        processor = GitlabRetrievalProcessor("https://gitlab.com", "token", redis_conn=redis_conn)
+        processor.process_event(SnippetEvent.SNIPPET_CHECK.value, {})
+
+        self.assertEqual(mock_gl.http_request.call_count, 2)
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(
+            [json.loads(message[b"snippet_check"])["id"] for _, message in redis_conn.xrange("retrieval")],
+            [1, 3, 5],
+        )
+
+    @patch("gitlab.Gitlab")
+    def test_sufficient_payloads_are_forwarded_without_fetching(self, mock_gitlab):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_gl = MagicMock()
+        mock_gl.url = "https://gitlab.com"
+        mock_gitlab.return_value = mock_gl
+
+        processor = GitlabRetrievalProcessor("https://gitlab.com", "token", redis_conn=redis_conn)
+
+        # Note hooks are triggered by the author of the note
+        with open("test/json_data/issue_note_create.json", "r") as file:
+            processor.process_event(IssueNoteEvent.ISSUE_NOTE_CREATE.value, json.load(file))
+
+        mock_gl.http_request.assert_not_called()
+        _, message = redis_conn.xrange("retrieval")[0]
+        self.assertEqual(
+            json.loads(message[IssueNoteEvent.ISSUE_NOTE_CREATE.value.encode("utf-8")]),
+            {
+                "_v": 2,
+                "id": 1241,
+                "project_id": 5,
+                "issue_iid": 17,
+                "body": "Hello world",
+                "created_at": "2015-05-17T17:06:40.000Z",
+                "author": {"name": "Administrator", "web_url": "https://gitlab.com/root"},
+            },
+        )
+
+        # The issue was opened by another user than the one in the hook,
+        # and system hook payloads lack most user attributes
+        mock_gl.http_request.return_value = gitlab_response({"id": 14})
+        mock_gl.projects.gitlab.http_get.return_value = {"id": 301, "iid": 23, "project_id": 14}
+        mock_gl.users.get.return_value.attributes = {"id": 58, "username": "new-exciting-name"}
+        with open("test/json_data/issue_open.json", "r") as file:
+            processor.process_event(IssueEvent.ISSUE_OPEN.value, json.load(file))
+        with open("test/json_data/user_rename.json", "r") as file:
+            processor.process_event(UserEvent.USER_RENAME.value, json.load(file))
+        mock_gl.projects.gitlab.http_get.assert_called_once_with("/projects/14/issues/23")
+        mock_gl.users.get.assert_called_once_with(58)
+        self.assertEqual(redis_conn.xlen("retrieval"), 3)
+
+    @patch("retrieval_service.main.time.sleep")
+    @patch("gitlab.Gitlab")
+    def test_transient_errors_are_retried_later(self, mock_gitlab, mock_sleep):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_gl = MagicMock()
+        mock_gitlab.return_value = mock_gl
+        mock_gl.users.get.side_effect = gitlab.exceptions.GitlabGetError("Bad gateway", response_code=502)
+
+        processor = GitlabRetrievalProcessor("https://gitlab.com", "token", redis_conn=redis_conn)
+        processor.process_event(UserEvent.USER_CREATE.value, {"user_id": "123"})
+
+        mock_sleep.assert_not_called()
+        self.assertEqual(mock_gl.users.get.call_count, 1)
+        self.assertEqual(redis_conn.zcard(RETRY_SCHEDULE_KEY), 1)
+
+        # The retry is added to the input stream again once it is due
+        processor.before_poll()
+        self.assertEqual(redis_conn.xlen("verification"), 0)
+        self.assertLessEqual(processor.poll_block_ms, 1000)
+
+        redis_conn.zadd(RETRY_SCHEDULE_KEY, {redis_conn.zrange(RETRY_SCHEDULE_KEY, 0, 0)[0]: 0})
+        processor.before_poll()
+        self.assertEqual(redis_conn.zcard(RETRY_SCHEDULE_KEY), 0)
+        _, message = redis_conn.xrange("verification")[0]
+        self.assertEqual(
+            json.loads(message[UserEvent.USER_CREATE.value.encode("utf-8")]),
+            {"user_id": "123", "_retrieval_attempt": 1},
+        )
+
+    @patch("gitlab.Gitlab")
+    def test_unreachable_gitlab_is_retried_later(self, mock_gitlab):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_gl = MagicMock()
+        mock_gitlab.return_value = mock_gl
+        mock_gl.users.get.side_effect = requests.exceptions.ConnectionError("Connection refused")
+        mock_gl.projects.get.side_effect = requests.exceptions.ReadTimeout("Read timed out")
+
+        processor = GitlabRetrievalProcessor("https://gitlab.com", "token", redis_conn=redis_conn)
+        processor.process_event(UserEvent.USER_CREATE.value, {"user_id": "123"})
+        processor.process_event(ProjectEvent.PROJECT_CREATE.value, {"project_id": "14"})
+
+        self.assertEqual(redis_conn.zcard(RETRY_SCHEDULE_KEY), 2)
+
+
+class TestAsyncRetrieval(unittest.TestCase):
+    @patch("gitlab.Gitlab")
+    def test_retrieve_gitlab_objects_concurrently(self, mock_gitlab):
+        redis_conn = fakeredis.FakeRedis()
+        requested_paths = []
+
+        def handler(request):
+            requested_paths.append(request.url.path)
+            if request.url.path == "/api/v4/users/123":
+                return httpx.Response(200, json={"id": 123, "username": "test_user"})
+            if request.url.path == "/api/v4/projects/5/issues/17/notes/1241":
+                return httpx.Response(200, json={"id": 1241, "body": "Hello world"})
+            return httpx.Response(200, json={})
+
+        with open("test/json_data/issue_note_create.json", "r") as file:
+            note_event = json.load(file)
+        # Triggered by another user than the author, so the note is retrieved
+        note_event["user"]["id"] = 2
+
+        redis_conn.xadd("verification", {UserEvent.USER_CREATE.value: json.dumps({"user_id": "123"})})
+        redis_conn.xadd("verification", {IssueNoteEvent.ISSUE_NOTE_CREATE.value: json.dumps(note_event)})
+
+        processor = AsyncGitlabRetrievalProcessor(
+            "https://gitlab.com",
+            "token",
+            redis_conn=redis_conn,
+            testing=True,
+            transport=httpx.MockTransport(handler),
+        )
+        processor.run(testing=True)
+
+        self.assertCountEqual(
+            requested_paths,
+            ["/api/v4/users/123", "/api/v4/projects/5/issues/17/notes/1241"],
+        )
+
+        outputs = {
+            key.decode("utf-8"): json.loads(value)
+            for _, message in redis_conn.xrange("retrieval")
+            for key, value in message.items()
+        }
+        self.assertEqual(
+            outputs[UserEvent.USER_CREATE.value],
+            {"_v": 2, **dict.fromkeys(USER_FIELDS), "id": 123, "username": "test_user"},
+        )
+        self.assertEqual(
+            outputs[IssueNoteEvent.ISSUE_NOTE_CREATE.value],
+            {
+                "_v": 2,
+                "id": 1241,
+                "project_id": 5,
+                "issue_iid": 17,
+                "body": "Hello world",
+                "created_at": None,
+                "author": {"name": None, "web_url": None},
+            },
+        )
+        self.assertEqual(redis_conn.xlen("verification"), 0)
+
+    @patch("gitlab.Gitlab")
+    def test_redis_is_not_called_from_the_event_loop(self, mock_gitlab):
+        redis_conn = fakeredis.FakeRedis()
+        redis_conn.xadd("verification", {UserEvent.USER_CREATE.value: json.dumps({"user_id": "123"})})
+
+        processor = AsyncGitlabRetrievalProcessor(
+            "https://gitlab.com",
+            "token",
+            redis_conn=redis_conn,
+            testing=True,
+            transport=httpx.MockTransport(lambda request: httpx.Response(200, json={"id": 123})),
+        )
+
+        # The event loop runs in the main thread
+        loop_calls = []
+
+        def record_loop_calls(method):
+            def call(*args, **kwargs):
+                if threading.current_thread() is threading.main_thread():
+                    loop_calls.append(args[0] if args else method.__name__)
+                return method(*args, **kwargs)
+            return call
+
+        with patch.object(redis_conn, "execute_command", record_loop_calls(redis_conn.execute_command)), \
+                patch.object(redis_conn, "pipeline", record_loop_calls(redis_conn.pipeline)):
+            processor.run(testing=True)
+
+        self.assertEqual(loop_calls, [])
+        self.assertEqual(redis_conn.xlen("retrieval"), 1)
+        self.assertEqual(redis_conn.xlen("verification"), 0)
+
+
+class TestGraphQLRetrieval(unittest.TestCase):
+    @patch("gitlab.Gitlab")
+    def test_issues_and_notes_are_retrieved_in_one_query(self, mock_gitlab):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_gl = MagicMock()
+        mock_gl.url = "https://gitlab.com"
+        mock_gitlab.return_value = mock_gl
+
+        author = {
+            "id": "gid://gitlab/User/51",
+            "username": "author",
+            "name": "Author",
+            "state": "active",
+            "avatarUrl": None,
+            "webUrl": "https://gitlab.com/author",
+        }
+        mock_gl.http_post.return_value = {
+            "data": {
+                "issue_301": {
+                    "id": "gid://gitlab/Issue/301", "iid": "23", "projectId": 14,
+                    "title": "New API", "description": "Create new API", "state": "opened",
+                    "type": "ISSUE", "confidential": False, "discussionLocked": True,
+                    "createdAt": "2013-12-03T17:15:43Z", "updatedAt": "2013-12-03T17:15:43Z",
+                    "closedAt": None, "dueDate": None, "webUrl": "https://gitlab.com/issues/23",
+                    "upvotes": 0, "downvotes": 0, "userNotesCount": 1,
+                    "labels": {"nodes": [{"title": "API"}]}, "author": author,
+                },
+                # The note could not be resolved, it is retrieved with REST
+                "note_1241": None,
+            },
+        }
+        mock_gl.http_request.side_effect = lambda verb, path, extra_headers=None: gitlab_response(
+            {"id": 92, "iid": 17, "project_id": 5} if "/issues/" in path else {"id": 5}
+        )
+        # Notes of cached issues are retrieved through the client's HTTP API
+        mock_gl.projects.gitlab.http_get.return_value = {"id": 1241, "body": "Hello world"}
+
+        with open("test/json_data/issue_open.json", "r") as file:
+            issue_event = json.load(file)
+        with open("test/json_data/issue_note_create.json", "r") as file:
+            note_event = json.load(file)
+        # Triggered by another user than the author, so the note is retrieved
+        note_event["user"]["id"] = 2
+
+        redis_conn.xadd("verification", {IssueEvent.ISSUE_OPEN.value: json.dumps(issue_event)})
+        redis_conn.xadd("verification", {IssueNoteEvent.ISSUE_NOTE_CREATE.value: json.dumps(note_event)})
+
+        processor = GraphQLGitlabRetrievalProcessor("https://gitlab.com", "token", redis_conn=redis_conn)
+        processor.run(testing=True)
+
+        mock_gl.http_post.assert_called_once()
+        self.assertEqual(mock_gl.http_post.call_args.args[0], "https://gitlab.com/api/graphql")
+        query = mock_gl.http_post.call_args.kwargs["post_data"]["query"]
+        self.assertIn('issue_301: issue(id: "gid://gitlab/Issue/301")', query)
+        self.assertIn('note_1241: note(id: "gid://gitlab/Note/1241")', query)
+
+        outputs = {
+            key.decode("utf-8"): json.loads(value)
+            for _, message in redis_conn.xrange("retrieval")
+            for key, value in message.items()
+        }
+        issue = outputs[IssueEvent.ISSUE_OPEN.value]
+        self.assertEqual((issue["id"], issue["iid"], issue["project_id"]), (301, 23, 14))
+        self.assertEqual(issue["author"], {"name": "Author"})
+        self.assertNotIn("labels", issue)
+        note = outputs[IssueNoteEvent.ISSUE_NOTE_CREATE.value]
+        self.assertEqual((note["id"], note["body"]), (1241, "Hello world"))
+        mock_gl.projects.gitlab.http_get.assert_called_once_with("/projects/5/issues/17/notes/1241")
+        self.assertEqual(redis_conn.xlen("verification"), 0)
+
+    @patch("gitlab.Gitlab")
+    def test_graphql_notes_can_be_notified(self, mock_gitlab):
+        redis_conn = fakeredis.FakeRedis()
+
+        mock_gl = MagicMock()
+        mock_gl.url = "https://gitlab.com"
+        mock_gitlab.return_value = mock_gl
+        mock_gl.http_post.return_value = {
+            "data": {
+                "note_1241": {
+                    "id": "gid://gitlab/Note/1241", "body": "Hello world", "system": False,
+                    "internal": False, "resolvable": False,
+                    "createdAt": "2024-01-02T03:04:05Z", "updatedAt": "2024-01-02T03:04:05Z",
+                    "author": {
+                        "id": "gid://gitlab/User/51", "username": "author", "name": "Author",
+                        "state": "active", "avatarUrl": None, "webUrl": "https://gitlab.com/author",
+                    },
+                },
+            },
+        }
+
+        with open("test/json_data/issue_note_create.json", "r") as file:
+            note_event = json.load(file)
+        # Triggered by another user than the author, so the note is retrieved
+        note_event["user"]["id"] = 2
+        redis_conn.xadd("verification", {IssueNoteEvent.ISSUE_NOTE_CREATE.value: json.dumps(note_event)})
+
+        processor = GraphQLGitlabRetrievalProcessor("https://gitlab.com", "token", redis_conn=redis_conn)
+        processor.run(testing=True)
+
+        _, message = redis_conn.xrange("retrieval")[0]
+        note = json.loads(message[IssueNoteEvent.ISSUE_NOTE_CREATE.value.encode("utf-8")])
+        self.assertEqual(note["created_at"], "2024-01-02T03:04:05.000Z")
+
+        message_format = format_message(
+            IssueNoteEvent.ISSUE_NOTE_CREATE.value, {"event_data": note, "prediction": 0, "score": 0.1}
+        )
+        fields = [field["text"] for field in message_format["blocks"][1]["fields"]]
+        self.assertIn("*Created At:*\n02 January 2024 03:04:05 GMT", fields)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,68 @@
+import logging
+import os
+
+from gunicorn.app.base import BaseApplication
+
+from common.bloom import bloom_filter_reader
+from common.event_processor import EventProcessor
+from verification_service.main import (
+    app,
+    reload_on_invalidation,
+    verification_cache,
+    verified_lists,
+    VERIFIED_USERS_BLOOM_BACKEND,
+    VERIFIED_USERS_BLOOM_PATH,
+)
+
+VERIFICATION_API_HOST = os.getenv("VERIFICATION_API_HOST", "0.0.0.0")
+VERIFICATION_API_PORT = int(os.getenv("VERIFICATION_API_PORT", 8001))
+VERIFICATION_API_WORKERS = int(os.getenv("VERIFICATION_API_WORKERS", 2))
+VERIFICATION_API_THREADS = int(os.getenv("VERIFICATION_API_THREADS", 4))
+
+
+# VerificationAPI class serves the verification Flask app with gunicorn,
+# so that /verify_email is handled by several worker processes instead
+# of a development server thread sharing the GIL with the stream
+# processor. It runs as its own process and can be scaled separately.
+class VerificationAPI(BaseApplication):
+    def __init__(self, application, options=None):
+        self.application = application
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+# Runs in every worker after it has been forked, as the Redis connection
+# and the invalidation listener thread cannot be shared across forks.
+def post_fork(server, worker):
+    redis_client = EventProcessor("", "").redis_client
+    verification_cache.redis_client = redis_client
+    verified_lists.redis_client = redis_client
+    verified_lists.bloom_filter = bloom_filter_reader(
+        VERIFIED_USERS_BLOOM_BACKEND, VERIFIED_USERS_BLOOM_PATH
+    )
+    reload_on_invalidation(verified_lists)
+    verification_cache.start_invalidation_listener()
+    verified_lists.refresh()
+    logging.info(f"Verification API worker {worker.pid} ready")
+
+
+def main():
+    options = {
+        "bind": f"{VERIFICATION_API_HOST}:{VERIFICATION_API_PORT}",
+        "workers": VERIFICATION_API_WORKERS,
+        "threads": VERIFICATION_API_THREADS,
+        "post_fork": post_fork,
+        "accesslog": None,
+    }
+    VerificationAPI(app, options).run()
+
+
+if __name__ == "__main__":
+    main()
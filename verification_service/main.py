@@ -1,13 +1,14 @@
 import logging
 import os
-import re
 import requests
-import yaml
 from prometheus_client import multiprocess, CollectorRegistry, Counter
 from flask import Flask, request, jsonify
 from threading import Thread
 
+from common.bloom import bloom_filter_reader
+from common.cache import TieredCache
 from common.event_processor import EventProcessor
+from verification_service.verified_lists import VerifiedLists
 
 from common.constants import (
     UserEvent,
@@ -51,6 +52,80 @@ snippet_check_events_total = Counter(
     "verification_service_snippet_check_events_total",
     "Total number of snippet check events processed",
 )
+verification_cache_requests_total = Counter(
+    "verification_service_cache_requests_total",
+    "Total number of verification cache lookups",
+    ["result"],
+)
+
+VERIFIED_USERS_FILE = "verification_service/verified_users.yaml"
+VERIFIED_DOMAINS_FILE = "verification_service/verified_domains.yaml"
+
+# Optional Bloom filter of the verified users sets, "file"
+VERIFIED_USERS_BLOOM_BACKEND = os.getenv("VERIFIED_USERS_BLOOM_BACKEND", "")
+VERIFIED_USERS_BLOOM_PATH = os.getenv("VERIFIED_USERS_BLOOM_PATH", "verified_users.bloom")
+
+VERIFICATION_CACHE_TTL = int(os.getenv("VERIFICATION_CACHE_TTL", 3600))
+VERIFICATION_CACHE_SIZE = int(os.getenv("VERIFICATION_CACHE_SIZE", 10000))
+GROUP_MEMBERS_CACHE_TTL = int(os.getenv("GROUP_MEMBERS_CACHE_TTL", 60))
+
+# Only lookups that need Redis or GitLab are cached, as the verified
+# lists are held in memory. Lookups in the verified users sets are
+# cached by version of the sets and email address
+# ("email:<sets version>:<address>"), user email addresses by GitLab
+# user ID ("user:<id>"), and the group member with the highest access
+# level by group ID ("group:<id>") for GROUP_MEMBERS_CACHE_TTL seconds.
+# The cache is shared by all replicas through Redis once a connection
+# is attached, and it is invalidated everywhere when the verified lists
+# or sets change. Invalidations make every replica reload its lists and
+# read the version of the sets, see reload_on_invalidation().
+verification_cache = TieredCache(
+    "verification",
+    max_size=VERIFICATION_CACHE_SIZE,
+    ttl=VERIFICATION_CACHE_TTL,
+)
+
+verified_lists = VerifiedLists(
+    VERIFIED_USERS_FILE,
+    VERIFIED_DOMAINS_FILE,
+    on_change=verification_cache.invalidate,
+)
+
+
+# Makes invalidations of the verification cache, e.g. by another
+# replica that reloaded the lists or by the verified users job, reload
+# the lists right away instead of after check_interval.
+def reload_on_invalidation(lists):
+    verification_cache.on_invalidate = lambda key: lists.refresh(force=True)
+
+
+# Looks up an address in the verified users sets through the cache.
+# Lookups are not cached until the version of the sets is known, and
+# failed lookups are not cached.
+def lookup_verified_sets(email, lists):
+    sets_version = lists.sets_version
+    key = f"email:{sets_version}:{email}"
+    result = verification_cache.get(key) if sets_version is not None else None
+    if result is not None:
+        verification_cache_requests_total.labels("hit").inc()
+        return result["user_verified"]
+
+    verification_cache_requests_total.labels("miss").inc()
+    user_verified = lists.is_user_in_sets(email)
+    if sets_version is not None and user_verified is not None:
+        verification_cache.set(key, {"user_verified": user_verified})
+    return user_verified
+
+
+def verify_email_address(email, lists=None):
+    lists = lists or verified_lists
+    return {
+        "domain_verified": lists.is_domain_verified(email),
+        "user_verified": lists.is_user_verified(
+            email, lookup_sets=lambda email: lookup_verified_sets(email, lists)
+        ),
+    }
+
 
 # Flask app for verification at a later point in the Spampibian pipeline
 # This is used to verify individual snippets that first need to be
@@ -70,12 +145,9 @@ def verify_email():
 
     logging.debug(f"Request received on /verify_email for email: {email}")
 
-    domain_verified = check_domain_verification(
-        email, "verification_service/verified_domains.yaml"
-    )
-    user_verified = check_user_verification(
-        email, "verification_service/verified_users.yaml"
-    )
+    result = verify_email_address(email)
+    domain_verified = result["domain_verified"]
+    user_verified = result["user_verified"]
 
     logging.debug(
         f"{email} status: Domain: {domain_verified}. User: {user_verified}"
@@ -93,29 +165,12 @@ def verify_email():
 def health_check():
     return jsonify({"status": "healthy"}), 200
 
-def check_domain_verification(email, verified_domains_file):
-    try:
-        with open(verified_domains_file, "r") as file:
-            verified_domains = yaml.safe_load(file).get("domains", [])
-
-        for domain in verified_domains:
-            if re.search(domain, email):
-                return True
-    except (FileNotFoundError, yaml.YAMLError, KeyError) as e:
-        print(f"Error: {e}")
-
-    return False
-
-
-def check_user_verification(email, verified_users_file):
-    with open(verified_users_file, "r") as file:
-        verified_users = yaml.safe_load(file)["users"]
-
-    for verified_user in verified_users:
-        if verified_user == email:
-            return True
-    return False
-
+# Readiness endpoint, reports whether the verified lists are loaded
+# and how long ago they were loaded and checked for changes.
+@app.route('/ready')
+def readiness_check():
+    status = verified_lists.status()
+    return jsonify(status), 200 if status["loaded"] else 503
 
 def get_user_email_address(event_type, event_data):
     if event_type in [e.value for e in ProjectEvent]:
@@ -153,9 +208,51 @@ class VerificationEventProcessor(EventProcessor):
         super().__init__(input_stream_name, output_stream_name, redis_conn)
         self.verified_users_file = verified_users_file
         self.verified_domains_file = verified_domains_file
+        self.verified_lists = VerifiedLists(
+            verified_users_file,
+            verified_domains_file,
+            on_change=verification_cache.invalidate,
+        )
         self.gitlab_url = gitlab_url
         self.gitlab_access_token = gitlab_access_token
 
+    # Returns the ID and public email address of the member with the
+    # highest access level in the group, or None if the members cannot
+    # be listed.
+    def get_group_owner(self, group_id):
+        # Get all members of the group
+        response = requests.get(
+            f"{self.gitlab_url}/api/v4/groups/{group_id}/members/all",
+            headers={"PRIVATE-TOKEN": f"{self.gitlab_access_token}"},
+        )
+
+        if response.status_code == 200:
+            gitlab_api_calls_total.labels("success").inc()
+        else:
+            gitlab_api_calls_total.labels("failure").inc()
+
+        try:
+            group_members = response.json()
+        except ValueError:
+            logging.debug(
+                "Failed to decode JSON from response"
+            )
+            return None
+
+        if not isinstance(group_members, list):
+            logging.debug("Unexpected response from server")
+            return None
+
+        # Get the user with the highest access level in the group
+        max_access_level = 0
+        owner = {"id": None, "email": None}
+        for member in group_members:
+            access_level = member.get("access_level")
+            if access_level > max_access_level:
+                max_access_level = access_level
+                owner = {"id": member.get("id"), "email": member.get("email")}
+        return owner
+
     def process_event(self, event_type, data):
 
         logging.debug(f"Processing event {event_type}")
@@ -182,49 +279,42 @@ class VerificationEventProcessor(EventProcessor):
             )
             group_id = data.get("group_id")
 
-            # Get all members of the group
-            response = requests.get(
-                f"{self.gitlab_url}/api/v4/groups/{group_id}/members/all",
-                headers={"PRIVATE-TOKEN": f"{self.gitlab_access_token}"},
-            )
-
-            if response.status_code == 200:
-                gitlab_api_calls_total.labels("success").inc()
+            # Group events of the same group come in bursts, e.g. on
+            # creation, so the owner is cached for a short time
+            group_key = f"group:{group_id}"
+            owner = verification_cache.get(group_key)
+            if owner is not None:
+                verification_cache_requests_total.labels("hit").inc()
             else:
-                gitlab_api_calls_total.labels("failure").inc()
-
-            try:
-                group_members = response.json()
-            except ValueError:
-                logging.debug(
-                    "Failed to decode JSON from response"
-                )
-                return
-
-            if not isinstance(group_members, list):
-                logging.debug("Unexpected response from server")
-                return
-
-            # Get the user with the highest access level in the group
-            max_access_level = 0
-            user_id_with_max_access = None
-            for member in group_members:
-                access_level = member.get("access_level")
-                if access_level > max_access_level:
-                    max_access_level = access_level
-                    user_id_with_max_access = member.get("id")
-                    user_email_address = member.get("email")
+                verification_cache_requests_total.labels("miss").inc()
+                owner = self.get_group_owner(group_id)
+                if owner is None:
+                    return
+                verification_cache.set(group_key, owner, ttl=GROUP_MEMBERS_CACHE_TTL)
+
+            user_id_with_max_access = owner["id"]
+            user_email_address = owner["email"]
 
             # If no group member with the highest access level had no
             # public email address present in the list of group members,
-            # get it from their GitLab user attributes.
+            # get it from their GitLab user attributes, unless it has
+            # already been looked up for this user ID.
             if not user_email_address and user_id_with_max_access is not None:
-                response = requests.get(
-                    f"{self.gitlab_url}/api/v4/users/{user_id_with_max_access}",
-                    headers={"PRIVATE-TOKEN": f"{self.gitlab_access_token}"},
-                )
-                user = response.json()
-                user_email_address = user.get("email")
+                user_key = f"user:{user_id_with_max_access}"
+                cached_user = verification_cache.get(user_key)
+                if cached_user is not None:
+                    verification_cache_requests_total.labels("hit").inc()
+                    user_email_address = cached_user.get("email")
+                else:
+                    verification_cache_requests_total.labels("miss").inc()
+                    response = requests.get(
+                        f"{self.gitlab_url}/api/v4/users/{user_id_with_max_access}",
+                        headers={"PRIVATE-TOKEN": f"{self.gitlab_access_token}"},
+                    )
+                    user = response.json()
+                    user_email_address = user.get("email")
+                    if user_email_address:
+                        verification_cache.set(user_key, {"email": user_email_address})
 
         # If an email address is still not located and the event type
         # is not snippet_check, log the situation and return.
@@ -237,23 +327,14 @@ class VerificationEventProcessor(EventProcessor):
         # If an email address is located, check if the user or their
         # email domain is verified.
         elif user_email_address is not None and event_type != SnippetEvent.SNIPPET_CHECK.value:
-            user_verified = check_domain_verification(
-                user_email_address, self.verified_domains_file
-            )
+            result = verify_email_address(user_email_address, self.verified_lists)
+            user_verified = result["domain_verified"] or result["user_verified"]
 
             logging.info(
-                f"User: {user_email_address}, user domain verification: {user_verified}"
+                f"User: {user_email_address}, domain verification: {result['domain_verified']}, "
+                f"user verification: {result['user_verified']}"
             )
 
-            if not user_verified:
-                user_verified = check_user_verification(
-                    user_email_address, self.verified_users_file
-                )
-
-                logging.info(
-                    f"User: {user_email_address}, user verification: {user_verified}"
-                )
-
         # Check if the event type is snippet_check.
         elif event_type == SnippetEvent.SNIPPET_CHECK.value:
             logging.info(
@@ -297,16 +378,31 @@ def process_events(
         gitlab_access_token=gitlab_access_token,
     )
 
+    # Share verification results with the other replicas through Redis,
+    # and look up users in the sets filled by the verified users job
+    verification_cache.redis_client = processor.redis_client
+    processor.verified_lists.redis_client = processor.redis_client
+    processor.verified_lists.bloom_filter = bloom_filter_reader(
+        VERIFIED_USERS_BLOOM_BACKEND, VERIFIED_USERS_BLOOM_PATH
+    )
+    if not testing:
+        reload_on_invalidation(processor.verified_lists)
+        verification_cache.start_invalidation_listener()
+
     processor.poll_and_process_event(testing=testing)
 
 
 def main():
-    Thread(target=app.run, kwargs={"port": 8001}, daemon=True).start()
+    # The verification API is served separately by verification_service/api.py.
+    # The Flask development server can still be started next to the stream
+    # processor for local development.
+    if os.getenv("VERIFICATION_API_EMBEDDED", "False") == "True":
+        Thread(target=app.run, kwargs={"port": 8001}, daemon=True).start()
 
     try:
         process_events(
-            verified_users_file="verification_service/verified_users.yaml",
-            verified_domains_file="verification_service/verified_domains.yaml",
+            verified_users_file=VERIFIED_USERS_FILE,
+            verified_domains_file=VERIFIED_DOMAINS_FILE,
             gitlab_url=os.getenv("GITLAB_URL"),
             gitlab_access_token=os.environ.get("GITLAB_ACCESS_TOKEN"),
         )
@@ -3,6 +3,8 @@ from unittest.mock import patch
 import json
 import responses
 import copy
+import os
+import tempfile
 import fakeredis
 from common.constants import (
     UserEvent,
@@ -13,7 +15,17 @@ from common.constants import (
     IssueEvent,
 )
 
-from verification_service.main import process_events, app
+from verification_service.main import (
+    process_events,
+    app,
+    reload_on_invalidation,
+    verification_cache,
+    verify_email_address,
+    VerificationEventProcessor,
+)
+from verification_service.verified_lists import VerifiedLists
+from common.constants import VERIFIED_ESTABLISHED_USERS_KEY, VERIFIED_USERS_VERSION_KEY
+from common.bloom import BloomFilter, MmapBloomFilter
 
 
 class TestVerificationService(unittest.TestCase):
@@ -270,6 +282,149 @@ class TestEmailVerificationAPI(unittest.TestCase):
                 self.assertEqual(json_data.get("domain_verified"), domain_verified)
                 self.assertEqual(json_data.get("user_verified"), user_verified)
 
+    def test_readiness_reports_loaded_lists(self):
+        response = self.client.get("/ready")
+        self.assertEqual(response.status_code, 200)
+
+        json_data = response.get_json()
+        self.assertTrue(json_data["loaded"])
+        self.assertEqual(json_data["verified_users"], 1)
+        self.assertEqual(json_data["verified_domains"], 3)
+        self.assertIsNotNone(json_data["seconds_since_load"])
+
+
+class TestVerificationCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.users_file = os.path.join(self.directory.name, "verified_users.yaml")
+        self.domains_file = os.path.join(self.directory.name, "verified_domains.yaml")
+
+        with open(self.users_file, "w") as file:
+            file.write("users:\n  - cached-user@example.com\n")
+        with open(self.domains_file, "w") as file:
+            file.write("domains:\n  - \"\\\\.gov$\"\n")
+
+        self.lists = VerifiedLists(
+            self.users_file,
+            self.domains_file,
+            check_interval=0,
+            on_change=verification_cache.invalidate,
+        )
+        verification_cache.redis_client = fakeredis.FakeRedis()
+
+    def tearDown(self):
+        verification_cache.on_invalidate = None
+        verification_cache.invalidate()
+        verification_cache.redis_client = None
+        self.directory.cleanup()
+
+    def test_lookups_in_verified_lists_are_not_cached(self):
+        result = verify_email_address("cached-user@example.com", self.lists)
+        self.assertEqual(result, {"domain_verified": False, "user_verified": True})
+        self.assertTrue(verify_email_address("someone@agency.gov", self.lists)["domain_verified"])
+        self.assertEqual(len(verification_cache.local), 0)
+
+        with open(self.users_file, "w") as file:
+            file.write("users: []\n")
+        os.utime(self.users_file, (0, 0))
+
+        result = verify_email_address("cached-user@example.com", self.lists)
+        self.assertEqual(result, {"domain_verified": False, "user_verified": False})
+
+    def test_lookups_in_verified_sets_are_cached_by_version_of_the_sets(self):
+        redis_conn = fakeredis.FakeRedis()
+        redis_conn.sadd(VERIFIED_ESTABLISHED_USERS_KEY, "established@example.com")
+        self.lists.redis_client = redis_conn
+        stale_lists = VerifiedLists(
+            self.users_file, self.domains_file, check_interval=3600, redis_client=redis_conn
+        )
+        stale_lists.refresh()
+
+        self.assertTrue(verify_email_address("established@example.com", self.lists)["user_verified"])
+        self.assertEqual(
+            verification_cache.get_with_tier("email:0:established@example.com")[1], "local"
+        )
+
+        redis_conn.srem(VERIFIED_ESTABLISHED_USERS_KEY, "established@example.com")
+        self.assertTrue(verify_email_address("established@example.com", self.lists)["user_verified"])
+
+        # Results cached under the previous version of the sets, e.g. by
+        # a replica that has not read the new version yet, are not read
+        redis_conn.incr(VERIFIED_USERS_VERSION_KEY)
+        self.assertFalse(verify_email_address("established@example.com", self.lists)["user_verified"])
+        verification_cache.local.clear()
+        self.assertTrue(verify_email_address("established@example.com", stale_lists)["user_verified"])
+        self.assertFalse(verify_email_address("established@example.com", self.lists)["user_verified"])
+
+        # Invalidations make replicas read the version of the sets
+        reload_on_invalidation(stale_lists)
+        verification_cache._handle_invalidation({"data": json.dumps({"namespace": "verification", "key": None})})
+        self.assertEqual(stale_lists.sets_version, 1)
+        self.assertFalse(verify_email_address("established@example.com", stale_lists)["user_verified"])
+
+    @patch("verification_service.main.requests.get")
+    def test_group_owners_are_cached(self, mock_get):
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = [
+            {"id": 1, "access_level": 30, "email": "developer@example.com"},
+            {"id": 2, "access_level": 50, "email": "owner@example.com"},
+        ]
+        processor = VerificationEventProcessor(
+            "event",
+            "verification",
+            redis_conn=fakeredis.FakeRedis(),
+            verified_users_file=self.users_file,
+            verified_domains_file=self.domains_file,
+            gitlab_url="http://gitlab.com",
+        )
+
+        for _ in range(2):
+            processor.process_event(GroupEvent.GROUP_CREATE.value, {"group_id": 42})
+
+        mock_get.assert_called_once()
+        self.assertEqual(verification_cache.get("group:42"), {"id": 2, "email": "owner@example.com"})
+
+    def test_last_lists_are_kept_if_files_cannot_be_loaded(self):
+        self.assertTrue(verify_email_address("cached-user@example.com", self.lists)["user_verified"])
+
+        # Half written and then missing file
+        with open(self.users_file, "w") as file:
+            file.write("users:\n  - [cached-user@example.com\n")
+        os.utime(self.users_file, (0, 0))
+        self.assertFalse(self.lists.refresh())
+        os.remove(self.users_file)
+        self.assertFalse(self.lists.refresh())
+
+        self.assertTrue(self.lists.is_user_verified("cached-user@example.com"))
+        self.assertTrue(self.lists.status()["loaded"])
+
+        missing_lists = VerifiedLists(self.users_file, self.domains_file, check_interval=0)
+        self.assertFalse(missing_lists.status()["loaded"])
+        self.assertIsNone(missing_lists.version)
+
+    def test_users_are_looked_up_in_redis_sets(self):
+        self.lists.redis_client = fakeredis.FakeRedis()
+        self.lists.redis_client.sadd(VERIFIED_ESTABLISHED_USERS_KEY, "established@example.com")
+
+        self.assertTrue(self.lists.is_user_verified("established@example.com"))
+        self.assertFalse(self.lists.is_user_verified("unknown@example.com"))
+
+    # The Bloom filter of a replica whose job has not rewritten it yet
+    # misses users added since, so its misses are looked up in Redis
+    def test_misses_of_outdated_bloom_filters_are_looked_up_in_redis(self):
+        redis_conn = fakeredis.FakeRedis()
+        redis_conn.set(VERIFIED_USERS_VERSION_KEY, 1)
+        path = os.path.join(self.directory.name, "verified_users.bloom")
+        BloomFilter(100, version=1).write_file(path)
+
+        self.lists.redis_client = redis_conn
+        self.lists.bloom_filter = MmapBloomFilter(path, check_interval=0)
+        redis_conn.sadd(VERIFIED_ESTABLISHED_USERS_KEY, "established@example.com")
+        self.assertFalse(self.lists.is_user_verified("established@example.com"))
+
+        redis_conn.incr(VERIFIED_USERS_VERSION_KEY)
+        self.assertTrue(self.lists.is_user_verified("established@example.com"))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import redis
+import yaml
+
+from common.constants import VERIFIED_USERS_KEYS, VERIFIED_USERS_VERSION_KEY
+
+
+# VerifiedLists class keeps the verified users and verified domains
+# lists in memory, so that checking an email address does not read
+# and parse the YAML files on every call. The files are mounted from
+# ConfigMaps and can change at runtime, so their modification times
+# are checked at most every check_interval seconds and the lists are
+# reloaded when they change. on_change is called after a reload that
+# changed the lists.
+#
+# version is a hash of the loaded lists, so that results cached under it
+# by a replica that has not reloaded the lists yet are never read by the
+# replicas that have.
+#
+# If a Redis client is set, users are also looked up in the verified
+# users sets filled by the verified users retriever job. If a Bloom
+# filter of these sets is set as well, addresses that are not in the
+# filter are rejected without a Redis lookup. The filter of a replica is
+# only rewritten by its own job, so a miss is only trusted if the filter
+# was built from the current version of the sets, sets_version, which
+# is read along with the file modification times.
+class VerifiedLists:
+    def __init__(
+        self,
+        verified_users_file,
+        verified_domains_file,
+        check_interval=10,
+        on_change=None,
+        redis_client=None,
+        bloom_filter=None,
+    ):
+        self.verified_users_file = verified_users_file
+        self.verified_domains_file = verified_domains_file
+        self.check_interval = check_interval
+        self.on_change = on_change
+        self.redis_client = redis_client
+        self.bloom_filter = bloom_filter
+
+        self.verified_users = frozenset()
+        self.verified_domains = ()
+        self.version = None
+        self.sets_version = None
+        self.loaded_at = None
+        self.checked_at = None
+
+        self._mtimes = None
+        self._last_checked = 0
+        self._lock = threading.Lock()
+
+    def _file_mtimes(self):
+        mtimes = []
+        for path in (self.verified_users_file, self.verified_domains_file):
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except (OSError, TypeError):
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    # Loads both lists. If a file cannot be read or parsed, e.g. while a
+    # ConfigMap is being updated, the last lists loaded are kept and
+    # False is returned.
+    def _load(self):
+        try:
+            with open(self.verified_users_file, "r") as file:
+                users = frozenset(yaml.safe_load(file).get("users") or [])
+        except (OSError, TypeError, AttributeError, yaml.YAMLError) as e:
+            logging.error(f"Unable to load verified users from {self.verified_users_file}: {e}")
+            return False
+
+        try:
+            with open(self.verified_domains_file, "r") as file:
+                domains = tuple(
+                    re.compile(domain)
+                    for domain in yaml.safe_load(file).get("domains") or []
+                )
+        except (OSError, TypeError, AttributeError, yaml.YAMLError, re.error) as e:
+            logging.error(f"Unable to load verified domains from {self.verified_domains_file}: {e}")
+            return False
+
+        self.verified_users = users
+        self.verified_domains = domains
+        # Set last, so that a version is never read before its lists
+        self.version = hashlib.sha256(
+            json.dumps([sorted(map(str, users)), [domain.pattern for domain in domains]]).encode("utf-8")
+        ).hexdigest()[:16]
+        self.loaded_at = time.time()
+        return True
+
+    # Reloads the lists if the files changed since they were last loaded.
+    # Returns True if the lists were reloaded. Failed loads are retried
+    # at the next check.
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self.checked_at is not None and now - self._last_checked < self.check_interval:
+            return False
+
+        with self._lock:
+            self._last_checked = now
+            self.checked_at = time.time()
+            self._read_sets_version()
+            mtimes = self._file_mtimes()
+            if not force and mtimes == self._mtimes:
+                return False
+
+            previous_version = self.version
+            if not self._load():
+                return False
+            self._mtimes = mtimes
+
+        logging.info(
+            f"Loaded {len(self.verified_users)} verified users and "
+            f"{len(self.verified_domains)} verified domains"
+        )
+
+        if previous_version is not None and self.version != previous_version and self.on_change is not None:
+            self.on_change()
+
+        return True
+
+    # The version is unknown if it cannot be read, so that the Bloom
+    # filter is not trusted until it can.
+    def _read_sets_version(self):
+        if self.redis_client is None:
+            return
+
+        try:
+            self.sets_version = int(self.redis_client.get(VERIFIED_USERS_VERSION_KEY) or 0)
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Unable to read the version of the verified users sets: {e}")
+            self.sets_version = None
+
+    # Reports whether the lists are loaded and how fresh they are. Lists
+    # are only reported as loaded once a load has succeeded.
+    def status(self):
+        self.refresh()
+        now = time.time()
+        return {
+            "loaded": self.loaded_at is not None,
+            "verified_users": len(self.verified_users),
+            "verified_domains": len(self.verified_domains),
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "seconds_since_load": None if self.loaded_at is None else round(now - self.loaded_at, 3),
+            "seconds_since_check": None if self.checked_at is None else round(now - self.checked_at, 3),
+        }
+
+    def is_domain_verified(self, email):
+        self.refresh()
+        return any(domain.search(email) for domain in self.verified_domains)
+
+    # lookup_sets is called instead of is_user_in_sets, e.g. to cache
+    # the lookups, for addresses that may be in the verified users sets.
+    def is_user_verified(self, email, lookup_sets=None):
+        self.refresh()
+        if email in self.verified_users:
+            return True
+
+        if self.redis_client is None:
+            return False
+
+        if (
+            self.bloom_filter is not None
+            and self.bloom_filter.might_contain(email) is False
+            and self.sets_version is not None
+            and self.bloom_filter.version == self.sets_version
+        ):
+            return False
+
+        return bool((lookup_sets or self.is_user_in_sets)(email))
+
+    # Returns None if the sets cannot be read
+    def is_user_in_sets(self, email):
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for key in VERIFIED_USERS_KEYS:
+                pipeline.sismember(key, email)
+            return any(pipeline.execute())
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Unable to look up verified users in Redis: {e}")
+            return None
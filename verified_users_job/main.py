@@ -0,0 +1,418 @@
+import datetime
+import itertools
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import gitlab
+from prometheus_client import Counter, Gauge
+
+from common.bloom import BloomFilter
+from common.cache import TieredCache
+from common.constants import (
+    VERIFIED_GROUP_MEMBERS_KEY,
+    VERIFIED_ESTABLISHED_USERS_KEY,
+    VERIFIED_USERS_KEYS,
+    VERIFIED_USERS_VERSION_KEY,
+)
+from common.event_processor import EventProcessor
+
+LOGLEVEL = os.environ.get('LOGLEVEL', 'WARNING').upper()
+logging.basicConfig(
+    level=LOGLEVEL, format="%(asctime)s - %(levelname)s - Verified users job: %(message)s"
+)
+
+CURSORS_KEY = "verified_users:cursors"
+SYNC_LOCK_KEY = "verified_users:sync_lock"
+# User ID to email address of the established users, to remove the
+# previous address of users who change it
+ESTABLISHED_EMAILS_KEY = "verified_users:established_emails"
+# User ID to username of the accounts old enough to be established but
+# without activity, to check them again once they have some
+INACTIVE_USERS_KEY = "verified_users:inactive_users"
+
+USERS_PAGE_SIZE = 100
+
+users_added_total = Counter(
+    "verified_users_job_users_added_total",
+    "Number of users added to the verified users sets",
+    ["source"],
+)
+users_removed_total = Counter(
+    "verified_users_job_users_removed_total",
+    "Number of users removed from the verified users sets",
+    ["source"],
+)
+verified_users_gauge = Gauge(
+    "verified_users_job_verified_users",
+    "Number of users in the verified users sets",
+    ["source"],
+)
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _format_time(value):
+    return value.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+# VerifiedUsersRetriever class fills the verified users sets in Redis
+# from GitLab, so that the verification service can check users in
+# O(1) without a redeploy of the verified users ConfigMap.
+#
+# Users are trusted if they are members of one of the configured groups,
+# or if their account is older than min_account_age_days, is active and
+# has activity. Group memberships are small and are fully resynced on
+# every run. Established users are synced incrementally: each run only
+# looks at accounts that became old enough since the previous run, at
+# accounts updated since the previous run, e.g. because they were
+# blocked or changed their email address, and at accounts without
+# activity when they were old enough that have been active since the
+# previous run. GitLab does not update updated_at on activity, so the
+# latter are found in the user activities. The cursors are stored in
+# Redis.
+#
+# For very large instances, a Bloom filter of the sets can be written
+# to a file ("file" backend), so that verification replicas can reject
+# unknown users without a lookup. The filter holds the version of the
+# sets it was built from, see VerifiedLists.
+#
+# The job runs in every replica, which share the sets and cursors. Only
+# the replica holding the sync lock syncs from GitLab, and the lock
+# expires after sync_lock_timeout seconds in case its replica dies. As
+# Bloom filter files are local to a replica, the others rewrite theirs
+# when the version of the sets changed.
+class VerifiedUsersRetriever:
+    def __init__(
+        self,
+        gitlab_url,
+        gitlab_access_token,
+        redis_conn=None,
+        group_ids=(),
+        min_account_age_days=None,
+        bloom_backend="",
+        bloom_location=None,
+        bloom_capacity=100000,
+        bloom_error_rate=0.001,
+        sync_lock_timeout=3600,
+        lookup_concurrency=8,
+    ):
+        self.redis_client = EventProcessor("", "", redis_conn=redis_conn).redis_client
+        self.gitlab_client = gitlab.Gitlab(gitlab_url, private_token=gitlab_access_token)
+        self.group_ids = list(group_ids)
+        self.min_account_age_days = min_account_age_days
+        self.bloom_backend = bloom_backend
+        self.bloom_location = bloom_location
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.sync_lock_timeout = sync_lock_timeout
+        self.lookup_concurrency = lookup_concurrency
+        self._bloom_version = None
+        self._bloom_written = False
+
+    def _get_user(self, user_id):
+        try:
+            return self.gitlab_client.users.get(user_id)
+        except gitlab.exceptions.GitlabGetError as e:
+            logging.warning(f"Unable to get user {user_id}: {e}")
+            return None
+
+    # Users are fetched concurrently, as the API has no batch lookup.
+    # Users that could not be fetched are None.
+    def _get_users(self, user_ids):
+        if not user_ids:
+            return []
+        with ThreadPoolExecutor(max_workers=self.lookup_concurrency) as executor:
+            return list(executor.map(self._get_user, user_ids))
+
+    # Returns the email address of each user by ID. User listings of
+    # administrators include them, and only the users of other listings,
+    # e.g. of group members, are fetched.
+    def _user_emails(self, users):
+        emails = {user.id: getattr(user, "email", None) for user in users}
+        missing = [user_id for user_id, email in emails.items() if not email]
+        for user_id, user in zip(missing, self._get_users(missing)):
+            emails[user_id] = user.attributes.get("email") if user is not None else None
+        return emails
+
+    def sync_group_members(self):
+        members = []
+        for group_id in self.group_ids:
+            group = self.gitlab_client.groups.get(group_id, lazy=True)
+            members.extend(
+                member for member in group.members_all.list(iterator=True) if member.state == "active"
+            )
+        emails = {email for email in self._user_emails(members).values() if email}
+
+        previous = {email.decode("utf-8") for email in self.redis_client.smembers(VERIFIED_GROUP_MEMBERS_KEY)}
+        added = emails - previous
+        removed = previous - emails
+
+        pipeline = self.redis_client.pipeline()
+        if added:
+            pipeline.sadd(VERIFIED_GROUP_MEMBERS_KEY, *added)
+        if removed:
+            pipeline.srem(VERIFIED_GROUP_MEMBERS_KEY, *removed)
+        pipeline.execute()
+
+        users_added_total.labels("group_members").inc(len(added))
+        users_removed_total.labels("group_members").inc(len(removed))
+        verified_users_gauge.labels("group_members").set(len(emails))
+
+        return bool(added or removed)
+
+    def _is_old_enough(self, user, cutoff):
+        created_at = _parse_time(getattr(user, "created_at", None))
+        return (
+            user.state == "active"
+            and not getattr(user, "bot", False)
+            and created_at is not None
+            and created_at <= cutoff
+        )
+
+    def _is_established(self, user, cutoff):
+        return self._is_old_enough(user, cutoff) and getattr(user, "last_activity_on", None) is not None
+
+    # Adds the established users among users to the set, and removes the
+    # others, and the previous email address of users who changed it.
+    # Returns the email addresses added and removed.
+    def _check_users(self, users, cutoff):
+        emails = self._user_emails(users)
+        previous_emails = self.redis_client.hmget(ESTABLISHED_EMAILS_KEY, [user.id for user in users])
+
+        added = set()
+        removed = set()
+        pipeline = self.redis_client.pipeline()
+        for user, previous_email in zip(users, previous_emails):
+            email = emails[user.id]
+            if email and self._is_established(user, cutoff):
+                added.add(email)
+                removed.discard(email)
+                pipeline.hset(ESTABLISHED_EMAILS_KEY, user.id, email)
+            else:
+                pipeline.hdel(ESTABLISHED_EMAILS_KEY, user.id)
+            if previous_email and previous_email.decode("utf-8") not in added:
+                removed.add(previous_email.decode("utf-8"))
+
+            if self._is_old_enough(user, cutoff) and getattr(user, "last_activity_on", None) is None:
+                pipeline.hset(INACTIVE_USERS_KEY, user.id, user.username)
+            else:
+                pipeline.hdel(INACTIVE_USERS_KEY, user.id)
+
+        if added:
+            pipeline.sadd(VERIFIED_ESTABLISHED_USERS_KEY, *added)
+        if removed:
+            pipeline.srem(VERIFIED_ESTABLISHED_USERS_KEY, *removed)
+        pipeline.execute()
+
+        return added, removed
+
+    def sync_established_users(self, now=None):
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        cutoff = now - datetime.timedelta(days=self.min_account_age_days)
+
+        cursors = {
+            key.decode("utf-8"): value.decode("utf-8")
+            for key, value in self.redis_client.hgetall(CURSORS_KEY).items()
+        }
+        created_cursor = cursors.get("created_before")
+        updated_cursor = _parse_time(cursors.get("updated_after"))
+        active_cursor = cursors.get("active_since")
+
+        added = set()
+        removed = set()
+
+        def check_users(users):
+            users_added, users_removed = self._check_users(users, cutoff)
+            added.update(users_added)
+            removed.difference_update(users_added)
+            removed.update(users_removed)
+            added.difference_update(users_removed)
+
+        # Accounts that became old enough since the previous run, checked
+        # a page at a time
+        list_filters = {"created_before": _format_time(cutoff), "order_by": "id", "sort": "asc"}
+        if created_cursor:
+            list_filters["created_after"] = created_cursor
+        users = iter(self.gitlab_client.users.list(iterator=True, per_page=USERS_PAGE_SIZE, **list_filters))
+        for page in iter(lambda: list(itertools.islice(users, USERS_PAGE_SIZE)), []):
+            check_users(page)
+
+        # Accounts updated since the previous run. Users are listed from
+        # the most recently updated one, so the listing stops at the cursor.
+        latest_update = updated_cursor
+        if updated_cursor is not None:
+            updated_users = []
+            for user in self.gitlab_client.users.list(iterator=True, order_by="updated_at", sort="desc"):
+                updated_at = _parse_time(getattr(user, "updated_at", None))
+                if updated_at is None or updated_at <= updated_cursor:
+                    break
+                latest_update = max(latest_update, updated_at)
+                updated_users.append(user)
+            if updated_users:
+                check_users(updated_users)
+        else:
+            latest_update = now
+
+        # Inactive accounts active since the day of the previous run
+        if active_cursor:
+            inactive_users = {
+                username.decode("utf-8"): int(user_id)
+                for user_id, username in self.redis_client.hgetall(INACTIVE_USERS_KEY).items()
+            }
+            activities = self.gitlab_client.user_activities.list(
+                iterator=True, query_parameters={"from": active_cursor}
+            )
+            active_ids = sorted({
+                inactive_users[activity.username]
+                for activity in activities
+                if activity.username in inactive_users
+            })
+            active_users = [user for user in self._get_users(active_ids) if user is not None]
+            if active_users:
+                check_users(active_users)
+
+        pipeline = self.redis_client.pipeline()
+        pipeline.hset(
+            CURSORS_KEY,
+            mapping={
+                "created_before": _format_time(cutoff),
+                "updated_after": _format_time(latest_update),
+                "active_since": now.strftime("%Y-%m-%d"),
+            },
+        )
+        pipeline.scard(VERIFIED_ESTABLISHED_USERS_KEY)
+        results = pipeline.execute()
+
+        users_added_total.labels("established").inc(len(added))
+        users_removed_total.labels("established").inc(len(removed))
+        verified_users_gauge.labels("established").set(results[-1])
+
+        return bool(added or removed)
+
+    # Bloom filters do not support removals, so the filter is rebuilt
+    # from the sets. It is sized for the larger of the configured
+    # capacity and the current number of users.
+    def write_bloom_filter(self):
+        version = self.redis_client.get(VERIFIED_USERS_VERSION_KEY)
+        pipeline = self.redis_client.pipeline()
+        for key in VERIFIED_USERS_KEYS:
+            pipeline.scard(key)
+        user_count = sum(pipeline.execute())
+
+        bloom_filter = BloomFilter(
+            max(self.bloom_capacity, user_count), self.bloom_error_rate, version=int(version or 0)
+        )
+        for key in VERIFIED_USERS_KEYS:
+            for email in self.redis_client.sscan_iter(key, count=1000):
+                bloom_filter.add(email.decode("utf-8"))
+
+        bloom_filter.write_file(self.bloom_location)
+
+        logging.info(
+            f"Wrote Bloom filter of {user_count} users ({len(bloom_filter.bits)} bytes) "
+            f"to {self.bloom_location}"
+        )
+        self._bloom_version = version
+        self._bloom_written = True
+
+    def _bloom_outdated(self):
+        return not self._bloom_written or self.redis_client.get(VERIFIED_USERS_VERSION_KEY) != self._bloom_version
+
+    def _acquire_sync_lock(self):
+        token = uuid.uuid4().hex
+        if self.redis_client.set(SYNC_LOCK_KEY, token, nx=True, ex=self.sync_lock_timeout):
+            return token
+        return None
+
+    # Deletes the lock only if this replica still holds it, as it may
+    # have expired and been taken by another replica
+    def _release_sync_lock(self, token):
+        def release(pipeline):
+            if pipeline.get(SYNC_LOCK_KEY) == token.encode("utf-8"):
+                pipeline.multi()
+                pipeline.delete(SYNC_LOCK_KEY)
+
+        self.redis_client.transaction(release, SYNC_LOCK_KEY)
+
+    def sync(self):
+        token = self._acquire_sync_lock()
+        if token is None:
+            logging.info("Verified users are being synced by another replica")
+            if self.bloom_backend and self._bloom_outdated():
+                self.write_bloom_filter()
+            return False
+
+        try:
+            changed = False
+            if self.group_ids:
+                changed = self.sync_group_members() or changed
+            if self.min_account_age_days is not None:
+                changed = self.sync_established_users() or changed
+            if changed:
+                self.redis_client.incr(VERIFIED_USERS_VERSION_KEY)
+
+            if self.bloom_backend and self._bloom_outdated():
+                self.write_bloom_filter()
+
+            # Cached verification results may be stale once the sets
+            # change. The invalidation also makes the verification
+            # replicas read the new version of the sets, so that they stop
+            # trusting Bloom filters built from the previous one.
+            if changed:
+                TieredCache("verification", redis_client=self.redis_client).invalidate()
+        finally:
+            self._release_sync_lock(token)
+
+        return changed
+
+    def run(self, interval=3600, testing=False):
+        while True:
+            try:
+                self.sync()
+            except (gitlab.exceptions.GitlabError, ValueError) as e:
+                logging.error(f"Error syncing verified users: {e}")
+
+            if testing:
+                return
+            time.sleep(interval)
+
+
+def main():
+    group_ids = [
+        group_id.strip()
+        for group_id in os.getenv("VERIFIED_USERS_GROUP_IDS", "").split(",")
+        if group_id.strip()
+    ]
+    min_account_age_days = os.getenv("VERIFIED_USERS_MIN_ACCOUNT_AGE_DAYS") or None
+
+    if not group_ids and min_account_age_days is None:
+        logging.info("No verified users sources configured, exiting")
+        return
+
+    bloom_backend = os.getenv("VERIFIED_USERS_BLOOM_BACKEND", "")
+    bloom_location = os.getenv("VERIFIED_USERS_BLOOM_PATH", "verified_users.bloom")
+
+    interval = int(os.getenv("VERIFIED_USERS_SYNC_INTERVAL", 3600))
+    retriever = VerifiedUsersRetriever(
+        os.getenv("GITLAB_URL"),
+        os.getenv("GITLAB_ACCESS_TOKEN"),
+        group_ids=group_ids,
+        min_account_age_days=None if min_account_age_days is None else int(min_account_age_days),
+        bloom_backend=bloom_backend,
+        bloom_location=bloom_location,
+        bloom_capacity=int(os.getenv("VERIFIED_USERS_BLOOM_CAPACITY", 100000)),
+        bloom_error_rate=float(os.getenv("VERIFIED_USERS_BLOOM_ERROR_RATE", 0.001)),
+        sync_lock_timeout=interval,
+    )
+    retriever.run(interval=interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import datetime
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+import fakeredis
+
+from common.constants import (
+    VERIFIED_GROUP_MEMBERS_KEY,
+    VERIFIED_ESTABLISHED_USERS_KEY,
+    VERIFIED_USERS_VERSION_KEY,
+)
+from common.bloom import MmapBloomFilter
+from verified_users_job.main import (
+    VerifiedUsersRetriever,
+    CURSORS_KEY,
+    ESTABLISHED_EMAILS_KEY,
+    INACTIVE_USERS_KEY,
+    SYNC_LOCK_KEY,
+)
+
+
+def make_user(user_id, email, state="active", created_at="2020-01-01T00:00:00Z",
+              updated_at="2020-01-01T00:00:00Z", last_activity_on="2023-01-01"):
+    user = MagicMock()
+    user.id = user_id
+    user.username = f"user{user_id}"
+    user.email = email
+    user.state = state
+    user.bot = False
+    user.created_at = created_at
+    user.updated_at = updated_at
+    user.last_activity_on = last_activity_on
+    return user
+
+
+class TestVerifiedUsersRetriever(unittest.TestCase):
+    @patch("gitlab.Gitlab")
+    def setUp(self, mock_gitlab):
+        self.redis_conn = fakeredis.FakeRedis()
+        self.mock_gl = MagicMock()
+        mock_gitlab.return_value = self.mock_gl
+
+        self.retriever = VerifiedUsersRetriever(
+            "https://gitlab.com",
+            "token",
+            redis_conn=self.redis_conn,
+            group_ids=["1"],
+            min_account_age_days=30,
+        )
+
+    def test_sync_group_members(self):
+        self.redis_conn.sadd(VERIFIED_GROUP_MEMBERS_KEY, "former-member@example.com")
+        members = [
+            make_user(1, "member@example.com"),
+            make_user(2, "blocked@example.com", state="blocked"),
+        ]
+        self.mock_gl.groups.get.return_value.members_all.list.return_value = members
+
+        self.assertTrue(self.retriever.sync_group_members())
+        self.assertEqual(
+            self.redis_conn.smembers(VERIFIED_GROUP_MEMBERS_KEY),
+            {b"member@example.com"},
+        )
+
+    def test_sync_established_users_is_incremental(self):
+        now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        self.mock_gl.users.list.return_value = [
+            make_user(1, "established@example.com"),
+            make_user(2, "inactive@example.com", last_activity_on=None),
+        ]
+
+        self.retriever.sync_established_users(now=now)
+
+        self.assertEqual(
+            self.redis_conn.smembers(VERIFIED_ESTABLISHED_USERS_KEY),
+            {b"established@example.com"},
+        )
+        self.assertEqual(
+            self.mock_gl.users.list.call_args.kwargs["created_before"],
+            "2023-12-02T00:00:00Z",
+        )
+
+        # The next run only lists newly eligible and recently updated users
+        blocked = make_user(1, "established@example.com", state="blocked", updated_at="2024-01-01T12:00:00Z")
+        unchanged = make_user(3, "unchanged@example.com", updated_at="2023-12-31T00:00:00Z")
+        self.mock_gl.users.list.side_effect = [[], [blocked, unchanged]]
+
+        self.retriever.sync_established_users(now=now + datetime.timedelta(days=1))
+
+        first_call, second_call = self.mock_gl.users.list.call_args_list[-2:]
+        self.assertEqual(first_call.kwargs["created_after"], "2023-12-02T00:00:00Z")
+        self.assertEqual(second_call.kwargs["order_by"], "updated_at")
+        self.assertEqual(self.redis_conn.smembers(VERIFIED_ESTABLISHED_USERS_KEY), set())
+        self.assertEqual(
+            self.redis_conn.hget(CURSORS_KEY, "updated_after"),
+            b"2024-01-01T12:00:00Z",
+        )
+
+    def test_group_members_without_email_are_fetched(self):
+        hidden_email = make_user(2, None)
+        self.mock_gl.groups.get.return_value.members_all.list.return_value = [
+            make_user(1, "member@example.com"),
+            hidden_email,
+        ]
+        self.mock_gl.users.get.return_value.attributes = {"email": "hidden@example.com"}
+
+        self.retriever.sync_group_members()
+
+        self.mock_gl.users.get.assert_called_once_with(2)
+        self.assertEqual(
+            self.redis_conn.smembers(VERIFIED_GROUP_MEMBERS_KEY),
+            {b"member@example.com", b"hidden@example.com"},
+        )
+
+    def test_previous_email_of_established_users_is_removed(self):
+        now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        self.mock_gl.users.list.return_value = [make_user(1, "old@example.com")]
+        self.retriever.sync_established_users(now=now)
+
+        renamed = make_user(1, "new@example.com", updated_at="2024-01-01T12:00:00Z")
+        self.mock_gl.users.list.side_effect = [[], [renamed]]
+        self.retriever.sync_established_users(now=now + datetime.timedelta(days=1))
+
+        self.assertEqual(self.redis_conn.smembers(VERIFIED_ESTABLISHED_USERS_KEY), {b"new@example.com"})
+        self.assertEqual(self.redis_conn.hget(ESTABLISHED_EMAILS_KEY, 1), b"new@example.com")
+
+    def test_inactive_users_are_checked_again_once_active(self):
+        now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        self.mock_gl.users.list.return_value = [make_user(2, "inactive@example.com", last_activity_on=None)]
+        self.retriever.sync_established_users(now=now)
+
+        self.assertEqual(self.redis_conn.smembers(VERIFIED_ESTABLISHED_USERS_KEY), set())
+        self.assertEqual(self.redis_conn.hget(INACTIVE_USERS_KEY, 2), b"user2")
+
+        # Signing in does not update updated_at, the user is found in the
+        # user activities
+        activity = MagicMock()
+        activity.username = "user2"
+        self.mock_gl.user_activities.list.return_value = [activity]
+        self.mock_gl.users.list.side_effect = [[], []]
+        self.mock_gl.users.get.return_value = make_user(2, "inactive@example.com")
+
+        self.retriever.sync_established_users(now=now + datetime.timedelta(days=1))
+
+        self.assertEqual(
+            self.mock_gl.user_activities.list.call_args.kwargs["query_parameters"],
+            {"from": "2024-01-01"},
+        )
+        self.mock_gl.users.get.assert_called_once_with(2)
+        self.assertEqual(self.redis_conn.smembers(VERIFIED_ESTABLISHED_USERS_KEY), {b"inactive@example.com"})
+        self.assertFalse(self.redis_conn.hexists(INACTIVE_USERS_KEY, 2))
+
+    def test_sync_writes_bloom_filter(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+
+        self.retriever.min_account_age_days = None
+        self.retriever.bloom_backend = "file"
+        self.retriever.bloom_location = os.path.join(temp_dir.name, "verified_users.bloom")
+        self.mock_gl.groups.get.return_value.members_all.list.return_value = [
+            make_user(1, "member@example.com"),
+        ]
+
+        self.retriever.sync()
+
+        bloom_filter = MmapBloomFilter(self.retriever.bloom_location)
+        self.assertTrue(bloom_filter.might_contain("member@example.com"))
+        self.assertEqual(bloom_filter.version, int(self.redis_conn.get(VERIFIED_USERS_VERSION_KEY)))
+
+
+    @patch("gitlab.Gitlab")
+    def test_only_one_replica_syncs_from_gitlab(self, mock_gitlab):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+
+        self.retriever.min_account_age_days = None
+        self.retriever.bloom_backend = "file"
+        self.retriever.bloom_location = os.path.join(temp_dir.name, "first.bloom")
+        self.mock_gl.groups.get.return_value.members_all.list.return_value = [
+            make_user(1, "member@example.com"),
+        ]
+
+        other_gl = MagicMock()
+        mock_gitlab.return_value = other_gl
+        other_replica = VerifiedUsersRetriever(
+            "https://gitlab.com",
+            "token",
+            redis_conn=self.redis_conn,
+            group_ids=["1"],
+            bloom_backend="file",
+            bloom_location=os.path.join(temp_dir.name, "second.bloom"),
+        )
+
+        # While the first replica holds the lock, the other one does not
+        # sync, and writes its Bloom filter file from the shared sets
+        token = self.retriever._acquire_sync_lock()
+        self.assertFalse(other_replica.sync())
+        self.retriever._release_sync_lock(token)
+
+        self.assertTrue(self.retriever.sync())
+        self.assertFalse(self.redis_conn.exists(SYNC_LOCK_KEY))
+
+        token = self.retriever._acquire_sync_lock()
+        other_replica.sync()
+        self.retriever._release_sync_lock(token)
+
+        other_gl.groups.get.assert_not_called()
+        bloom_filter = MmapBloomFilter(os.path.join(temp_dir.name, "second.bloom"))
+        self.assertTrue(bloom_filter.might_contain("member@example.com"))
+
+
+if __name__ == "__main__":
+    unittest.main()